@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""Benchmark the config resolution hot path of dog in-process.
+
+Times read_config, update_dependencies_in_config, docker_run_args and main (with
+os.execvp stubbed) for a set of realistic and synthetic configs, and compares the
+results with the stored baselines. No docker daemon or network is needed:
+
+    python benchmarks/config_resolution.py
+    python benchmarks/config_resolution.py --update-baseline
+
+Each measurement is the fastest of --iterations runs, as the slower ones only
+add the noise of the machine. Times are stored relative to a fixed pure-Python
+calibration workload, which is run in turn with the measured function so both
+see the same load, and the baselines can be compared between machines of
+different speed. The exit code is 1 if any
+measurement is more than --threshold times slower than its baseline, and also
+more than --noise-floor microseconds slower, so the sub-millisecond measurements
+do not fail on jitter.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Tuple
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+import dog  # noqa: E402
+
+BENCHMARKS_DIR = Path(__file__).absolute().parent
+BASELINE_FILE = BENCHMARKS_DIR / 'baselines' / 'config_resolution.json'
+HANDLERS = [
+    'perform_variable_subst',
+    'handle_auto_mount',
+    'handle_full_image',
+    'handle_usb_devices',
+    'handle_volumes',
+    'handle_normalize_volumes',
+    'handle_minimal_auto_mount',
+    'handle_volumes_covered_by_auto_mount',
+    'handle_caches',
+    'handle_resources',
+    'handle_entrypoint_mode',
+]
+
+
+def dog_config(sections: dict) -> str:
+    lines = []
+    for section, values in sections.items():
+        lines.append('[{}]'.format(section))
+        lines.extend('{} = {}'.format(k, v) for k, v in values.items())
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def dog_section(**extra) -> dict:
+    section = {
+        'dog-config-file-version': '2',
+        'image': 'debian:latest',
+        'registry': 'registry.example.com',
+    }
+    section.update(extra)
+    return section
+
+
+def realistic(directory: Path, env: dict):
+    (directory / 'shared.config').write_text(
+        dog_config(
+            {
+                'dog': dog_section(**{'user-env-vars': 'CI,BUILD_NUMBER'}),
+                'volumes': {
+                    'ssh': '~/.ssh:${home}/.ssh:ro',
+                    'gitconfig?': '~/.gitconfig:${home}/.gitconfig:ro',
+                    'cache?': '~/.cache/ccache:${home}/.cache/ccache',
+                },
+            }
+        )
+    )
+    (directory / 'dog.config').write_text(
+        dog_config(
+            {
+                'dog': {
+                    'dog-config-file-version': '2',
+                    'include-dog-config': 'shared.config',
+                    'image': 'gcc:12',
+                },
+                'volumes': {'tools': '/opt/tools:/opt/tools:ro'},
+            }
+        )
+    )
+    env.update({'CI': 'true', 'BUILD_NUMBER': '42'})
+
+
+def deep_includes(directory: Path, env: dict, depth: int = 50):
+    for i in range(depth):
+        config = {'dog': {'dog-config-file-version': '2', 'level{}'.format(i): 'x'}}
+        if i + 1 < depth:
+            config['dog']['include-dog-config'] = 'level{}.config'.format(i + 1)
+        else:
+            config['dog'].update(dog_section())
+        config['volumes'] = {'v{}'.format(i): '/src/{0}:/src/{0}'.format(i)}
+        name = 'dog.config' if i == 0 else 'level{}.config'.format(i)
+        (directory / name).write_text(dog_config(config))
+
+
+def many_volumes(directory: Path, env: dict, count: int = 300):
+    volumes = {}
+    for i in range(count):
+        if i % 3 == 0:
+            volumes['opt{}?'.format(i)] = '~/missing/{0}:/opt/{0}'.format(i)
+        elif i % 3 == 1:
+            volumes['nested{}'.format(i)] = '/data/{0}/sub:/data/{0}/sub'.format(i)
+        else:
+            volumes['v{}'.format(i)] = '/data/{0}:/data/{0}:ro'.format(i)
+    (directory / 'dog.config').write_text(
+        dog_config({'dog': dog_section(), 'volumes': volumes})
+    )
+
+
+def many_sections(directory: Path, env: dict, count: int = 200):
+    sections = {'dog': dog_section()}
+    volumes = {}
+    for i in range(count):
+        sections['section{}'.format(i)] = {
+            'path': '/srv/{}'.format(i),
+            'mode': 'ro',
+            'a': 'b',
+        }
+        if i % 10 == 0:
+            volumes['s{}'.format(i)] = '${{section{0}_path}}:/mnt/{0}'.format(i)
+    sections['volumes'] = volumes
+    (directory / 'dog.config').write_text(dog_config(sections))
+
+
+def large_env(directory: Path, env: dict, count: int = 300):
+    names = ['BENCH_VAR_{}'.format(i) for i in range(count)]
+    for name in names:
+        env[name] = 'value-of-' + name.lower() * 3
+    (directory / 'dog.config').write_text(
+        dog_config(
+            {
+                'dog': dog_section(
+                    **{
+                        'user-env-vars': ','.join(names[: count // 2]),
+                        'user-env-vars-if-set': ','.join(names[count // 2 :]),
+                    }
+                )
+            }
+        )
+    )
+
+
+SCENARIOS = {
+    'realistic': realistic,
+    'deep-includes': deep_includes,
+    'many-volumes': many_volumes,
+    'many-sections': many_sections,
+    'large-env': large_env,
+}
+
+
+def calibration_workload():
+    """A fixed workload similar in nature to config resolution."""
+    data = {'key{}'.format(i): ['/path/{}'.format(i)] * 5 for i in range(2000)}
+    json.loads(json.dumps(data))
+    sorted(str(v) for v in data.values())
+
+
+def run_time(function) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def median_time(function, iterations: int) -> float:
+    return statistics.median(run_time(function) for _ in range(iterations))
+
+
+def calibrated_min_time(timer, iterations: int) -> Tuple[float, float]:
+    """The fastest of the seconds returned by timer() and of calibration_workload."""
+    times, calibrations = [], []
+    for _ in range(iterations):
+        calibrations.append(run_time(calibration_workload))
+        times.append(timer())
+    return min(times), min(calibrations)
+
+
+@contextmanager
+def dog_environment(scenario):
+    """Run the block in a project directory set up by scenario(directory, env).
+
+    HOME, the cache and runtime dirs point into a temporary directory, and
+    os.execvp is stubbed so dog.main can be called.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp) / 'project'
+        home = Path(tmp) / 'home'
+        directory.mkdir()
+        home.mkdir()
+        env = {
+            'HOME': str(home),
+            'XDG_CACHE_HOME': str(home / '.cache'),
+            'XDG_RUNTIME_DIR': str(home / 'run'),
+        }
+        scenario(directory, env)
+        old_environ = dict(os.environ)
+        old_cwd = os.getcwd()
+        old_execvp = os.execvp
+        os.environ.update(env)
+        os.chdir(str(directory))
+        os.execvp = lambda file, args: None
+        try:
+            yield directory
+        finally:
+            os.execvp = old_execvp
+            os.chdir(old_cwd)
+            os.environ.clear()
+            os.environ.update(old_environ)
+
+
+def measure(scenario: str, iterations: int) -> Dict[str, Tuple[float, float]]:
+    """The seconds and the calibration seconds of each function."""
+    argv = ['dog', 'true']
+    with dog_environment(SCENARIOS[scenario]):
+        config = dog.read_config(argv)  # Warm up (e.g. the mount table)
+
+        def dependencies_time():
+            dog.PHASE_TIMINGS.restart()
+            dog.read_config(argv)
+            return sum(
+                span['duration']
+                for span in dog.PHASE_TIMINGS.spans
+                if span['name'] in HANDLERS
+            )
+
+        timers = {
+            'read_config': lambda: run_time(lambda: dog.read_config(argv)),
+            'update_dependencies_in_config': dependencies_time,
+            'docker_run_args': lambda: run_time(lambda: dog.docker_run_args(config)),
+            'main': lambda: run_time(lambda: dog.main(argv)),
+        }
+        return {
+            function: calibrated_min_time(timer, iterations)
+            for function, timer in timers.items()
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=1.5,
+        help='Fail if a measurement is more than this many times its baseline',
+    )
+    parser.add_argument(
+        '--noise-floor',
+        type=float,
+        default=50,
+        help='Only fail if a measurement is also this many microseconds slower',
+    )
+    parser.add_argument(
+        '--update-baseline',
+        action='store_true',
+        help='Store the results as the new baselines',
+    )
+    parser.add_argument(
+        'scenarios',
+        nargs='*',
+        metavar='SCENARIO',
+        help='Scenarios to run (default all): {}'.format(', '.join(sorted(SCENARIOS))),
+    )
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenario(s): {}'.format(', '.join(sorted(unknown))))
+
+    try:
+        baselines = json.loads(BASELINE_FILE.read_text())
+    except (OSError, ValueError):
+        baselines = {}
+    results = {}
+    regressions = []
+    print(
+        '{:<15} {:<30} {:>10} {:>9} {:>9}'.format(
+            'SCENARIO', 'FUNCTION', 'MIN us', 'RELATIVE', 'BASELINE'
+        )
+    )
+    for scenario in args.scenarios or sorted(SCENARIOS):
+        results[scenario] = {}
+        measurements = measure(scenario, args.iterations)
+        for function, (seconds, calibration) in measurements.items():
+            relative = seconds / calibration
+            results[scenario][function] = round(relative, 6)
+            baseline = baselines.get(scenario, {}).get(function)
+            verdict = ''
+            if baseline:
+                ratio = relative / baseline
+                slower_us = (relative - baseline) * calibration * 1e6
+                verdict = '{:.2f}x'.format(ratio)
+                if ratio > args.threshold and slower_us > args.noise_floor:
+                    verdict += ' REGRESSION'
+                    regressions.append((scenario, function))
+            print(
+                '{:<15} {:<30} {:>10.1f} {:>9.3f} {:>9}'.format(
+                    scenario, function, seconds * 1e6, relative, verdict
+                )
+            )
+
+    if args.update_baseline:
+        baselines.update(results)
+        BASELINE_FILE.parent.mkdir(exist_ok=True)
+        BASELINE_FILE.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+        print('Baselines written to {}'.format(BASELINE_FILE))
+        return 0
+    if regressions:
+        print(
+            '{} regression(s) above {}x the baseline and {} us slower'.format(
+                len(regressions), args.threshold, args.noise_floor
+            )
+        )
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
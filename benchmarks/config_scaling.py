@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Check that dog config resolution scales linearly with the size of dog.config.
+
+Generates synthetic dog.config files of increasing size (with [volumes] entries,
+optional volumes, user sections and ${} references to them, and user-env-vars)
+and measures the time and peak memory (traced with tracemalloc) of read_config
+for each:
+
+    python benchmarks/config_scaling.py
+    python benchmarks/config_scaling.py --sizes 1000 2000 4000 --csv scaling.csv
+
+The scaling exponent is fitted on a log-log scale (1.0 is linear, 2.0 is
+quadratic) and the exit code is 1 if it exceeds --max-exponent for the time or
+the memory. No docker daemon or network is needed.
+"""
+
+import argparse
+import math
+import sys
+import tracemalloc
+from pathlib import Path
+
+from config_resolution import dog, dog_config, dog_environment, dog_section, median_time
+
+ARGV = ['dog', 'true']
+PLOT_WIDTH = 40
+
+
+def generate_config(directory: Path, env: dict, size: int):
+    """A dog.config with about size [volumes] entries and size / 4 user sections.
+
+    A quarter of the volumes are optional (half of them existing), a quarter use
+    ${} references to the user sections and a quarter are nested in others.
+    """
+    sections = {}
+    volumes = {}
+    existing = directory / 'existing'
+    existing.mkdir()
+    for i in range((size + 3) // 4):
+        sections['section{}'.format(i)] = {'path': '/srv/{}'.format(i), 'mode': 'ro'}
+        (existing / str(i)).mkdir()
+    for i in range(size):
+        kind = i % 4
+        if kind == 0:
+            parent = existing if i % 8 == 0 else directory / 'missing'
+            volumes['opt{}?'.format(i)] = '{}/{}:/opt/{}'.format(parent, i // 4, i)
+        elif kind == 1:
+            volumes['ref{}'.format(i)] = '${{section{0}_path}}:/ref/{0}'.format(i // 4)
+        elif kind == 2:
+            volumes['nested{}'.format(i)] = '/data/{0}/sub:/data/{0}/sub'.format(i + 1)
+        else:
+            volumes['v{}'.format(i)] = '/data/{0}:/data/{0}'.format(i)
+    names = ['SCALING_VAR_{}'.format(i) for i in range(size // 4)]
+    env.update({name: 'value-{}'.format(name) for name in names})
+    config = {'dog': dog_section(**{'user-env-vars': ','.join(names)})}
+    config.update(sections)
+    config['volumes'] = volumes
+    (directory / 'dog.config').write_text(dog_config(config))
+
+
+def measure(size: int, iterations: int):
+    """Median time (seconds) and peak traced memory (bytes) of read_config."""
+    with dog_environment(lambda directory, env: generate_config(directory, env, size)):
+        dog.read_config(ARGV)  # Warm up (e.g. the mount table)
+        seconds = median_time(lambda: dog.read_config(ARGV), iterations)
+        tracemalloc.start()
+        try:
+            dog.read_config(ARGV)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return seconds, peak
+
+
+def scaling_exponent(sizes, values) -> float:
+    """The slope of a least squares fit of log(values) against log(sizes)."""
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(value) for value in values]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    numerator = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    denominator = sum((x - mean_x) ** 2 for x in xs)
+    return numerator / denominator
+
+
+def plot(value: float, maximum: float) -> str:
+    return '#' * max(1, round(PLOT_WIDTH * value / maximum))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=[250, 500, 1000, 2000, 4000],
+        help='Numbers of [volumes] entries to generate configs with',
+    )
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument(
+        '--max-exponent',
+        type=float,
+        default=1.3,
+        help='Fail if the fitted scaling exponent is above this (1.0 is linear)',
+    )
+    parser.add_argument('--csv', type=Path, help='Also write the results to this file')
+    args = parser.parse_args()
+    sizes = sorted(set(args.sizes))
+    if len(sizes) < 2 or sizes[0] <= 0:
+        parser.error('at least two different positive sizes are needed')
+
+    results = [measure(size, args.iterations) for size in sizes]
+    times = [seconds for seconds, _ in results]
+    peaks = [peak for _, peak in results]
+    print('{:>6} {:>10} {:>10}  {}'.format('SIZE', 'TIME ms', 'PEAK KiB', 'TIME'))
+    for size, seconds, peak in zip(sizes, times, peaks):
+        print(
+            '{:>6} {:>10.2f} {:>10.0f}  {}'.format(
+                size, seconds * 1000, peak / 1024, plot(seconds, max(times))
+            )
+        )
+    if args.csv:
+        args.csv.write_text(
+            'size,seconds,peak_bytes\n'
+            + ''.join(
+                '{},{:.6f},{}\n'.format(size, seconds, peak)
+                for size, seconds, peak in zip(sizes, times, peaks)
+            )
+        )
+
+    failed = False
+    for name, values in (('time', times), ('memory', peaks)):
+        exponent = scaling_exponent(sizes, values)
+        verdict = ''
+        if exponent > args.max_exponent:
+            verdict = ' - above {}, not linear'.format(args.max_exponent)
+            failed = True
+        print('Scaling exponent of the {}: {:.2f}{}'.format(name, exponent, verdict))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
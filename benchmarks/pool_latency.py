@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Compare the latency of "dog true" with and without the container pool.
+
+Run it from a directory containing a dog.config (a real docker daemon is needed):
+
+    python benchmarks/pool_latency.py --iterations 20 --pool-size 2
+
+The benchmark creates a temporary dog.config that includes the one found in the
+current directory and only overrides pool-size, so the same image, volumes, etc.
+are used for both measurements.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+DOG_PY = Path(__file__).absolute().parent.parent / 'dog.py'
+
+
+def find_dog_config() -> Path:
+    cwd = Path.cwd()
+    for directory in [cwd] + list(cwd.parents):
+        if (directory / 'dog.config').is_file():
+            return directory / 'dog.config'
+    sys.exit('Could not find dog.config in current directory or its parents')
+
+
+def write_config(directory: Path, included: Path, pool_size: int):
+    (directory / 'dog.config').write_text(
+        '[dog]\n'
+        'dog-config-file-version = 2\n'
+        'include-dog-config = {}\n'
+        'pool-size = {}\n'.format(included, pool_size)
+    )
+
+
+def measure(directory: Path, iterations: int) -> list:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, str(DOG_PY), '--not-interactive', 'true'],
+            cwd=str(directory),
+            check=True,
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name: str, timings: list):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(
+        '{:<8} median {:7.3f}s  p95 {:7.3f}s  min {:7.3f}s'.format(
+            name, statistics.median(timings), p95, timings[0]
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--pool-size', type=int, default=2)
+    parser.add_argument(
+        '--settle',
+        type=float,
+        default=3.0,
+        help='Seconds to wait between pooled runs so the pool can be refilled',
+    )
+    args = parser.parse_args()
+
+    included = find_dog_config()
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        write_config(directory, included, 0)
+        cold = measure(directory, args.iterations)
+
+        write_config(directory, included, args.pool_size)
+        measure(directory, 1)  # Fill the pool
+        pooled = []
+        for _ in range(args.iterations):
+            time.sleep(args.settle)
+            pooled.extend(measure(directory, 1))
+
+    report('cold', cold)
+    report('pooled', pooled)
+
+
+if __name__ == '__main__':
+    main()
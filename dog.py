@@ -1,17 +1,37 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import configparser
+import contextlib
 import copy
+import errno
+import fnmatch
+import functools
+import glob
+import hashlib
+import json
+import math
 import os
 import platform
 import pprint
 import re
+import select
+import shutil
+import signal
+import socket
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
 from collections import deque
 from pathlib import Path
-from typing import List, Deque, Dict, Tuple, Union
+from typing import List, Deque, Dict, Set, Tuple, Union
 
 # Version of dog
 DOG_VERSION = 15
@@ -20,14 +40,23 @@ MAX_DOG_CONFIG_VERSION = 2
 # Constants for consistent naming of dog variables, etc.
 # Configuration keys (documented externally in docs/Configuration.md)
 ADDITIONAL_DOCKER_RUN_PARAMS = 'additional-docker-run-params'
+ADMISSION_DIR = 'admission-dir'
+ADMISSION_SLOTS = 'admission-slots'
+ADMISSION_WEIGHT = 'admission-weight'
+ALLOCATION_DIR = 'allocation-dir'
 AS_ROOT = 'as-root'
 AUTO_MOUNT = 'auto-mount'
 AUTO_RUN_VOLUMES_FROM = 'auto-run-volumes-from'
+CACHE_MAX_SIZE = 'cache-max-size'
 CWD = 'cwd'
 DEVICE = 'device'
+DOCKER_HOST = 'docker-host'
+DOCKER_HOST_PERSIST = 'docker-host-persist'
 DOCKER_MINIMUM_VERSION = 'docker-minimum-version'
 DOG_CONFIG_FILE_VERSION = 'dog-config-file-version'
 DOG_CONFIG_PATH_RESOLVE_SYMLINK = 'dog-config-path-resolve-symlink'
+ENTRYPOINT_MODE = 'entrypoint-mode'
+ENV_FILE = 'env-file'
 EXPOSED_DOG_VARIABLES = 'exposed-dog-variables'
 FULL_IMAGE = 'full-image'
 GID = 'gid'
@@ -38,8 +67,14 @@ IMAGE = 'image'
 INCLUDE_DOG_CONFIG = 'include-dog-config'
 INIT = 'init'
 INTERACTIVE = 'interactive'
+JOBSERVER = 'jobserver'
+LEDGER_SIZE = 'ledger-size'
+METRICS_FILE = 'metrics-file'
 MINIMUM_VERSION = 'minimum-version'
 NETWORK = 'network'
+POOL_IDLE_TTL = 'pool-idle-ttl'
+POOL_MAX_MEMORY = 'pool-max-memory'
+POOL_SIZE = 'pool-size'
 PULL = 'pull'
 REGISTRY = 'registry'
 SANITY_CHECK_ALWAYS = 'sanity-check-always'
@@ -52,36 +87,223 @@ USER_ENV_VARS = 'user-env-vars'
 USER_ENV_VARS_IF_SET = 'user-env-vars-if-set'
 VERBOSE = 'verbose'
 VOLUMES_FROM_SILENT = 'volumes-from-silent'
+VOLUMES_RESOLVE_SYMLINKS = 'volumes-resolve-symlinks'
 # Constants (documented externally in docs/Configuration.md)
 DOG_CONFIG_PATH = 'dog-config-path'
 # Sections
+CACHES = 'caches'
 DOG = 'dog'
 PORTS = 'ports'
+RESOURCES = 'resources'
 VOLUMES = 'volumes'
 VOLUMES_FROM = 'volumes-from'
 USB_DEVICES = 'usb-devices'
 # Miscellaneous
+ADMISSION_SLOT_FDS = 'admission-slot-fds'
 ARGS = 'args'
+BENCH = 'bench'
+AUTO_MOUNT_MINIMAL = 'minimal'
+AUTO_MOUNT_MOUNTPOINT = 'mountpoint'
+AUTO_MOUNT_POINT = 'auto-mount-point'
+AUTO_MOUNT_WORKSPACE = 'workspace'
+CACHE_INPUTS = 'cache-inputs'
+CACHE_OUTPUTS = 'cache-outputs'
+CACHE_PRUNE = 'cache-prune'
+CACHE_STATS = 'cache-stats'
 CONFIG_FILE = 'dog.config'
 DOCKER = 'docker'
+ENTRYPOINT_MODE_FAST = 'fast'
+ENTRYPOINT_MODE_LEGACY = 'legacy'
+ENGINE_HOST_ARGS = 'engine-host-args'
+JOBSERVER_TOKENS = 'jobserver-tokens'
+MEASURE = 'measure'
 PODMAN = 'podman'
 SANITY_CHECK = 'sanity-check'
+STATS = 'stats'
+TIMINGS = 'timings'
 SUDO = 'sudo'
 VERSION = 'version'
+WATCH = 'watch'
 WIN32_CWD = 'win32-cwd'
 
-DOG_CONFIG_SECTIONS = [DOG, USB_DEVICES, VOLUMES, VOLUMES_FROM]
+DOG_CONFIG_SECTIONS = [
+    CACHES,
+    DOG,
+    PORTS,
+    RESOURCES,
+    USB_DEVICES,
+    VOLUMES,
+    VOLUMES_FROM,
+]
 SUBST_NAME_RE = re.compile(r'\${([^}]+)}')
+SIZE_RE = re.compile(r'^\s*([0-9.]+)\s*([kmgt]?)(i?)(b?)\s*$', re.IGNORECASE)
+SIZE_UNITS = {'': 0, 'k': 1, 'm': 2, 'g': 3, 't': 4}
+# Labels used to identify the pre-started containers of the container pool
+POOL_LABEL = 'dog.pool'
+POOL_CONTAINER_PREFIX = 'dog-pool-'
+POOL_CLAIMED_PREFIX = 'dog-claimed-'
+# Pool containers keep running once this file exists in them, and the commands
+# run in a claimed container create it. Containers which have less than
+# POOL_CLAIM_MARGIN seconds of their idle TTL left are not claimed, so they cannot
+# expire before the command has created the file
+POOL_CLAIM_MARKER = '/tmp/.dog-pool-claimed'
+POOL_CLAIM_MARGIN = 30
+# Label and index file used to keep track of the [caches] volumes
+CACHE_LABEL = 'dog.cache'
+CACHE_INDEX_FILE = 'caches.json'
+# Seconds the last use of a cache in the index may be behind, so the index is not
+# rewritten on every run
+CACHE_INDEX_RESOLUTION = 3600
+# Files and directories of the action cache (in the dog cache dir)
+ACTION_CACHE_DIR = 'actions'
+CAS_DIR = 'cas'
+HASH_DB_FILE = 'hashdb.json'
+# Files modified less than this many seconds before being hashed are not put in the
+# hash database, since they could be modified again without changing mtime
+HASH_DB_RACY_SECONDS = 2
+AUTO_MOUNT_MODES = [AUTO_MOUNT_MINIMAL, AUTO_MOUNT_MOUNTPOINT, AUTO_MOUNT_WORKSPACE]
+# Files or directories marking the root of a version controlled workspace
+VCS_MARKERS = ['.git', '.hg', '.svn', '.p4config']
+MOUNTINFO = '/proc/self/mountinfo'
+MOUNTINFO_ESCAPE_RE = re.compile(r'\\([0-7]{3})')
+# Command line options taking a separate value (used when inserting --)
+OPTIONS_WITH_VALUE = ['--cache-inputs', '--cache-outputs', '--watch']
+# Command line options taking an optional number, e.g. "--bench 5"
+OPTIONS_WITH_OPTIONAL_NUMBER = ['--bench']
+# Cache of directory listings used for the existence checks of optional volumes
+DIR_LISTING_CACHE_FILE = 'dirlistings.json'
+DIR_LISTING_MAX_WORKERS = 4
+SYSFS_ROOT = '/sys'
+# Cache of the USB device lookup (in the dog runtime dir)
+USB_DEVICES_CACHE_FILE = 'usb-devices.json'
+# Environment variable with all the exposed dog variables as a JSON object
+DOG_JSON = 'DOG_JSON'
+ENV_FILE_OPTION = '--env-file'
+ENV_FILE_PREFIX = 'env-'
+# Environment variable enabling --timings: 1 for a table on stderr or a file name
+DOG_TIMINGS_ENV = 'DOG_TIMINGS'
+# Environment variable naming a file to append a trace of each dog run to
+DOG_TRACE_FILE_ENV = 'DOG_TRACE_FILE'
+# Where --measure looks for the cgroup (v2) of the container, given its id
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_PATTERNS = [
+    'system.slice/docker-{}.scope',
+    'docker/{}',
+    'machine.slice/libpod-{}.scope',
+    '*/*/*/*/libpod-{}.scope',
+]
+MEASURE_POLL_SECONDS = 0.1
+# --watch: the container kept running between the runs of the command removes
+# itself after WATCH_CONTAINER_TTL seconds, should dog not get to remove it
+WATCH_CONTAINER_PREFIX = 'dog-watch-'
+WATCH_CONTAINER_TTL = 24 * 60 * 60
+# Changes less than WATCH_DEBOUNCE_SECONDS apart are handled as a single change
+WATCH_DEBOUNCE_SECONDS = 0.2
+# Interval of the file scans when inotify is not available
+WATCH_POLL_SECONDS = 1.0
+# How long a cancelled run gets to exit after SIGTERM before it is killed
+WATCH_CANCEL_SECONDS = 5
+# docker-host: the unix sockets (in the dog runtime dir) shared by the engine
+# commands, the default engine socket on ssh:// hosts and the settings making
+# up the connection to tcp:// hosts
+ENGINE_SOCKET_PREFIX = 'engine-'
+ENGINE_REMOTE_SOCKETS = {
+    DOCKER: '/var/run/docker.sock',
+    PODMAN: '/run/podman/podman.sock',
+}
+ENGINE_TLS_ENV_VARS = ['DOCKER_TLS', 'DOCKER_TLS_VERIFY', 'DOCKER_CERT_PATH']
+ENGINE_CONNECT_SECONDS = 10
+ENGINE_BROKER_POLL_SECONDS = 1.0
+ENGINE_HEAD_MAX_SIZE = 64 * 1024
+# inotify(7) constants
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+# The trivial command timed by --bench, and the default number of iterations
+BENCH_COMMAND = ['true']
+BENCH_ITERATIONS = 20
+# Ring buffer of recent runs (in the dog cache dir), one fixed size slot per run
+# after a header slot holding the ledger size and the next slot to write
+LEDGER_FILE = 'ledger'
+LEDGER_SLOT_SIZE = 512
+LEDGER_COMMAND_LENGTH = 60
+# Fields of a ledger entry left out, in this order, until it fits in a slot
+LEDGER_OPTIONAL_FIELDS = ['ph', 'ws', 'img', 'cmd', 'rc', 'dur']
+# Environment variable telling the container how many jobs it may run in parallel
+DOG_JOBS_ENV = 'DOG_JOBS'
+JOBSERVER_AUTH_RE = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+# Host wide admission control: a locked file per slot in admission-dir and a
+# ticket file per waiting dog (locked by it) in its queue sub directory
+ADMISSION_QUEUE_DIR = 'queue'
+ADMISSION_POLL_SECONDS = 0.2
+# Keys of the [resources] section
+RESOURCE_CPUS = 'cpus'
+RESOURCE_CPUSET = 'cpuset'
+RESOURCE_MEMORY = 'memory'
+RESOURCE_KEYS = [RESOURCE_CPUS, RESOURCE_CPUSET, RESOURCE_MEMORY]
+CPUSET_AUTO = 'auto'
+# Resources allocated to the containers of running dogs (of all users), kept in
+# <name>.json in a directory and locked with <name>.lock
+CPUSET_ALLOCATIONS = 'cpusets'
+PORT_ALLOCATIONS = 'ports'
+# Environment variable with the CPUs the container may use (e.g. 0-3,8)
+DOG_CPUS_ENV = 'DOG_CPUS'
+# Placeholder in [ports] for a free host port chosen by dog
+FREE_PORT = '${free-port}'
+FREE_PORT_ATTEMPTS = 100
+# Prefix of the environment variables with the host port of each [ports] entry
+DOG_PORT_ENV_PREFIX = 'DOG_PORT_'
+# Histogram buckets (in seconds) of the metrics written to metrics-file
+METRICS_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+METRICS = {
+    'dog_invocations_total': ('counter', 'Number of dog invocations.'),
+    'dog_pulls_total': ('counter', 'Number of docker pulls done by dog.'),
+    'dog_volumes_from_runs_total': (
+        'counter',
+        'Number of times dog ran the [volumes-from] containers.',
+    ),
+    'dog_cache_hits_total': ('counter', 'Number of cache hits (by cache).'),
+    'dog_cache_misses_total': ('counter', 'Number of cache misses (by cache).'),
+    'dog_container_exits_total': (
+        'counter',
+        'Exit status of the containers dog waited for.',
+    ),
+    'dog_overhead_seconds': (
+        'histogram',
+        'Time spent by dog itself, before starting the container.',
+    ),
+    'dog_container_run_seconds': (
+        'histogram',
+        'Run time of the containers dog waited for.',
+    ),
+}
 
 DogConfig = Dict[str, Union[str, int, bool, Path, List[str], Dict[str, str]]]
 
 DEFAULT_CONFIG = {
     ADDITIONAL_DOCKER_RUN_PARAMS: '',
+    ADMISSION_DIR: '/tmp/dog-admission',
+    ADMISSION_SLOTS: 0,
+    ADMISSION_WEIGHT: 1,
+    ALLOCATION_DIR: '/tmp/dog-allocations',
     ARGS: ['id'],
     AS_ROOT: False,
     AUTO_MOUNT: True,
     AUTO_RUN_VOLUMES_FROM: True,
+    CACHE_MAX_SIZE: '10g',
+    CACHES: {},
     CWD: '/home/nobody',
+    DOCKER_HOST: '',
+    DOCKER_HOST_PERSIST: 0,
+    ENTRYPOINT_MODE: 'legacy',
+    ENV_FILE: False,
     EXPOSED_DOG_VARIABLES: [UID, GID, USER, GROUP, HOME, AS_ROOT, VERSION],
     GID: 1000,
     GROUP: 'nogroup',
@@ -89,8 +311,15 @@ DEFAULT_CONFIG = {
     HOSTNAME: 'dog_docker',
     INIT: True,
     INTERACTIVE: True,
+    JOBSERVER: False,
+    LEDGER_SIZE: 0,
+    METRICS_FILE: '',
+    POOL_IDLE_TTL: 600,
+    POOL_MAX_MEMORY: '',
+    POOL_SIZE: 0,
     PORTS: {},
     PULL: False,
+    RESOURCES: {},
     SANITY_CHECK_ALWAYS: False,
     SUDO_OUTSIDE_DOCKER: False,
     TERMINAL: False,
@@ -105,13 +334,27 @@ DEFAULT_CONFIG = {
     VOLUMES: {},
     VOLUMES_FROM: {},
     VOLUMES_FROM_SILENT: False,
+    VOLUMES_RESOLVE_SYMLINKS: False,
 }
 
 
 class UsbDevices:
-    def __init__(self):
-        self.devs = {}
-        self._subdev_re = re.compile(r'^[0-9]+-[0-9]+(\.[0-9]+)*$')
+    """Bus and device numbers of the USB devices, indexed on 'vendor:product'.
+
+    Only the vendor:product ids asked for are looked up, and the result can be
+    cached in cache_file for as long as the USB topology is unchanged.
+    """
+
+    def __init__(
+        self,
+        vendor_products: Union[List[str], None] = None,
+        sysfs_root: str = SYSFS_ROOT,
+        cache_file: Union[Path, None] = None,
+    ):
+        self.devs = {}  # type: Dict[str, List[Tuple[int, int]]]
+        self.wanted = None if vendor_products is None else set(vendor_products)
+        self.devices_dir = os.path.join(sysfs_root, 'bus', 'usb', 'devices')
+        self.cache_file = cache_file
         self._find_devices()
 
     def get_bus_paths(self, vendor_product):
@@ -121,32 +364,523 @@ class UsbDevices:
         return ['/dev/bus/usb/{0:03}/{1:03}'.format(dev[0], dev[1]) for dev in devices]
 
     def _find_devices(self):
-        for p in Path('/sys/bus/usb/devices').glob('usb*'):
-            self._add_device(p)
-
-    def _add_device(self, p):
-        busnum = self.read_info(p / 'busnum')
-        devnum = self.read_info(p / 'devnum')
-        vendor = self.read_info(p / 'idVendor')
-        product = self.read_info(p / 'idProduct')
-        if busnum and devnum and vendor and product:
-            key = '{}:{}'.format(vendor, product)
-            try:
-                dev_list = self.devs[key]
-            except KeyError:
-                dev_list = []
-                self.devs[key] = dev_list
-            dev_list.append((int(busnum), int(devnum)))
-        for t in p.glob('{}-*'.format(busnum)):
-            m = self._subdev_re.match(str(t.name))
-            if m:
-                self._add_device(p / m[0])
+        try:
+            # Interfaces (like 1-1:1.0) are in the same directory as the devices
+            entries = [e for e in os.scandir(self.devices_dir) if ':' not in e.name]
+        except OSError:
+            return
+        # The entries are recreated, with new inode numbers, when a device is
+        # plugged in or removed
+        topology = sorted('{} {}'.format(e.name, e.inode()) for e in entries)
+        topology += sorted(self.wanted or ['*'])
+        key = hashlib.sha256('\n'.join(topology).encode()).hexdigest()
+        if self._read_cache(key):
+            PHASE_TIMINGS.annotate('usb_devices_cache_hit', True)
+            return
+        if self.cache_file is not None:
+            PHASE_TIMINGS.annotate('usb_devices_cache_hit', False)
+        for entry in entries:
+            self._add_device(entry.path)
+        self._write_cache(key)
+
+    def _add_device(self, path):
+        vendor = self.read_info(os.path.join(path, 'idVendor'))
+        product = self.read_info(os.path.join(path, 'idProduct'))
+        if not vendor or not product:
+            return
+        key = '{}:{}'.format(vendor, product)
+        if self.wanted is not None and key not in self.wanted:
+            return
+        busnum = self.read_info(os.path.join(path, 'busnum'))
+        devnum = self.read_info(os.path.join(path, 'devnum'))
+        if busnum and devnum:
+            self.devs.setdefault(key, []).append((int(busnum), int(devnum)))
+
+    def _read_cache(self, key):
+        if self.cache_file is None:
+            return False
+        try:
+            with self.cache_file.open() as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cache.get('key') != key:
+            return False
+        self.devs = {k: [tuple(dev) for dev in v] for k, v in cache['devs'].items()}
+        return True
+
+    def _write_cache(self, key):
+        if self.cache_file is None:
+            return
+        tmp_file = self.cache_file.with_name(
+            '{}.{}.tmp'.format(self.cache_file.name, os.getpid())
+        )
+        try:
+            with tmp_file.open('w') as f:
+                json.dump({'key': key, 'devs': self.devs}, f)
+            os.replace(str(tmp_file), str(self.cache_file))
+        except OSError:
+            pass
 
     @staticmethod
     def read_info(path):
-        if not path.exists():
+        try:
+            with open(path) as f:
+                return f.read().rstrip()
+        except OSError:
             return ''
-        return path.read_text().rstrip()
+
+
+class Timings:
+    """Monotonic timestamps of the phases of a dog run (see --timings).
+
+    Phases can be nested and carry attributes (like cache hits), which are
+    included in the trace appended to DOG_TRACE_FILE.
+    """
+
+    def __init__(self):
+        self.restart()
+
+    def restart(self):
+        self.start = time.monotonic()
+        self.wall_start = time.time()
+        self.spans = []  # type: List[dict]
+        self.open_spans = []  # type: List[dict]
+        self.attributes = {}  # Attributes of the whole run
+        self.finished = False
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        span = {
+            'name': name,
+            'depth': len(self.open_spans),
+            'start': time.monotonic() - self.start,
+            'duration': 0.0,
+            'attributes': {},
+        }
+        self.spans.append(span)
+        self.open_spans.append(span)
+        try:
+            yield
+        finally:
+            self.open_spans.remove(span)
+            span['duration'] = time.monotonic() - self.start - span['start']
+
+    def annotate(self, key: str, value):
+        """Add an attribute to the innermost phase (or to the whole run)."""
+        if self.open_spans:
+            self.open_spans[-1]['attributes'][key] = value
+        else:
+            self.attributes[key] = value
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """Leave the phases of the block out, e.g. those of --bench iterations."""
+        saved = self.spans, self.open_spans, self.attributes
+        self.spans, self.open_spans, self.attributes = [], [], {}
+        try:
+            yield
+        finally:
+            self.spans, self.open_spans, self.attributes = saved
+
+    def finish(self) -> bool:
+        """Stop timing; returns False if already stopped."""
+        if self.finished:
+            return False
+        self.finished = True
+        self.total = time.monotonic() - self.start
+        for span in self.open_spans:
+            span['duration'] = self.total - span['start']
+        return True
+
+    def report(self, destination: str):
+        """Print a table on stderr (destination '-') or write JSON to a file."""
+        if destination == '-':
+            for span in self.spans:
+                print(
+                    'Dog timing: {:>8.1f} ms {:>8.1f} ms  {}{}'.format(
+                        span['start'] * 1000,
+                        span['duration'] * 1000,
+                        '  ' * span['depth'],
+                        span['name'],
+                    ),
+                    file=sys.stderr,
+                )
+            print(
+                'Dog timing: {:>8.1f} ms total'.format(self.total * 1000),
+                file=sys.stderr,
+            )
+            return
+        timings = {
+            'total': self.total,
+            'phases': [
+                {k: span[k] for k in ('name', 'depth', 'start', 'duration')}
+                for span in self.spans
+            ],
+        }
+        with open(destination, 'w') as f:
+            json.dump(timings, f, indent=2)
+
+    def trace_events(self) -> List[dict]:
+        """The run and its phases as Chrome trace (Perfetto) complete events."""
+        pid = os.getpid()
+
+        def event(name: str, start: float, duration: float, attributes: dict):
+            return {
+                'name': name,
+                'ph': 'X',
+                'ts': int((self.wall_start + start) * 1000000),
+                'dur': int(duration * 1000000),
+                'pid': pid,
+                'tid': pid,
+                'args': attributes,
+            }
+
+        events = [event(DOG, 0.0, self.total, self.attributes)]
+        for span in self.spans:
+            events.append(
+                event(span['name'], span['start'], span['duration'], span['attributes'])
+            )
+        return events
+
+    def append_trace(self, trace_file: str):
+        """Append the trace as a single JSON line.
+
+        The line is written with one write to a file opened with O_APPEND (under
+        an exclusive lock where supported), so many dog processes can append to
+        the same file at the same time.
+        """
+        line = json.dumps(
+            {'pid': os.getpid(), 'traceEvents': self.trace_events()}, default=str
+        )
+        fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if sys.platform != 'win32':
+                import fcntl
+
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, (line + '\n').encode())
+        finally:
+            os.close(fd)
+
+
+PHASE_TIMINGS = Timings()
+
+
+def metrics_from_timings(image: str, timings: Timings) -> Tuple[dict, dict]:
+    """Counter increments and histogram observations of a dog run.
+
+    Both are indexed on (metric name, labels).
+    """
+    counters = {('dog_invocations_total', (('image', image),)): 1}
+    histograms = {}
+
+    def count(name: str, **labels):
+        key = (name, tuple(sorted(labels.items(), key=lambda label: label[0])))
+        counters[key] = counters.get(key, 0) + 1
+
+    run_time = 0.0
+    for span in timings.spans:
+        if span['name'] == 'docker_pull':
+            count('dog_pulls_total', image=image)
+        elif span['name'] == 'docker_run_volumes_from':
+            count('dog_volumes_from_runs_total', image=image)
+        elif span['name'] == 'run_subprocess':
+            run_time += span['duration']
+            histograms.setdefault(
+                ('dog_container_run_seconds', (('image', image),)), []
+            ).append(span['duration'])
+            if 'returncode' in span['attributes']:
+                status = str(span['attributes']['returncode'])
+                count('dog_container_exits_total', image=image, status=status)
+    attributes = [timings.attributes] + [span['attributes'] for span in timings.spans]
+    for cache in ('action_cache', 'pool', 'usb_devices_cache'):
+        for attrs in attributes:
+            hit = attrs.get('{}_hit'.format(cache))
+            if hit is not None:
+                count(
+                    'dog_cache_hits_total' if hit else 'dog_cache_misses_total',
+                    image=image,
+                    cache=cache,
+                )
+    histograms[('dog_overhead_seconds', (('image', image),))] = [
+        timings.total - run_time
+    ]
+    return counters, histograms
+
+
+def format_metric_labels(labels: tuple, extra: tuple = ()) -> str:
+    def escape(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return ','.join(
+        '{}="{}"'.format(name, escape(str(value))) for name, value in labels + extra
+    )
+
+
+def format_metrics(state: dict) -> str:
+    """The metrics state in the Prometheus text format."""
+    lines = []
+    for name, (metric_type, help_text) in sorted(METRICS.items()):
+        samples = state.get(name)
+        if not samples:
+            continue
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for labels_json, value in sorted(samples.items()):
+            labels = tuple(tuple(label) for label in json.loads(labels_json))
+            label_text = format_metric_labels(labels)
+            if metric_type == 'counter':
+                lines.append('{}{{{}}} {}'.format(name, label_text, value))
+                continue
+            cumulative = 0
+            for le, bucket in zip(METRICS_BUCKETS + ['+Inf'], value['buckets']):
+                cumulative += bucket
+                lines.append(
+                    '{}_bucket{{{}}} {}'.format(
+                        name, format_metric_labels(labels, (('le', le),)), cumulative
+                    )
+                )
+            lines.append('{}_sum{{{}}} {}'.format(name, label_text, value['sum']))
+            lines.append('{}_count{{{}}} {}'.format(name, label_text, value['count']))
+    return ''.join(line + '\n' for line in lines)
+
+
+def update_metrics(metrics_file: str, counters: dict, histograms: dict):
+    """Add the counters and observations to the Prometheus textfile metrics_file.
+
+    The accumulated values are kept in metrics_file.json; both files are
+    updated under an exclusive lock (where supported) and replaced atomically,
+    so the textfile collector never sees a partial file.
+    """
+    state_file = metrics_file + '.json'
+    lock_fd = os.open(metrics_file + '.lock', os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if sys.platform != 'win32':
+            import fcntl
+
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        for (name, labels), increment in counters.items():
+            samples = state.setdefault(name, {})
+            labels_json = json.dumps(labels)
+            samples[labels_json] = samples.get(labels_json, 0) + increment
+        for (name, labels), observations in histograms.items():
+            samples = state.setdefault(name, {})
+            histogram = samples.setdefault(
+                json.dumps(labels),
+                {'buckets': [0] * (len(METRICS_BUCKETS) + 1), 'sum': 0.0, 'count': 0},
+            )
+            for observation in observations:
+                bucket = len(METRICS_BUCKETS)
+                for i, le in enumerate(METRICS_BUCKETS):
+                    if observation <= le:
+                        bucket = i
+                        break
+                histogram['buckets'][bucket] += 1
+                histogram['sum'] += observation
+                histogram['count'] += 1
+        for path, contents in (
+            (state_file, json.dumps(state)),
+            (metrics_file, format_metrics(state)),
+        ):
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(contents)
+            os.replace(tmp_path, path)
+    finally:
+        os.close(lock_fd)
+
+
+def ledger_entry(config: DogConfig, timings: Timings) -> dict:
+    """Summary of a run for the ledger (see --stats)."""
+    entry = {
+        't': int(timings.wall_start),
+        'ws': str(config[DOG_CONFIG_PATH]),
+        'img': config[FULL_IMAGE],
+        'cmd': ' '.join(config[ARGS][:2])[:LEDGER_COMMAND_LENGTH],
+    }
+    run_spans = [span for span in timings.spans if span['name'] == 'run_subprocess']
+    run_time = sum(span['duration'] for span in run_spans)
+    entry['ovh'] = round(timings.total - run_time, 4)
+    if run_spans:
+        entry['dur'] = round(run_time, 3)
+        entry['rc'] = run_spans[-1]['attributes'].get('returncode')
+    # The slowest phases without nested phases
+    spans = timings.spans
+    leaves = [
+        span
+        for i, span in enumerate(spans)
+        if span['name'] != 'run_subprocess'
+        and (i + 1 == len(spans) or spans[i + 1]['depth'] <= span['depth'])
+    ]
+    leaves.sort(key=lambda span: span['duration'], reverse=True)
+    entry['ph'] = [[span['name'], round(span['duration'], 4)] for span in leaves[:3]]
+    return entry
+
+
+def encode_ledger_slot(entry: dict) -> bytes:
+    entry = dict(entry)
+    optional_fields = list(LEDGER_OPTIONAL_FIELDS)
+    data = json.dumps(entry, separators=(',', ':')).encode()
+    while len(data) >= LEDGER_SLOT_SIZE:
+        entry.pop(optional_fields.pop(0), None)
+        data = json.dumps(entry, separators=(',', ':')).encode()
+    return data.ljust(LEDGER_SLOT_SIZE - 1) + b'\n'
+
+
+def append_to_ledger(ledger_file: Path, size: int, entry: dict):
+    """Write entry to the next slot of the ring buffer, overwriting the oldest."""
+    fd = os.open(str(ledger_file), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if sys.platform != 'win32':
+            import fcntl
+
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = json.loads(os.read(fd, LEDGER_SLOT_SIZE).decode())
+        except ValueError:
+            header = {}
+        if header.get('size') != size:
+            # New ledger, or resized
+            os.ftruncate(fd, 0)
+            header = {'size': size, 'next': 0}
+        slot = header['next'] % size + 1
+        os.lseek(fd, slot * LEDGER_SLOT_SIZE, os.SEEK_SET)
+        os.write(fd, encode_ledger_slot(entry))
+        header['next'] = slot % size
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, encode_ledger_slot(header))
+    finally:
+        os.close(fd)
+
+
+def read_ledger(ledger_file: Path) -> List[dict]:
+    entries = []
+    try:
+        with ledger_file.open('rb') as f:
+            f.read(LEDGER_SLOT_SIZE)  # Header
+            for slot in iter(lambda: f.read(LEDGER_SLOT_SIZE), b''):
+                try:
+                    entries.append(json.loads(slot.decode()))
+                except ValueError:
+                    pass
+    except OSError:
+        pass
+    return sorted(entries, key=lambda entry: entry['t'])
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile."""
+    values = sorted(values)
+    rank = -(-p * len(values) // 100)
+    return values[max(0, int(rank) - 1)]
+
+
+def show_stats(config: DogConfig) -> int:
+    """Summarize the runs recorded in the ledger."""
+    entries = read_ledger(get_cache_dir() / LEDGER_FILE)
+    if not entries:
+        print('No runs recorded - set {} in the [dog] section'.format(LEDGER_SIZE))
+        return 0
+    first = time.strftime('%Y-%m-%d %H:%M', time.localtime(entries[0]['t']))
+    print('Dog runs recorded since {}: {}'.format(first, len(entries)))
+
+    print('\nOverhead per image (ms):')
+    print('{:<50} {:>6} {:>8} {:>8}'.format('IMAGE', 'RUNS', 'P50', 'P95'))
+    by_image = {}  # type: Dict[str, List[float]]
+    for entry in entries:
+        by_image.setdefault(entry.get('img', '?'), []).append(entry['ovh'] * 1000)
+    for image, overheads in sorted(by_image.items()):
+        p50 = percentile(overheads, 50)
+        p95 = percentile(overheads, 95)
+        print('{:<50} {:>6} {:>8.1f} {:>8.1f}'.format(image, len(overheads), p50, p95))
+
+    print('\nSlowest phases (ms):')
+    print('{:<50} {:>6} {:>8} {:>8}'.format('PHASE', 'RUNS', 'TOTAL', 'MAX'))
+    phases = {}  # type: Dict[str, List[float]]
+    for entry in entries:
+        for name, duration in entry.get('ph', []):
+            phases.setdefault(name, []).append(duration * 1000)
+    slowest = sorted(phases.items(), key=lambda item: sum(item[1]), reverse=True)
+    for name, durations in slowest[:5]:
+        print(
+            '{:<50} {:>6} {:>8.1f} {:>8.1f}'.format(
+                name, len(durations), sum(durations), max(durations)
+            )
+        )
+
+    print('\nMost frequent commands:')
+    print('{:<50} {:>6} {:>8}'.format('COMMAND', 'RUNS', 'FAILED'))
+    commands = {}  # type: Dict[Tuple[str, str], List[dict]]
+    for entry in entries:
+        command = (entry.get('img', '?'), entry.get('cmd', '?'))
+        commands.setdefault(command, []).append(entry)
+    frequent = sorted(commands.items(), key=lambda item: len(item[1]), reverse=True)
+    for (_, command), runs in frequent[:5]:
+        failed = len([run for run in runs if run.get('rc') not in (None, 0)])
+        print('{:<50} {:>6} {:>8}'.format(command, len(runs), failed))
+
+    # Short commands run often lose the largest share of their time to starting
+    # containers, so they gain the most from pool-size
+    print('\nCandidates for {} (most total overhead, ms):'.format(POOL_SIZE))
+    print('{:<50} {:>6} {:>8} {:>8}'.format('COMMAND', 'RUNS', 'TOTAL', 'SHARE'))
+    overhead = sorted(
+        commands.items(),
+        key=lambda item: sum(run['ovh'] for run in item[1]),
+        reverse=True,
+    )
+    for (_, command), runs in overhead[:5]:
+        total_overhead = sum(run['ovh'] for run in runs)
+        run_times = [run['dur'] for run in runs if 'dur' in run]
+        share = ''
+        if run_times:
+            share = '{:.0f}%'.format(
+                100 * total_overhead / (total_overhead + sum(run_times))
+            )
+        print(
+            '{:<50} {:>6} {:>8.1f} {:>8}'.format(
+                command, len(runs), total_overhead * 1000, share
+            )
+        )
+    return 0
+
+
+def report_run(config: DogConfig):
+    """Report the timings (--timings), trace (DOG_TRACE_FILE) and metrics once."""
+    if not PHASE_TIMINGS.finish():
+        return
+    if config.get(TIMINGS):
+        PHASE_TIMINGS.report(config[TIMINGS])
+    trace_file = os.getenv(DOG_TRACE_FILE_ENV)
+    if trace_file:
+        try:
+            PHASE_TIMINGS.append_trace(trace_file)
+        except OSError as e:
+            print(
+                'Dog could not write trace to {}: {}'.format(trace_file, e),
+                file=sys.stderr,
+            )
+    ledger_size = int_from_config(config, LEDGER_SIZE)
+    if ledger_size > 0 and config[ARGS]:
+        entry = ledger_entry(config, PHASE_TIMINGS)
+        try:
+            append_to_ledger(get_cache_dir() / LEDGER_FILE, ledger_size, entry)
+        except OSError as e:
+            print('Dog could not update the ledger: {}'.format(e), file=sys.stderr)
+    if config[METRICS_FILE]:
+        counters, histograms = metrics_from_timings(config[FULL_IMAGE], PHASE_TIMINGS)
+        try:
+            update_metrics(config[METRICS_FILE], counters, histograms)
+        except OSError as e:
+            print(
+                'Dog could not update {}: {}'.format(config[METRICS_FILE], e),
+                file=sys.stderr,
+            )
 
 
 def log_verbose(config: DogConfig, txt: str):
@@ -191,6 +925,27 @@ def list_from_config_entry(entry: str) -> List[str]:
     return [s.strip() for s in var_list]
 
 
+def int_from_config(config: DogConfig, key: str) -> int:
+    try:
+        return int(config[key])
+    except ValueError:
+        fatal_error('{} must be an integer (got "{}")'.format(key, config[key]))
+
+
+def parse_size(size: str) -> int:
+    """Parse sizes like "512m", "2GiB" or "1.5 kB" into a number of bytes.
+
+    Like docker, "kB", "MB", etc. are decimal units while "k", "KiB", etc. are
+    binary units.
+    """
+    m = SIZE_RE.match(size)
+    if not m:
+        raise ValueError('Could not parse size "{}"'.format(size))
+    number, unit, binary, byte = m.groups()
+    base = 1000 if unit and byte and not binary else 1024
+    return int(float(number) * base ** SIZE_UNITS[unit.lower()])
+
+
 def get_user_env_vars(
     config_user_env_vars: str, allow_empty: bool
 ) -> Dict[str, Union[str, List[str]]]:
@@ -287,7 +1042,10 @@ def handle_booleans_in_config(config, dog_config):
     """Use DEFAULT_CONFIG to determine which values should be booleans."""
     for k, v in DEFAULT_CONFIG.items():
         if isinstance(v, bool) and k in config[DOG]:
-            dog_config[k] = config[DOG].getboolean(k)
+            if k == AUTO_MOUNT and config[DOG][k].lower() in AUTO_MOUNT_MODES:
+                dog_config[k] = config[DOG][k].lower()
+            else:
+                dog_config[k] = config[DOG].getboolean(k)
 
 
 def handle_user_env_vars(dog_config):
@@ -302,7 +1060,7 @@ def handle_user_env_vars(dog_config):
 
 
 def handle_dict_config_vars(config: configparser.ConfigParser, dog_config):
-    for v in [PORTS, USB_DEVICES, VOLUMES_FROM]:
+    for v in [CACHES, PORTS, RESOURCES, USB_DEVICES, VOLUMES_FROM]:
         if v in config:
             dog_config[v] = dict(config[v])
 
@@ -418,6 +1176,52 @@ def parse_command_line_args(own_name: str, argv: list) -> DogConfig:
     parser.add_argument(
         '--version', action=VERSION, version='dog version {}'.format(DOG_VERSION)
     )
+    parser.add_argument(
+        '--cache-inputs',
+        dest=CACHE_INPUTS,
+        action='append',
+        metavar='GLOBS',
+        help='Comma-separated globs of the input files of a deterministic command.'
+        ' If the inputs, image, command and environment are unchanged since an'
+        ' earlier run, the outputs are restored without running the command',
+    )
+    parser.add_argument(
+        '--cache-outputs',
+        dest=CACHE_OUTPUTS,
+        action='append',
+        metavar='GLOBS',
+        help='Comma-separated globs of the output files to store (see'
+        ' --cache-inputs)',
+    )
+    parser.add_argument(
+        '--watch',
+        dest=WATCH,
+        action='append',
+        metavar='GLOBS',
+        help='Keep the container running and run the command again (cancelling'
+        ' a run in progress) every time files matching the comma-separated globs'
+        ' change. Stop with Ctrl+C',
+    )
+    parser.add_argument(
+        '--timings',
+        dest=TIMINGS,
+        nargs='?',
+        const='-',
+        metavar='FILE',
+        help='Show how long each phase of dog takes on stderr, or write it as JSON'
+        ' to FILE (--timings=FILE). Can also be enabled with {}=1 or'
+        ' {}=FILE'.format(DOG_TIMINGS_ENV, DOG_TIMINGS_ENV),
+    )
+    parser.add_argument(
+        '--measure',
+        dest=MEASURE,
+        nargs='?',
+        const='-',
+        metavar='FILE',
+        help='Report the CPU time, peak memory, block I/O and wall time of the'
+        ' container (and the overhead of dog) on stderr, or as JSON to FILE'
+        ' (--measure=FILE)',
+    )
     parser.add_argument(
         '--verbose',
         dest=VERBOSE,
@@ -440,16 +1244,60 @@ def parse_command_line_args(own_name: str, argv: list) -> DogConfig:
         const=True,
         help='Perform sanity check, i.e. is required docker version available',
     )
+    sanity_check_group.add_argument(
+        '--bench',
+        dest=BENCH,
+        nargs='?',
+        type=int,
+        const=BENCH_ITERATIONS,
+        metavar='N',
+        help='Measure the latency of running "{}" N times (--bench=N, default {})'
+        ' with the different ways dog can start containers'.format(
+            ' '.join(BENCH_COMMAND), BENCH_ITERATIONS
+        ),
+    )
+    sanity_check_group.add_argument(
+        '--stats',
+        dest=STATS,
+        action='store_const',
+        const=True,
+        help='Summarize the runs recorded in the ledger (see {})'.format(LEDGER_SIZE),
+    )
+    sanity_check_group.add_argument(
+        '--cache-stats',
+        dest=CACHE_STATS,
+        action='store_const',
+        const=True,
+        help='Show the size and last use of your [caches] volumes on this host',
+    )
+    sanity_check_group.add_argument(
+        '--cache-prune',
+        dest=CACHE_PRUNE,
+        action='store_const',
+        const=True,
+        help='Remove your least recently used [caches] volumes until their total'
+        ' size is below {}'.format(CACHE_MAX_SIZE),
+    )
 
     # Insert the needed -- to separate dog args with the rest of the commands
     # But only if the user did not do it himself
     if DOG not in own_name:
         argv.insert(0, own_name)
     if '--' not in argv:
-        for index, arg in enumerate(argv):
+        index = 0
+        while index < len(argv):
+            arg = argv[index]
             if arg[0] != '-':
                 argv.insert(index, '--')
                 break
+            if arg in OPTIONS_WITH_VALUE or (
+                arg in OPTIONS_WITH_OPTIONAL_NUMBER
+                and index + 1 < len(argv)
+                and argv[index + 1].isdigit()
+            ):
+                index += 2
+            else:
+                index += 1
     args = parser.parse_args(argv)
     config = vars(args)
     if config[PULL] is None:
@@ -462,6 +1310,12 @@ def parse_command_line_args(own_name: str, argv: list) -> DogConfig:
         del config[AS_ROOT]
     if config[VERBOSE] is None:
         del config[VERBOSE]
+    if config[TIMINGS] is None:
+        del config[TIMINGS]
+    if config[MEASURE] is None:
+        del config[MEASURE]
+    if config[WATCH] is None:
+        del config[WATCH]
     return config
 
 
@@ -470,6 +1324,62 @@ def win32_to_dog_unix(win_path: Path) -> str:
     return '/' + win_path.as_posix().replace(':', '')
 
 
+def get_runtime_dir() -> Path:
+    """Private directory for files dog generates while running."""
+    xdg_runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if xdg_runtime_dir:
+        runtime_dir = Path(xdg_runtime_dir) / DOG
+    elif sys.platform == 'win32':
+        runtime_dir = Path(tempfile.gettempdir()) / DOG
+    else:
+        # Anyone can create it first in the shared temp dir, and it holds files
+        # mounted into containers, env files and the engine sockets
+        runtime_dir = Path(tempfile.gettempdir()) / 'dog-{}'.format(os.getuid())
+        try:
+            runtime_dir.mkdir(mode=0o700)
+        except FileExistsError:
+            pass
+        st = os.lstat(str(runtime_dir))
+        if (
+            not stat.S_ISDIR(st.st_mode)
+            or st.st_uid != os.getuid()
+            or stat.S_IMODE(st.st_mode) != 0o700
+        ):
+            fatal_error(
+                '{} must be a directory owned by you with mode 0700'.format(runtime_dir)
+            )
+        return runtime_dir
+    runtime_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return runtime_dir
+
+
+def get_cache_dir() -> Path:
+    """Persistent directory for data dog keeps between runs."""
+    if sys.platform == 'win32':
+        base_dir = os.getenv('LOCALAPPDATA') or str(Path.home())
+    else:
+        base_dir = os.getenv('XDG_CACHE_HOME') or str(Path.home() / '.cache')
+    cache_dir = Path(base_dir) / DOG
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def write_runtime_file(prefix: str, contents: str) -> Path:
+    """Write contents to a content-addressed file in the runtime dir.
+
+    The files are never deleted, since they are bind-mounted into containers
+    that outlive dog (dog execs into docker), but as the name is based on the
+    contents the same file is reused by all following runs.
+    """
+    digest = hashlib.sha256(contents.encode()).hexdigest()[:16]
+    path = get_runtime_dir() / '{}-{}'.format(prefix, digest)
+    if not path.exists():
+        tmp_path = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+        tmp_path.write_text(contents)
+        os.replace(str(tmp_path), str(path))
+    return path
+
+
 def get_env_config() -> DogConfig:
     hostname = platform.node()
     if sys.platform == 'win32':
@@ -519,10 +1429,89 @@ def get_env_config() -> DogConfig:
         return env_config
 
 
-def find_mount_point(p: Path):
-    while not os.path.ismount(str(p)) and not str(p.parent) == p.root:
-        p = p.parent
-    return p
+def get_env_timings() -> DogConfig:
+    dog_timings = os.getenv(DOG_TIMINGS_ENV)
+    if not dog_timings or dog_timings == '0':
+        return {}
+    return {TIMINGS: '-' if dog_timings == '1' else dog_timings}
+
+
+class MountTable:
+    """The mount points of the host as a trie of path components.
+
+    Finding the mount containing a path is a single walk down the trie, without
+    touching the file system (stat'ing paths on autofs/NFS can trigger automounts
+    or hang).
+    """
+
+    MOUNT = ''  # Key used in a trie node to store the mount point ending there
+
+    def __init__(self, mount_points: List[str]):
+        self.trie = {}
+        for mount_point in mount_points:
+            self.add(mount_point)
+
+    @classmethod
+    def from_mountinfo(cls, mountinfo: str) -> 'MountTable':
+        mount_points = []
+        with open(mountinfo) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 4:
+                    mount_points.append(
+                        MOUNTINFO_ESCAPE_RE.sub(
+                            lambda m: chr(int(m.group(1), 8)), fields[4]
+                        )
+                    )
+        return cls(mount_points)
+
+    @staticmethod
+    def _components(path: str) -> List[str]:
+        return [c for c in path.split('/') if c and c != '.']
+
+    def add(self, mount_point: str):
+        node = self.trie
+        for component in self._components(mount_point):
+            node = node.setdefault(component, {})
+        node[self.MOUNT] = '/' + '/'.join(self._components(mount_point))
+
+    def find(self, path: str) -> str:
+        """Return the mount point of the mount containing path."""
+        node = self.trie
+        mount_point = node.get(self.MOUNT, '/')
+        for component in self._components(os.path.normpath(path)):
+            node = node.get(component)
+            if node is None:
+                break
+            mount_point = node.get(self.MOUNT, mount_point)
+        return mount_point
+
+
+@functools.lru_cache()
+def get_mount_table(mountinfo: str = MOUNTINFO) -> Union[MountTable, None]:
+    try:
+        return MountTable.from_mountinfo(mountinfo)
+    except OSError:
+        return None
+
+
+def find_mount_point(p: Path, mount_table: MountTable = None):
+    """Find the directory to auto-mount for p.
+
+    This is the mount point of the mount containing p - except for the root
+    file system, where the top-level directory containing p is used instead.
+    """
+    if mount_table is None:
+        mount_table = get_mount_table()
+    if mount_table is None:
+        # No /proc/self/mountinfo (e.g. macOS), so check each parent instead
+        while not os.path.ismount(str(p)) and not str(p.parent) == p.root:
+            p = p.parent
+        return p
+    mount_point = Path(mount_table.find(str(p)))
+    if str(mount_point) == p.root and len(p.parts) > 1:
+        return Path(p.root) / p.parts[1]
+    return mount_point
 
 
 def docker_cmd(config: DogConfig) -> str:
@@ -533,6 +1522,7 @@ def docker_pull(config: DogConfig):
     try:
         args = [SUDO] if config[SUDO_OUTSIDE_DOCKER] else []
         args.append(docker_cmd(config))
+        args += docker_host_args(config)
         args += ['pull', config[FULL_IMAGE]]
         proc = subprocess.run(args)
         if proc.returncode != 0:
@@ -545,21 +1535,76 @@ def docker_pull(config: DogConfig):
         sys.exit(-1)
 
 
-def generate_env_arg_list(config: DogConfig) -> List[str]:
-    args = []
+def generate_env_vars(config: DogConfig) -> List[Tuple[str, str]]:
+    env_vars = []
     for name in config[EXPOSED_DOG_VARIABLES]:
         env_name = name.upper().replace('-', '_')
-        args.extend(['-e', 'DOG_{}={}'.format(env_name, config[name])])
+        env_vars.append(('DOG_{}'.format(env_name), str(config[name])))
 
-    for env_name, value in config[USER_ENV_VARS].items():
-        args.extend(['-e', '{}={}'.format(env_name, value)])
-    for env_name, value in config[USER_ENV_VARS_IF_SET].items():
+    env_vars.extend(config[USER_ENV_VARS].items())
+    env_vars.extend(config[USER_ENV_VARS_IF_SET].items())
+    return env_vars
+
+
+def generate_env_arg_list(config: DogConfig) -> List[str]:
+    args = []
+    for env_name, value in generate_env_vars(config):
         args.extend(['-e', '{}={}'.format(env_name, value)])
     return args
 
 
+def generate_dog_json(config: DogConfig) -> str:
+    return json.dumps(
+        {name: config[name] for name in config[EXPOSED_DOG_VARIABLES]},
+        sort_keys=True,
+        default=str,
+    )
+
+
+def write_env_file(config: DogConfig) -> List[str]:
+    """Write the environment to a private file and return the args using it.
+
+    The file is created in the runtime dir (tmpfs on most Linux systems), only
+    readable by the user, which keeps the values out of the docker command line.
+    Values containing newlines cannot be put in an env file, so they are still
+    passed with -e.
+    """
+    env_vars = generate_env_vars(config) + [(DOG_JSON, generate_dog_json(config))]
+    lines = []
+    args = []
+    for env_name, value in env_vars:
+        if '\n' in value:
+            args.extend(['-e', '{}={}'.format(env_name, value)])
+        else:
+            lines.append('{}={}\n'.format(env_name, value))
+    path = get_runtime_dir() / '{}{}'.format(ENV_FILE_PREFIX, uuid.uuid4().hex)
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(''.join(lines))
+    return [ENV_FILE_OPTION, str(path)] + args
+
+
+def generate_env_args(config: DogConfig) -> List[str]:
+    if config[ENV_FILE]:
+        return write_env_file(config)
+    return generate_env_arg_list(config)
+
+
+def remove_env_file(args: List[str]):
+    """Remove the env file written by write_env_file (if any) used in args."""
+    if ENV_FILE_OPTION not in args:
+        return
+    path = Path(args[args.index(ENV_FILE_OPTION) + 1])
+    if path.parent == get_runtime_dir() and path.name.startswith(ENV_FILE_PREFIX):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
 def docker_container_names(config: DogConfig) -> List[str]:
-    args = [docker_cmd(config), 'container', 'ls', '-a', '--format={{.Names}}']
+    args = [docker_cmd(config)] + docker_host_args(config)
+    args += ['container', 'ls', '-a', '--format={{.Names}}']
     proc = subprocess.run(
         args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
     )
@@ -587,6 +1632,7 @@ def docker_run_volumes_from(config: DogConfig):
 
         proc = await asyncio.create_subprocess_exec(
             cmd,
+            *docker_host_args(config),
             'run',
             '--network',
             'none',
@@ -608,14 +1654,363 @@ def docker_run_volumes_from(config: DogConfig):
     loop.close()
 
 
-def docker_run(config: DogConfig):
+def docker_base_args(config: DogConfig) -> List[str]:
+    args = [SUDO] if config[SUDO_OUTSIDE_DOCKER] else []
+    return args + [docker_cmd(config)] + docker_host_args(config)
+
+
+def read_cache_index() -> Dict[str, float]:
+    try:
+        with (get_cache_dir() / CACHE_INDEX_FILE).open() as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache_index(index: Dict[str, float]):
+    index_file = get_cache_dir() / CACHE_INDEX_FILE
+    tmp_file = index_file.with_name('{}.{}.tmp'.format(index_file.name, os.getpid()))
+    with tmp_file.open('w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(str(tmp_file), str(index_file))
+
+
+def docker_cache_volume_names(config: DogConfig) -> List[str]:
+    args = docker_base_args(config)
+    args += [
+        'volume',
+        'ls',
+        '--filter',
+        'label={}'.format(CACHE_LABEL),
+        '--format={{.Name}}',
+    ]
+    proc = subprocess.run(
+        args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+    )
+    return proc.stdout.splitlines()
+
+
+def docker_create_caches(config: DogConfig):
+    """Create missing [caches] volumes and record that the caches were used.
+
+    A new volume is owned by root, so it is chowned to the dog user (by running
+    chown in the image itself, bypassing the entrypoint) before first use. The
+    engine is always asked for the existing volumes, since the index cannot tell
+    if a volume was removed (or if the home is shared with another engine).
+    """
+    index = read_cache_index()
+    volumes = {name: cache_volume_name(config, name) for name in config[CACHES]}
+    existing = set(docker_cache_volume_names(config))
+    now = time.time()
+    index_modified = False
+    for name, volume in volumes.items():
+        if index.get(volume, 0.0) < now - CACHE_INDEX_RESOLUTION:
+            index[volume] = now
+            index_modified = True
+        if volume in existing:
+            continue
+        log_verbose(config, 'Dog creating cache volume: {}'.format(volume))
+        args = docker_base_args(config)
+        args += [
+            'volume',
+            'create',
+            '--label',
+            '{}={}'.format(CACHE_LABEL, name),
+            '--label',
+            '{}.image={}'.format(CACHE_LABEL, config[FULL_IMAGE]),
+            '--label',
+            '{}.uid={}'.format(CACHE_LABEL, config[UID]),
+            volume,
+        ]
+        subprocess.run(args, stdout=subprocess.DEVNULL)
+        args = docker_base_args(config)
+        args += [
+            'run',
+            '--rm',
+            '--network',
+            'none',
+            '--user',
+            '0:0',
+            '--entrypoint',
+            'chown',
+            '-v',
+            '{}:/dog-cache'.format(volume),
+            config[FULL_IMAGE],
+            '{}:{}'.format(config[UID], config[GID]),
+            '/dog-cache',
+        ]
+        proc = subprocess.run(args, stdout=subprocess.DEVNULL)
+        if proc.returncode != 0:
+            print(
+                'WARNING[dog]: Could not change owner of cache volume {}'.format(
+                    volume
+                ),
+                file=sys.stderr,
+            )
+    if index_modified:
+        write_cache_index(index)
+
+
+def docker_cache_sizes(config: DogConfig) -> Dict[str, int]:
+    args = docker_base_args(config)
+    args += ['system', 'df', '-v', '--format={{json .}}']
+    proc = subprocess.run(
+        args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+    )
+    sizes = {}
+    try:
+        volumes = json.loads(proc.stdout).get('Volumes') or []
+    except ValueError:
+        return sizes
+    for volume in volumes:
+        try:
+            sizes[volume['Name']] = parse_size(volume['Size'])
+        except (KeyError, ValueError):
+            pass
+    return sizes
+
+
+def get_cache_volumes(config: DogConfig) -> List[Tuple[str, int, float]]:
+    """The [caches] volumes of the user as (name, size, last used), oldest first.
+
+    The volumes of other users on the host are not in the index of this user, so
+    they are left alone.
+    """
+    index = read_cache_index()
+    sizes = docker_cache_sizes(config)
+    volumes = [
+        (name, sizes.get(name, 0), index[name])
+        for name in docker_cache_volume_names(config)
+        if name in index
+    ]
+    return sorted(volumes, key=lambda v: v[2])
+
+
+def format_size(size: int) -> str:
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TiB'
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
+
+
+def docker_cache_stats(config: DogConfig) -> int:
+    volumes = get_cache_volumes(config)
+    print('{:<50} {:>12}  {}'.format('CACHE VOLUME', 'SIZE', 'LAST USED'))
+    for name, size, last_used in reversed(volumes):
+        used = time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used))
+        print('{:<50} {:>12}  {}'.format(name, format_size(size), used))
+    total = sum(v[1] for v in volumes)
+    print('Total: {} in {} cache volumes'.format(format_size(total), len(volumes)))
+    return 0
+
+
+def docker_cache_prune(config: DogConfig) -> int:
+    try:
+        max_size = parse_size(str(config[CACHE_MAX_SIZE]))
+    except ValueError as e:
+        fatal_error('{}: {}'.format(CACHE_MAX_SIZE, e))
+    volumes = get_cache_volumes(config)
+    total = sum(v[1] for v in volumes)
+    index = read_cache_index()
+    for name, size, _ in volumes:
+        if total <= max_size:
+            break
+        args = docker_base_args(config) + ['volume', 'rm', name]
+        proc = subprocess.run(args, stdout=subprocess.DEVNULL)
+        if proc.returncode != 0:
+            # Most likely in use by a running container
+            continue
+        print('Dog removed cache volume: {} ({})'.format(name, format_size(size)))
+        index.pop(name, None)
+        total -= size
+    write_cache_index(index)
+    return 0
+
+
+class HashDatabase:
+    """sha256 of files, indexed on path, mtime and size to avoid rehashing."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.modified = False
+        try:
+            with path.open() as f:
+                self.db = json.load(f)
+        except (OSError, ValueError):
+            self.db = {}
+
+    def hash_file(self, file_name: str) -> str:
+        file_name = os.path.abspath(file_name)
+        st = os.stat(file_name)
+        entry = self.db.get(file_name)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        h = hashlib.sha256()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        if st.st_mtime < time.time() - HASH_DB_RACY_SECONDS:
+            self.db[file_name] = [st.st_mtime_ns, st.st_size, digest]
+            self.modified = True
+        return digest
+
+    def save(self):
+        if not self.modified:
+            return
+        tmp_path = self.path.with_name('{}.{}.tmp'.format(self.path.name, os.getpid()))
+        with tmp_path.open('w') as f:
+            json.dump(self.db, f)
+        os.replace(str(tmp_path), str(self.path))
+        self.modified = False
+
+
+def expand_globs(glob_options: List[str]) -> List[str]:
+    """Sorted list of the files matching the comma-separated globs."""
+    files = set()
+    for option in glob_options or []:
+        for pattern in list_from_config_entry(option):
+            for file_name in glob.glob(pattern, recursive=True):
+                if os.path.isfile(file_name):
+                    files.add(os.path.normpath(file_name))
+    return sorted(files)
+
+
+def docker_image_id(config: DogConfig) -> str:
+    args = docker_base_args(config)
+    args += ['image', 'inspect', '--format={{.Id}}', config[FULL_IMAGE]]
+    proc = subprocess.run(
+        args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+    )
+    return proc.stdout.strip() if proc.returncode == 0 else ''
+
+
+def is_per_run_env_var(env_name: str) -> bool:
+    """Whether dog sets the variable for each run, e.g. from the free resources."""
+    return env_name in (DOG_JOBS_ENV, DOG_CPUS_ENV) or env_name.startswith(
+        DOG_PORT_ENV_PREFIX
+    )
+
+
+def action_cache_key(config: DogConfig, image_id: str, hash_db: HashDatabase) -> str:
+    h = hashlib.sha256()
+    action = {
+        'image': image_id,
+        'args': config[ARGS],
+        'cwd': str(config[CWD]),
+        # The variables set for each run would make every run a miss
+        'env': [
+            (env_name, value)
+            for env_name, value in generate_env_vars(config)
+            if not is_per_run_env_var(env_name)
+        ],
+        'outputs': config[CACHE_OUTPUTS],
+        'inputs': [
+            (file_name, hash_db.hash_file(file_name))
+            for file_name in expand_globs(config[CACHE_INPUTS])
+        ],
+    }
+    h.update(json.dumps(action, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def cas_path(digest: str) -> Path:
+    return get_cache_dir() / CAS_DIR / digest[:2] / digest
+
+
+def restore_cached_outputs(config: DogConfig, manifest_path: Path) -> bool:
+    try:
+        with manifest_path.open() as f:
+            outputs = json.load(f)['outputs']
+    except (OSError, ValueError, KeyError):
+        return False
+    if not all(cas_path(digest).is_file() for _, digest, _ in outputs):
+        return False
+    for file_name, digest, mode in outputs:
+        log_verbose(config, 'Dog restoring {} from action cache'.format(file_name))
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_name = '{}.{}.tmp'.format(file_name, os.getpid())
+        shutil.copyfile(str(cas_path(digest)), tmp_name)
+        os.chmod(tmp_name, mode)
+        os.replace(tmp_name, file_name)
+    return True
+
+
+def store_outputs(config: DogConfig, manifest_path: Path, hash_db: HashDatabase):
+    outputs = []
+    for file_name in expand_globs(config[CACHE_OUTPUTS]):
+        digest = hash_db.hash_file(file_name)
+        blob = cas_path(digest)
+        if not blob.is_file():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp_blob = blob.with_name('{}.{}.tmp'.format(blob.name, os.getpid()))
+            shutil.copyfile(file_name, str(tmp_blob))
+            os.replace(str(tmp_blob), str(blob))
+        outputs.append((file_name, digest, os.stat(file_name).st_mode & 0o7777))
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_name(
+        '{}.{}.tmp'.format(manifest_path.name, os.getpid())
+    )
+    with tmp_path.open('w') as f:
+        json.dump({'args': config[ARGS], 'outputs': outputs}, f, indent=1)
+    os.replace(str(tmp_path), str(manifest_path))
+
+
+def docker_run_with_action_cache(config: DogConfig) -> int:
+    """Run a deterministic command, reusing the outputs of an identical earlier run.
+
+    The action key covers the image id, the command, the working directory, the
+    environment given to the container and the contents of all input files.
+    Only runs that succeed are stored.
+    """
+    if not config[CACHE_INPUTS] or not config[CACHE_OUTPUTS]:
+        fatal_error('--cache-inputs and --cache-outputs must be used together')
+    hash_db = HashDatabase(get_cache_dir() / HASH_DB_FILE)
+    image_id = docker_image_id(config)
+    manifest_path = None
+    if image_id:
+        key = action_cache_key(config, image_id, hash_db)
+        manifest_path = get_cache_dir() / ACTION_CACHE_DIR / key[:2] / key
+        hit = restore_cached_outputs(config, manifest_path)
+        PHASE_TIMINGS.annotate('action_cache_hit', hit)
+        if hit:
+            hash_db.save()
+            log_verbose(config, 'Dog action cache hit: {}'.format(key))
+            return 0
+        log_verbose(config, 'Dog action cache miss: {}'.format(key))
+
+    args = docker_run_args(config)
+    log_verbose(config, ' '.join(args))
+    res = run_subprocess(args)
+    if res == 0:
+        if manifest_path is None:
+            # The image was pulled by the run, so the key can be calculated now
+            key = action_cache_key(config, docker_image_id(config), hash_db)
+            manifest_path = get_cache_dir() / ACTION_CACHE_DIR / key[:2] / key
+        store_outputs(config, manifest_path, hash_db)
+    hash_db.save()
+    return res
+
+
+def docker_run_args(config: DogConfig, run_params: List[str] = None) -> List[str]:
+    """Build the full "docker run" command line for the given config.
+
+    run_params are inserted right after "run --rm" (e.g. ["-d", "--name", "foo"]).
+    """
     args = []
     if config[SUDO_OUTSIDE_DOCKER]:
         args += [SUDO]
     args += [docker_cmd(config)]
+    args += docker_host_args(config)
+    args += ['run', '--rm']
+    if run_params:
+        args += run_params
     args += [
-        'run',
-        '--rm',
         '--hostname={}'.format(config[HOSTNAME]),
         '-w',
         str(config[CWD]),
@@ -646,7 +2041,18 @@ def docker_run(config: DogConfig):
         for device in config[DEVICE]:
             args.append('--device={}'.format(device))
 
-    env_args = generate_env_arg_list(config)
+    resources = config[RESOURCES]
+    if RESOURCE_CPUS in resources:
+        args.append('--cpus={}'.format(resources[RESOURCE_CPUS]))
+    if RESOURCE_MEMORY in resources:
+        args.append('--memory={}'.format(resources[RESOURCE_MEMORY]))
+    if resources.get(RESOURCE_CPUSET, CPUSET_AUTO) != CPUSET_AUTO:
+        args.append('--cpuset-cpus={}'.format(resources[RESOURCE_CPUSET]))
+
+    if config[ENTRYPOINT_MODE] == ENTRYPOINT_MODE_FAST:
+        args.extend(fast_entrypoint_args(config))
+
+    env_args = generate_env_args(config)
     args.extend(env_args)
 
     if config[ADDITIONAL_DOCKER_RUN_PARAMS]:
@@ -654,27 +2060,845 @@ def docker_run(config: DogConfig):
 
     args.append(config[FULL_IMAGE])
     args.extend(config[ARGS])
+    return args
 
-    log_verbose(config, ' '.join(args))
-    if sys.platform != 'win32':
-        sys.stdout.flush()
-        sys.stderr.flush()
-        os.execvp(args[0], args)
-        return 0  # execvp does not return but this makes testing easier
-    # Using execvp on Windows results in weird behavior,
-    # so keep using a subprocess here
+
+def run_subprocess(args: List[str]) -> int:
     try:
-        proc = subprocess.run(args)
+        with PHASE_TIMINGS.phase('run_subprocess'):
+            proc = subprocess.run(args)
+            PHASE_TIMINGS.annotate('returncode', proc.returncode)
         return proc.returncode
     except KeyboardInterrupt:
         print('Dog received Ctrl+C')
         return -1
+    finally:
+        remove_env_file(args)
 
 
-def update_config(existing_config: DogConfig, new_config: DogConfig):
-    """Merge two DogConfigs.
+def docker_run(config: DogConfig):
+    args = docker_run_args(config)
 
-    All exiting keys in existing_config will be replaced with the keys in new_config
+    log_verbose(config, ' '.join(args))
+    # With an env file or jobserver tokens dog has to stay around to clean up
+    if (
+        sys.platform != 'win32'
+        and not config[ENV_FILE]
+        and not config.get(JOBSERVER_TOKENS)
+    ):
+        report_run(config)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execvp(args[0], args)
+        return 0  # execvp does not return but this makes testing easier
+    # Using execvp on Windows results in weird behavior,
+    # so keep using a subprocess here
+    return run_subprocess(args)
+
+
+def find_container_cgroup(container_id: str) -> Union[str, None]:
+    for pattern in CGROUP_PATTERNS:
+        for path in glob.glob(os.path.join(CGROUP_ROOT, pattern.format(container_id))):
+            return path
+    return None
+
+
+def read_cgroup_stats(cgroup: str) -> Dict[str, int]:
+    """CPU, memory and block I/O usage of a cgroup (v2)."""
+    stats = {}
+    try:
+        with open(os.path.join(cgroup, 'cpu.stat')) as f:
+            for line in f:
+                key, value = line.split()
+                if key in ('usage_usec', 'user_usec', 'system_usec'):
+                    stats[key] = int(value)
+        for key in ('memory.current', 'memory.peak'):
+            try:
+                with open(os.path.join(cgroup, key)) as f:
+                    stats[key] = int(f.read())
+            except (OSError, ValueError):
+                pass
+        stats['rbytes'] = stats['wbytes'] = 0
+        with open(os.path.join(cgroup, 'io.stat')) as f:
+            for line in f:
+                for field in line.split()[1:]:
+                    key, _, value = field.partition('=')
+                    if key in ('rbytes', 'wbytes'):
+                        stats[key] += int(value)
+    except (OSError, ValueError):
+        pass
+    return stats
+
+
+def format_measurements(measurements: dict) -> List[str]:
+    lines = [
+        'wall {:.2f} s, dog overhead {:.1f} ms, exit code {}'.format(
+            measurements['wall_seconds'],
+            measurements['overhead_seconds'] * 1000,
+            measurements['exit_code'],
+        )
+    ]
+    if measurements['cgroup'] is None:
+        lines.append('container cgroup (v2) not found, no resource usage available')
+        return lines
+    if 'cpu_seconds' in measurements:
+        lines.append(
+            'cpu {:.2f} s (user {:.2f} s, system {:.2f} s)'.format(
+                measurements['cpu_seconds'],
+                measurements['user_seconds'],
+                measurements['system_seconds'],
+            )
+        )
+    if 'memory_peak_bytes' in measurements:
+        lines.append(
+            'peak memory {}'.format(format_size(measurements['memory_peak_bytes']))
+        )
+    if 'io_read_bytes' in measurements:
+        lines.append(
+            'block io read {}, written {}'.format(
+                format_size(measurements['io_read_bytes']),
+                format_size(measurements['io_write_bytes']),
+            )
+        )
+    return lines
+
+
+def docker_run_measured(config: DogConfig) -> int:
+    """Run the container attached and report its resource usage (--measure).
+
+    The cgroup of the container is removed when it exits, so its files are
+    polled while it runs; the last reading is used for the totals (which may
+    miss up to MEASURE_POLL_SECONDS of CPU time and I/O) and memory.peak (or
+    the highest memory.current seen) for the peak memory.
+    """
+    cidfile = get_runtime_dir() / 'measure-{}.cid'.format(uuid.uuid4().hex)
+    args = docker_run_args(config, ['--cidfile', str(cidfile)])
+    log_verbose(config, ' '.join(args))
+    overhead = time.monotonic() - PHASE_TIMINGS.start
+    start = time.monotonic()
+    cgroup = None
+    stats = {}
+    peak_memory = 0
+    try:
+        with PHASE_TIMINGS.phase('run_subprocess'):
+            proc = subprocess.Popen(args)
+            while True:
+                try:
+                    returncode = proc.wait(timeout=MEASURE_POLL_SECONDS)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                except KeyboardInterrupt:
+                    print('Dog received Ctrl+C')
+                    returncode = proc.wait()
+                    break
+                if cgroup is None:
+                    try:
+                        container_id = cidfile.read_text().strip()
+                    except OSError:
+                        continue
+                    if container_id:
+                        cgroup = find_container_cgroup(container_id)
+                if cgroup is not None:
+                    new_stats = read_cgroup_stats(cgroup)
+                    if new_stats:
+                        stats = new_stats
+                        peak_memory = max(
+                            peak_memory,
+                            stats.get('memory.peak', 0),
+                            stats.get('memory.current', 0),
+                        )
+            PHASE_TIMINGS.annotate('returncode', returncode)
+    finally:
+        remove_env_file(args)
+        try:
+            cidfile.unlink()
+        except OSError:
+            pass
+
+    measurements = {
+        'wall_seconds': time.monotonic() - start,
+        'overhead_seconds': overhead,
+        'exit_code': returncode,
+        'cgroup': cgroup,
+    }
+    if 'usage_usec' in stats:
+        measurements['cpu_seconds'] = stats['usage_usec'] / 1000000
+        measurements['user_seconds'] = stats.get('user_usec', 0) / 1000000
+        measurements['system_seconds'] = stats.get('system_usec', 0) / 1000000
+    if peak_memory:
+        measurements['memory_peak_bytes'] = peak_memory
+    if 'rbytes' in stats:
+        measurements['io_read_bytes'] = stats['rbytes']
+        measurements['io_write_bytes'] = stats['wbytes']
+
+    if config[MEASURE] == '-':
+        for line in format_measurements(measurements):
+            print('Dog measure: {}'.format(line), file=sys.stderr)
+    else:
+        with open(config[MEASURE], 'w') as f:
+            json.dump(measurements, f, indent=2)
+    return returncode
+
+
+def pool_fingerprint(config: DogConfig) -> str:
+    """Identify the pool a container belongs to.
+
+    Containers can only be shared between dog invocations which would have
+    started them in exactly the same way, so everything given to "docker run"
+    except for the command itself is part of the fingerprint.
+    """
+    fingerprint = {
+        'image': config[FULL_IMAGE],
+        'volumes': sorted(config[VOLUMES].items()),
+        'volumes-from': sorted(config[VOLUMES_FROM].keys()),
+        'devices': config.get(DEVICE, []),
+        'network': config.get(NETWORK, ''),
+        'resources': sorted(config[RESOURCES].items()),
+        'hostname': config[HOSTNAME],
+        'init': config[INIT],
+        'additional': config[ADDITIONAL_DOCKER_RUN_PARAMS],
+        'dog-variables': [
+            (name, str(config[name])) for name in config[EXPOSED_DOG_VARIABLES]
+        ],
+        'sudo': config[SUDO_OUTSIDE_DOCKER],
+        'podman': config[USE_PODMAN],
+    }
+    encoded = json.dumps(fingerprint, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def pool_enabled(config: DogConfig) -> bool:
+    if int_from_config(config, POOL_SIZE) <= 0:
+        return False
+    if sys.platform == 'win32':
+        log_verbose(config, 'Dog container pool is not supported on Windows')
+        return False
+    if config[PORTS]:
+        log_verbose(config, 'Dog container pool can not be used with [ports]')
+        return False
+    if config[RESOURCES].get(RESOURCE_CPUSET) == CPUSET_AUTO:
+        log_verbose(config, 'Dog container pool can not be used with cpuset = auto')
+        return False
+    return True
+
+
+def docker_pool_container_names(config: DogConfig, fingerprint: str = None):
+    label = POOL_LABEL if fingerprint is None else POOL_LABEL + '=' + fingerprint
+    args = docker_base_args(config)
+    args += [
+        'container',
+        'ls',
+        '--filter',
+        'label={}'.format(label),
+        '--filter',
+        'status=running',
+        '--format={{.Names}}',
+    ]
+    proc = subprocess.run(
+        args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+    )
+    return [
+        name
+        for name in proc.stdout.splitlines()
+        if name.startswith(POOL_CONTAINER_PREFIX)
+    ]
+
+
+def pool_container_age(name: str) -> Union[int, None]:
+    """Seconds since the pool container was started, from its name."""
+    try:
+        return int(time.time()) - int(name.split('-')[-2])
+    except (IndexError, ValueError):
+        return None
+
+
+def docker_pool_claim(config: DogConfig, fingerprint: str) -> Union[str, None]:
+    """Atomically take a waiting container out of the pool.
+
+    Renaming a container is atomic in the engine, so if several dog processes
+    race for the same container only one of the renames succeeds.
+    """
+    base_args = docker_base_args(config)
+    max_age = int_from_config(config, POOL_IDLE_TTL) - POOL_CLAIM_MARGIN
+    for name in docker_pool_container_names(config, fingerprint):
+        age = pool_container_age(name)
+        if age is None or age > max_age:
+            continue
+        claimed_name = '{}{}-{}'.format(POOL_CLAIMED_PREFIX, fingerprint, os.getpid())
+        proc = subprocess.run(
+            base_args + ['rename', name, claimed_name],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if proc.returncode == 0:
+            return claimed_name
+    return None
+
+
+def docker_pool_start_args(config: DogConfig, fingerprint: str) -> List[str]:
+    """Arguments for starting a detached pool container.
+
+    The container runs the normal entrypoint (so user setup is done up front)
+    with a sleep loop as its command, which makes it remove itself after the idle
+    TTL, unless it was claimed (see POOL_CLAIM_MARKER) by then. The start time in
+    the name is used to skip containers about to expire when claiming.
+    """
+    pool_config = copy.deepcopy(config)
+    pool_config[ARGS] = [
+        'sh',
+        '-c',
+        'i=0; while [ ! -e {0} ]; do [ $i -ge {1} ] && exit 0; sleep 1; i=$((i+1));'
+        ' done; while :; do sleep 3600; done'.format(
+            POOL_CLAIM_MARKER, int_from_config(config, POOL_IDLE_TTL)
+        ),
+    ]
+    pool_config[INTERACTIVE] = False
+    pool_config[TERMINAL] = False
+    name = '{}{}-{}-{}'.format(
+        POOL_CONTAINER_PREFIX, fingerprint, int(time.time()), uuid.uuid4().hex[:8]
+    )
+    run_params = [
+        '-d',
+        '--name',
+        name,
+        '--label',
+        '{}={}'.format(POOL_LABEL, fingerprint),
+    ]
+    return docker_run_args(pool_config, run_params)
+
+
+def docker_pool_exec_args(config: DogConfig, name: str) -> List[str]:
+    args = docker_base_args(config) + ['exec']
+    if config[INTERACTIVE]:
+        args.append('-i')
+    if config[TERMINAL]:
+        args.append('-t')
+    if not config[AS_ROOT]:
+        # Numeric ids work even if the entrypoint has not finished adding the user
+        args.extend(['-u', '{}:{}'.format(config[UID], config[GID])])
+    args.extend(['-w', str(config[CWD]), '-e', 'HOME={}'.format(config[HOME])])
+    args.extend(generate_env_args(config))
+    args.append(name)
+    args.extend(config[ARGS])
+    return args
+
+
+def docker_pool_claimed_exec_args(config: DogConfig, name: str) -> List[str]:
+    """docker_pool_exec_args creating POOL_CLAIM_MARKER before the command."""
+    exec_config = copy.deepcopy(config)
+    exec_config[ARGS] = [
+        'sh',
+        '-c',
+        ': > {}; exec "$@"'.format(POOL_CLAIM_MARKER),
+        'sh',
+    ] + config[ARGS]
+    return docker_pool_exec_args(exec_config, name)
+
+
+def docker_pool_memory_usage(config: DogConfig) -> int:
+    """Total memory used by all pool containers on this host (in bytes)."""
+    names = docker_pool_container_names(config)
+    if not names:
+        return 0
+    args = docker_base_args(config)
+    args += ['stats', '--no-stream', '--format={{.MemUsage}}']
+    proc = subprocess.run(
+        args + names,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    total = 0
+    for line in proc.stdout.splitlines():
+        try:
+            total += parse_size(line.split('/')[0])
+        except ValueError:
+            pass
+    return total
+
+
+def docker_pool_refill(config: DogConfig, fingerprint: str):
+    """Start containers until the pool for fingerprint has pool-size members.
+
+    The pool is counted and filled under a lock, so concurrent dogs refilling the
+    same pool do not all start the missing containers.
+    """
+    import fcntl
+
+    lock_path = get_runtime_dir() / 'pool-{}.lock'.format(fingerprint)
+    with lock_path.open('w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        missing = int_from_config(config, POOL_SIZE) - len(
+            docker_pool_container_names(config, fingerprint)
+        )
+        if missing <= 0:
+            return
+        if config[POOL_MAX_MEMORY]:
+            try:
+                max_memory = parse_size(config[POOL_MAX_MEMORY])
+            except ValueError as e:
+                fatal_error('{}: {}'.format(POOL_MAX_MEMORY, e))
+            if docker_pool_memory_usage(config) >= max_memory:
+                return
+        for _ in range(missing):
+            args = docker_pool_start_args(config, fingerprint)
+            subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            remove_env_file(args)
+
+
+def docker_pool_refill_in_background(config: DogConfig, fingerprint: str):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork() != 0:
+        return
+    # Detach completely, so the refill neither blocks nor outputs anything
+    try:
+        os.setsid()
+        release_admission_slots(config.get(ADMISSION_SLOT_FDS, []))
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        docker_pool_refill(config, fingerprint)
+    finally:
+        os._exit(0)
+
+
+def docker_run_pooled(config: DogConfig) -> int:
+    fingerprint = pool_fingerprint(config)
+    name = docker_pool_claim(config, fingerprint)
+    docker_pool_refill_in_background(config, fingerprint)
+    PHASE_TIMINGS.annotate('pool_hit', name is not None)
+    if name is None:
+        log_verbose(config, 'Dog container pool is empty - using a new container')
+        return docker_run(config)
+
+    args = docker_pool_claimed_exec_args(config, name)
+    log_verbose(config, ' '.join(args))
+    res = run_subprocess(args)
+    subprocess.Popen(
+        docker_base_args(config) + ['rm', '-f', name],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    return res
+
+
+def watch_patterns(config: DogConfig) -> List[str]:
+    """The --watch globs, relative to the current directory."""
+    patterns = []
+    for option in config[WATCH]:
+        for pattern in list_from_config_entry(option):
+            while pattern.startswith('./'):
+                pattern = pattern[2:]
+            patterns.append(pattern)
+    return patterns
+
+
+def matches_watch_patterns(path: str, patterns: List[str]) -> bool:
+    """Does the relative path match one of the --watch globs?
+
+    Unlike glob, * also matches / here, and a leading **/ matches nothing too.
+    """
+    path = path.replace(os.sep, '/')
+    for pattern in patterns:
+        while pattern.startswith('**/'):
+            pattern = pattern[3:]
+        if fnmatch.fnmatch(path, pattern):
+            return True
+    return False
+
+
+def watched_dirs(root: str):
+    """root and all directories below it, except the hidden ones (like .git)."""
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        yield dirpath
+
+
+class Inotify:
+    """Watch the directory tree below the current directory with inotify(7).
+
+    inotify only watches single directories, so every directory gets a watch,
+    and the directories created later get one as soon as they show up.
+    """
+
+    MASK = (
+        IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    )
+
+    def __init__(self, patterns: List[str]):
+        import ctypes
+
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.patterns = patterns
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.dirs = {}  # type: Dict[int, str]
+        try:
+            for path in watched_dirs(os.curdir):
+                self.add_watch(path)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path: str):
+        import ctypes
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # Directories removed in the meantime are fine, anything else (like
+            # running out of watches) is not
+            if error not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                raise OSError(error, '{}: {}'.format(path, os.strerror(error)))
+        else:
+            self.dirs[wd] = path
+
+    def changes(self, timeout: Union[float, None]) -> List[str]:
+        """The changed paths matching the patterns, waiting at most timeout."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        changed = []
+        while ready:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b'\0'))
+                offset += length
+                changed.extend(self.handle_event(wd, mask, name))
+        return [
+            path
+            for path in changed
+            if matches_watch_patterns(os.path.normpath(path), self.patterns)
+        ]
+
+    def handle_event(self, wd: int, mask: int, name: str) -> List[str]:
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost, so anything may have changed
+            return [os.path.join(path, name) for path in self.dirs.values()]
+        if mask & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return []
+        if wd not in self.dirs:
+            return []
+        path = os.path.join(self.dirs[wd], name)
+        if not mask & IN_ISDIR:
+            return [path]
+        if name.startswith('.') or not mask & (IN_CREATE | IN_MOVED_TO):
+            return []
+        # Files can be created in a new directory before it is watched
+        changed = []
+        for dirpath in watched_dirs(path):
+            self.add_watch(dirpath)
+            with contextlib.suppress(OSError):
+                changed.extend(os.path.join(dirpath, f) for f in os.listdir(dirpath))
+        return changed
+
+
+class PollingWatcher:
+    """Watch for changes by comparing the mtimes of the matching files."""
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self.mtimes = self.scan()
+
+    def close(self):
+        pass
+
+    def scan(self) -> Dict[str, int]:
+        mtimes = {}
+        for dirpath in watched_dirs(os.curdir):
+            with contextlib.suppress(OSError):
+                for entry in os.scandir(dirpath):
+                    path = os.path.normpath(entry.path)
+                    if matches_watch_patterns(path, self.patterns):
+                        with contextlib.suppress(OSError):
+                            mtimes[path] = entry.stat().st_mtime_ns
+        return mtimes
+
+    def changes(self, timeout: Union[float, None]) -> List[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = WATCH_POLL_SECONDS
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.monotonic())
+            time.sleep(max(0, remaining))
+            mtimes = self.scan()
+            changed = [
+                path
+                for path in set(mtimes) | set(self.mtimes)
+                if mtimes.get(path) != self.mtimes.get(path)
+            ]
+            self.mtimes = mtimes
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return sorted(changed)
+
+
+def make_watcher(config: DogConfig) -> Union[Inotify, PollingWatcher]:
+    patterns = watch_patterns(config)
+    if sys.platform.startswith('linux'):
+        try:
+            return Inotify(patterns)
+        except OSError as e:
+            log_verbose(config, 'Dog cannot use inotify ({}) - polling'.format(e))
+    return PollingWatcher(patterns)
+
+
+def docker_watch_start_args(config: DogConfig, name: str) -> List[str]:
+    """Arguments for starting the container the --watch runs are executed in."""
+    watch_config = copy.deepcopy(config)
+    watch_config[ARGS] = ['sleep', str(WATCH_CONTAINER_TTL)]
+    watch_config[INTERACTIVE] = False
+    watch_config[TERMINAL] = False
+    return docker_run_args(watch_config, ['-d', '--name', name])
+
+
+def docker_watch_pid_file(name: str) -> str:
+    return '/tmp/{}.pid'.format(name)
+
+
+def docker_watch_exec_args(config: DogConfig, name: str) -> List[str]:
+    """Arguments for one run of the command in the --watch container.
+
+    The command records its pid, since killing "docker exec" does not stop the
+    process in the container.
+    """
+    exec_config = copy.deepcopy(config)
+    exec_config[INTERACTIVE] = False
+    exec_config[ARGS] = [
+        'sh',
+        '-c',
+        'echo $$ > {}; exec "$@"'.format(docker_watch_pid_file(name)),
+        'sh',
+    ] + config[ARGS]
+    return docker_pool_exec_args(exec_config, name)
+
+
+def docker_watch_cancel(config: DogConfig, name: str, proc: subprocess.Popen):
+    """Stop a run of the command: SIGTERM, and SIGKILL if it does not exit."""
+    for signal_name in ('TERM', 'KILL'):
+        kill_config = copy.deepcopy(config)
+        kill_config[INTERACTIVE] = False
+        kill_config[TERMINAL] = False
+        kill_config[ARGS] = [
+            'sh',
+            '-c',
+            # The whole process group if the command leads one, else just it
+            'pid=$(cat {0}) && (kill -{1} -$pid || kill -{1} $pid) 2>/dev/null'.format(
+                docker_watch_pid_file(name), signal_name
+            ),
+        ]
+        kill_config[USER_ENV_VARS] = {}
+        subprocess.run(
+            docker_pool_exec_args(kill_config, name),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            proc.wait(timeout=WATCH_CANCEL_SECONDS)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+    proc.kill()
+    proc.wait()
+
+
+def docker_watch(config: DogConfig) -> int:
+    """Run the command every time the watched files change (--watch)."""
+    watcher = make_watcher(config)
+    name = '{}{}'.format(WATCH_CONTAINER_PREFIX, uuid.uuid4().hex[:12])
+    start_args = docker_watch_start_args(config, name)
+    log_verbose(config, ' '.join(start_args))
+    try:
+        proc = subprocess.run(start_args, stdout=subprocess.DEVNULL)
+    finally:
+        remove_env_file(start_args)
+    if proc.returncode != 0:
+        watcher.close()
+        return proc.returncode
+
+    returncode = 0
+    run = None
+    run_args = []
+    try:
+        changed = None
+        while True:
+            if changed is not None:
+                if len(changed) > 1:
+                    changed = ['{} files'.format(len(changed))]
+                print(
+                    'Dog running {} again ({} changed)'.format(
+                        ' '.join(config[ARGS]), changed[0]
+                    ),
+                    file=sys.stderr,
+                )
+            run_args = docker_watch_exec_args(config, name)
+            log_verbose(config, ' '.join(run_args))
+            run = subprocess.Popen(run_args)
+            while True:
+                changed = watcher.changes(None if run is None else WATCH_POLL_SECONDS)
+                if run is not None and run.poll() is not None:
+                    returncode = run.returncode
+                    remove_env_file(run_args)
+                    run = None
+                    print(
+                        'Dog: exit code {} - waiting for changes'.format(returncode),
+                        file=sys.stderr,
+                    )
+                if changed:
+                    break
+            more = changed
+            while more:
+                more = watcher.changes(WATCH_DEBOUNCE_SECONDS)
+                changed += more
+            changed = sorted(set(changed))
+            if run is not None:
+                log_verbose(config, 'Dog cancelling the run in progress')
+                docker_watch_cancel(config, name, run)
+                remove_env_file(run_args)
+                run = None
+    except KeyboardInterrupt:
+        print('Dog received Ctrl+C')
+    finally:
+        if run is not None:
+            docker_watch_cancel(config, name, run)
+            remove_env_file(run_args)
+        watcher.close()
+        subprocess.run(
+            docker_base_args(config) + ['rm', '-f', name],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    return returncode
+
+
+def bench_strategies(config: DogConfig) -> List[Tuple[str, DogConfig, str]]:
+    """The ways of starting the container to compare: (name, overrides, mode)."""
+    strategies = [
+        ('docker run --init', {INIT: True}, 'run'),
+        ('docker run', {INIT: False}, 'run'),
+        ('entrypoint-mode=fast', {ENTRYPOINT_MODE: ENTRYPOINT_MODE_FAST}, 'run'),
+    ]
+    if config[VOLUMES_FROM]:
+        strategies.append(('volumes-from pre-flight', {}, 'volumes-from'))
+    pool_overrides = {POOL_SIZE: max(1, int_from_config(config, POOL_SIZE))}
+    if pool_enabled(dict(config, **pool_overrides)):
+        strategies.append(('container pool', pool_overrides, 'pool'))
+    return strategies
+
+
+def bench_once(argv: List[str], overrides: DogConfig, mode: str) -> Tuple[float, float]:
+    """Run the bench command once, returning the dog and the engine time.
+
+    Like a dog run, every iteration connects to the engine and gets it and the host
+    ready with prepared_run. The phases of the iterations are left out of the
+    timings of the dog run.
+    """
+    with PHASE_TIMINGS.suspended():
+        start = time.monotonic()
+        config = read_config(argv)
+        config.update(overrides)
+        config[INTERACTIVE] = False
+        config[TERMINAL] = False
+        # Only the pre-flight strategy pays for the [volumes-from] containers
+        config[AUTO_RUN_VOLUMES_FROM] = mode == 'volumes-from'
+        if ENTRYPOINT_MODE in overrides:
+            handle_entrypoint_mode(config)
+        config[ENGINE_HOST_ARGS] = connect_docker_host(config)
+        with prepared_run(config):
+            name = None
+            if mode == 'pool':
+                fingerprint = pool_fingerprint(config)
+                name = docker_pool_claim(config, fingerprint)
+            if name:
+                args = docker_pool_claimed_exec_args(config, name)
+            else:
+                args = docker_run_args(config)
+            engine_start = time.monotonic()
+            proc = subprocess.run(
+                args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL
+            )
+            end = time.monotonic()
+            remove_env_file(args)
+        if proc.returncode != 0:
+            fatal_error(
+                '"{}" failed with exit code {} while benchmarking'.format(
+                    ' '.join(args), proc.returncode
+                )
+            )
+        if mode == 'pool':
+            # Done in the background by normal runs, so not part of the latency
+            if name:
+                subprocess.run(
+                    docker_base_args(config) + ['rm', '-f', name],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            docker_pool_refill(config, fingerprint)
+        return engine_start - start, end - engine_start
+
+
+def bench(argv: List[str], config: DogConfig) -> int:
+    """Compare the latency of the ways dog can start a container (--bench).
+
+    Every iteration reads the config and runs the command in-process, so the
+    dog overhead does not include starting the Python interpreter.
+    """
+    iterations = config[BENCH]
+    bench_argv = [
+        arg
+        for index, arg in enumerate(argv)
+        if arg != '--'
+        and not arg.startswith('--bench')
+        and not (index > 0 and argv[index - 1] == '--bench' and arg.isdigit())
+    ]
+    bench_argv += ['--'] + BENCH_COMMAND
+    print(
+        'Dog benchmarking "{}" in {} ({} iterations, times in ms)'.format(
+            ' '.join(BENCH_COMMAND), config[FULL_IMAGE], iterations
+        )
+    )
+    print(
+        '{:<26} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+            'STRATEGY', 'P50', 'P95', 'MAX', 'DOG P50', 'ENGINE P50'
+        )
+    )
+    for name, overrides, mode in bench_strategies(config):
+        bench_once(bench_argv, overrides, mode)  # Warm up (pull, pool, caches)
+        dog_times, engine_times = [], []
+        for _ in range(iterations):
+            dog_time, engine_time = bench_once(bench_argv, overrides, mode)
+            dog_times.append(dog_time * 1000)
+            engine_times.append(engine_time * 1000)
+        totals = [d + e for d, e in zip(dog_times, engine_times)]
+        print(
+            '{:<26} {:>8.1f} {:>8.1f} {:>8.1f} {:>10.1f} {:>10.1f}'.format(
+                name,
+                percentile(totals, 50),
+                percentile(totals, 95),
+                max(totals),
+                percentile(dog_times, 50),
+                percentile(engine_times, 50),
+            )
+        )
+    return 0
+
+
+def update_config(existing_config: DogConfig, new_config: DogConfig):
+    """Merge two DogConfigs.
+
+    All exiting keys in existing_config will be replaced with the keys in new_config
     - except for dictionaries, they will be merged with the existing dictionary.
     """
     for k, v in new_config.items():
@@ -719,17 +2943,110 @@ def perform_variable_subst(config):
         subst_in_dict(config[VOLUMES], config)
         subst_in_dict(config[VOLUMES_FROM], config)
         subst_in_dict(config[USB_DEVICES], config)
+        subst_in_dict(config[CACHES], config)
+        subst_in_dict(config[RESOURCES], config)
+
+
+def find_vcs_root(p: Path) -> Union[Path, None]:
+    for directory in [p] + list(p.parents):
+        for marker in VCS_MARKERS:
+            if os.path.lexists(os.path.join(str(directory), marker)):
+                return directory
+    return None
+
+
+def find_workspace(config: DogConfig) -> Path:
+    """The outermost of the VCS root and dog-config-path containing cwd."""
+    cwd = config[WIN32_CWD] if sys.platform == 'win32' else config[CWD]
+    workspace = Path(config[DOG_CONFIG_PATH])
+    if workspace != cwd and workspace not in cwd.parents:
+        # dog-config-path-resolve-symlink moved it away from cwd
+        workspace = cwd
+    vcs_root = find_vcs_root(cwd)
+    if vcs_root is not None and vcs_root in workspace.parents:
+        workspace = vcs_root
+    return workspace
+
+
+def add_auto_mount(config: DogConfig, path: Path):
+    if sys.platform == 'win32':
+        config[VOLUMES][win32_to_dog_unix(path)] = str(path)
+    else:
+        config[VOLUMES][str(path)] = str(path)
+        config[AUTO_MOUNT_POINT] = str(path)
 
 
 def handle_auto_mount(config):
     if not config[AUTO_MOUNT]:
         return
-    if sys.platform == 'win32':
+    if config[AUTO_MOUNT] == AUTO_MOUNT_WORKSPACE:
+        add_auto_mount(config, find_workspace(config))
+    elif config[AUTO_MOUNT] == AUTO_MOUNT_MINIMAL:
+        pass  # Handled by handle_minimal_auto_mount once [volumes] are resolved
+    elif sys.platform == 'win32':
         drive = config[WIN32_CWD].drive
         config[VOLUMES]['/' + drive[0]] = drive + '\\'
     else:
         mount_point = str(find_mount_point(config[CWD]))
         config[VOLUMES][mount_point] = mount_point
+        config[AUTO_MOUNT_POINT] = mount_point
+
+
+def handle_minimal_auto_mount(config: DogConfig):
+    """Mount the smallest set of directories covering cwd and the [volumes].
+
+    [volumes] mounted at the same path inside and outside are merged with the
+    current working directory, so only the outermost of them are mounted.
+    """
+    if config[AUTO_MOUNT] != AUTO_MOUNT_MINIMAL:
+        return
+    cwd = config[WIN32_CWD] if sys.platform == 'win32' else config[CWD]
+    if sys.platform == 'win32':
+        add_auto_mount(config, cwd)
+        return
+    identity_mounts = [
+        inside for inside, outside in config[VOLUMES].items() if inside == outside
+    ]
+    covering = set()
+    for path in sorted(identity_mounts + [str(cwd)], key=len):
+        if not any(path == c or path.startswith(c + '/') for c in covering):
+            covering.add(path)
+    for inside in identity_mounts:
+        if inside not in covering:
+            log_verbose(
+                config,
+                'Dog skipping volume {} - it is inside another mount'.format(inside),
+            )
+            del config[VOLUMES][inside]
+    if str(cwd) in covering:
+        add_auto_mount(config, cwd)
+
+
+def is_covered_by_auto_mount(config: DogConfig, inside: str, outside: str) -> bool:
+    """Is the volume already visible in the container through the auto-mount?
+
+    Bind mounts are recursive (including mounts nested inside them), so this is
+    the case if it is mounted at the same path inside and outside, below the
+    auto-mounted directory.
+    """
+    auto_mount_point = config[AUTO_MOUNT_POINT]
+    if inside != outside or outside == auto_mount_point:
+        return False
+    return auto_mount_point == '/' or outside.startswith(auto_mount_point + '/')
+
+
+def handle_volumes_covered_by_auto_mount(config: DogConfig):
+    if AUTO_MOUNT_POINT not in config:
+        return
+    for inside, outside in list(config[VOLUMES].items()):
+        if is_covered_by_auto_mount(config, inside, outside):
+            log_verbose(
+                config,
+                'Dog skipping volume {}:{} - it is already auto-mounted'.format(
+                    outside, inside
+                ),
+            )
+            del config[VOLUMES][inside]
 
 
 def handle_full_image(config):
@@ -743,46 +3060,334 @@ def handle_full_image(config):
 
 
 def handle_usb_devices(config):
-    if USB_DEVICES in config:
-        usb_device_paths = []
-        system_usb_devices = UsbDevices()
-        for vendor_product in config[USB_DEVICES].values():
-            dev_path = system_usb_devices.get_bus_paths(vendor_product)
-            if dev_path:
-                usb_device_paths.extend(dev_path)
-        if usb_device_paths:
-            if DEVICE in config:
-                config[DEVICE].extend(usb_device_paths)
-            else:
-                config[DEVICE] = usb_device_paths
+    if not config.get(USB_DEVICES):
+        return
+    usb_device_paths = []
+    system_usb_devices = UsbDevices(
+        list(config[USB_DEVICES].values()),
+        cache_file=get_runtime_dir() / USB_DEVICES_CACHE_FILE,
+    )
+    for vendor_product in config[USB_DEVICES].values():
+        dev_path = system_usb_devices.get_bus_paths(vendor_product)
+        if dev_path:
+            usb_device_paths.extend(dev_path)
+    if usb_device_paths:
+        if DEVICE in config:
+            config[DEVICE].extend(usb_device_paths)
+        else:
+            config[DEVICE] = usb_device_paths
+
+
+def list_dir(directory: str, listings: dict) -> Tuple[List[str], List[str]]:
+    """Names of the entries in directory, and the names of the symlinks among them.
+
+    The listings are reused as long as the mtime of the directory is unchanged.
+    """
+    try:
+        st = os.stat(directory)
+    except OSError:
+        return [], []
+    listing = listings.get(directory)
+    if listing and listing[0] == st.st_mtime_ns:
+        return listing[1], listing[2]
+    names, links = [], []
+    try:
+        for entry in os.scandir(directory):
+            names.append(entry.name)
+            if entry.is_symlink():
+                links.append(entry.name)
+    except OSError:
+        return [], []
+    if st.st_mtime < time.time() - HASH_DB_RACY_SECONDS:
+        listings[directory] = [st.st_mtime_ns, names, links]
+    return names, links
+
+
+def existing_paths(paths: List[str]) -> set:
+    """The paths that exist, using one (cached) scandir per parent directory.
+
+    Directories on different mounts are listed concurrently, since the optional
+    volumes are often on slow network file systems.
+    """
+    found = set()
+    by_dir = {}  # type: Dict[str, List[Tuple[str, str]]]
+    for path in paths:
+        directory, name = os.path.split(os.path.normpath(path))
+        if not name or name == '..' or '..' in Path(directory).parts:
+            if os.path.exists(path):
+                found.add(path)
+        else:
+            # Relative paths are listed (and cached) by their absolute directory
+            by_dir.setdefault(os.path.abspath(directory), []).append((name, path))
+    if not by_dir:
+        return found
+
+    listings_file = None  # type: Union[Path, None]
+    try:
+        listings_file = get_cache_dir() / DIR_LISTING_CACHE_FILE
+        with listings_file.open() as f:
+            listings = json.load(f)
+    except (OSError, ValueError):
+        listings = {}
+    old_listings = dict(listings)
+    case_insensitive = sys.platform in ('win32', 'darwin')
+
+    def check(directories: List[str]) -> List[str]:
+        existing = []
+        for directory in directories:
+            names, links = list_dir(directory, listings)
+            for name, path in by_dir[directory]:
+                if name in names and name not in links:
+                    existing.append(path)
+                elif (name in links or case_insensitive) and os.path.exists(path):
+                    existing.append(path)
+        return existing
+
+    mount_table = get_mount_table()
+    by_mount = {}  # type: Dict[str, List[str]]
+    for directory in by_dir:
+        mount_point = mount_table.find(directory) if mount_table else ''
+        by_mount.setdefault(mount_point, []).append(directory)
+    if len(by_mount) > 1:
+        workers = min(len(by_mount), DIR_LISTING_MAX_WORKERS)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for existing in pool.map(check, by_mount.values()):
+                found.update(existing)
+    else:
+        for directories in by_mount.values():
+            found.update(check(directories))
+
+    if listings_file and listings != old_listings:
+        tmp_file = listings_file.with_name(
+            '{}.{}.tmp'.format(listings_file.name, os.getpid())
+        )
+        try:
+            with tmp_file.open('w') as f:
+                json.dump(listings, f)
+            os.replace(str(tmp_file), str(listings_file))
+        except OSError:
+            pass
+    return found
 
 
 def handle_volumes(config):
     home_path = str(Path.home())
-    volumes = {}
+    entries = []
     for inside, outside in config[VOLUMES].items():
-        only_if_outside_exists = False
-        if inside[0] == '?':
-            only_if_outside_exists = True
-            new_inside = inside[1:]
-        else:
-            new_inside = inside
+        only_if_outside_exists = inside[0] == '?'
+        if only_if_outside_exists:
+            inside = inside[1:]
         if outside.startswith('~'):
-            new_outside = home_path + outside[1:]
-        else:
-            new_outside = outside
-        if not only_if_outside_exists or os.path.exists(new_outside):
-            volumes[new_inside] = new_outside
-    config[VOLUMES] = volumes
+            outside = home_path + outside[1:]
+        entries.append((inside, outside, only_if_outside_exists))
+    optional = [outside for _, outside, only_if in entries if only_if]
+    existing = existing_paths(optional) if optional else set()
+    config[VOLUMES] = {
+        inside: outside
+        for inside, outside, only_if_outside_exists in entries
+        if not only_if_outside_exists or outside in existing
+    }
+
+
+def split_volume_options(inside: str) -> Tuple[str, str]:
+    """Split '/inside:ro' into ('/inside', ':ro')."""
+    path, sep, options = inside.partition(':')
+    return path, sep + options
+
+
+def handle_normalize_volumes(config: DogConfig):
+    """Canonicalize [volumes] and drop the ones already covered by another.
+
+    Host paths are normalized ('..', trailing slashes) as the docker daemon would
+    do, without touching the file system (which can be slow on autofs or NFS)
+    unless volumes-resolve-symlinks asks for the symlinks to be resolved too. A
+    volume is dropped if a volume mounted at a parent inside path with the same
+    options already makes it visible at the same place. Two different host paths
+    mounted at the same inside path is an error.
+    """
+    if sys.platform == 'win32':
+        return
+    volumes = {}  # type: Dict[str, Tuple[str, str]]
+    for inside, outside in config[VOLUMES].items():
+        inside_path, options = split_volume_options(inside)
+        inside_path = os.path.normpath(inside_path).replace('//', '/')
+        if os.path.isabs(outside):
+            if config[VOLUMES_RESOLVE_SYMLINKS]:
+                outside = os.path.realpath(outside)
+            else:
+                outside = os.path.normpath(outside)
+        if inside_path in volumes:
+            other_outside, other_options = volumes[inside_path]
+            if (other_outside, other_options) != (outside, options):
+                fatal_error(
+                    'Conflicting volumes for {}: {}{} and {}{}'.format(
+                        inside_path, other_outside, other_options, outside, options
+                    )
+                )
+            log_verbose(
+                config, 'Dog skipping volume {}:{} - duplicate'.format(outside, inside)
+            )
+            continue
+        volumes[inside_path] = (outside, options)
+
+    # Visit parents before children, so only kept volumes are used as parents
+    for inside_path in sorted(volumes, key=lambda p: p.count('/')):
+        outside, options = volumes[inside_path]
+        if not os.path.isabs(outside):
+            continue  # Named volume
+        child, parent = inside_path, os.path.dirname(inside_path)
+        while parent != child:
+            if parent in volumes:
+                parent_outside, parent_options = volumes[parent]
+                rel = os.path.relpath(inside_path, parent)
+                if (
+                    parent_options == options
+                    and os.path.isabs(parent_outside)
+                    and os.path.join(parent_outside, rel) == outside
+                ):
+                    log_verbose(
+                        config,
+                        'Dog skipping volume {}:{} - it is inside volume {}:{}'.format(
+                            outside, inside_path, parent_outside, parent
+                        ),
+                    )
+                    del volumes[inside_path]
+                break
+            child, parent = parent, os.path.dirname(parent)
+    config[VOLUMES] = {
+        inside_path + options: outside
+        for inside_path, (outside, options) in volumes.items()
+    }
+
+
+def cache_volume_name(config: DogConfig, name: str) -> str:
+    """Name of the docker volume used for the [caches] entry name.
+
+    Caches are not shared between images or users, since the contents of e.g. a
+    compiler cache depend on both.
+    """
+    key = '{}\n{}'.format(config[FULL_IMAGE], config[UID]).encode()
+    return 'dog-cache-{}-{}'.format(name, hashlib.sha256(key).hexdigest()[:12])
+
+
+def handle_caches(config: DogConfig):
+    for name, inside in config[CACHES].items():
+        config[VOLUMES][inside] = cache_volume_name(config, name)
+
+
+def handle_resources(config: DogConfig):
+    resources = config[RESOURCES]
+    for key in resources:
+        if key not in RESOURCE_KEYS:
+            fatal_error('Unknown key "{}" in [{}]'.format(key, RESOURCES))
+    if RESOURCE_CPUS in resources:
+        try:
+            valid = float(resources[RESOURCE_CPUS]) > 0
+        except ValueError:
+            valid = False
+        if not valid:
+            fatal_error(
+                '[{}] {} must be a positive number (got "{}")'.format(
+                    RESOURCES, RESOURCE_CPUS, resources[RESOURCE_CPUS]
+                )
+            )
+    if RESOURCE_MEMORY in resources:
+        try:
+            parse_size(resources[RESOURCE_MEMORY])
+        except ValueError as e:
+            fatal_error('[{}] {}: {}'.format(RESOURCES, RESOURCE_MEMORY, e))
+    cpuset = resources.get(RESOURCE_CPUSET)
+    if cpuset == CPUSET_AUTO:
+        if RESOURCE_CPUS not in resources:
+            fatal_error(
+                '[{}] {} = {} needs {} (the number of CPUs)'.format(
+                    RESOURCES, RESOURCE_CPUSET, CPUSET_AUTO, RESOURCE_CPUS
+                )
+            )
+    elif cpuset is not None:
+        try:
+            parse_cpu_list(cpuset)
+        except ValueError:
+            fatal_error(
+                '[{}] {} must be "{}" or a list of CPUs like 0-3,8 (got "{}")'.format(
+                    RESOURCES, RESOURCE_CPUSET, CPUSET_AUTO, cpuset
+                )
+            )
+
+
+def generate_passwd_and_group(config: DogConfig) -> Tuple[str, str]:
+    """Generate /etc/passwd and /etc/group contents for the dog user."""
+    passwd = ['root:x:0:0:root:/root:/bin/sh']
+    group = ['root:x:0:']
+    if int(config[UID]) != 0:
+        passwd.append(
+            '{}:x:{}:{}:Self:{}:/bin/sh'.format(
+                config[USER], config[UID], config[GID], config[HOME]
+            )
+        )
+    if int(config[GID]) != 0:
+        group.append('{}:x:{}:{}'.format(config[GROUP], config[GID], config[USER]))
+    passwd.append('nobody:x:65534:65534:nobody:/nonexistent:/bin/false')
+    group.append('nogroup:x:65534:')
+    return '\n'.join(passwd) + '\n', '\n'.join(group) + '\n'
+
+
+def handle_entrypoint_mode(config: DogConfig):
+    mode = config[ENTRYPOINT_MODE]
+    if mode not in (ENTRYPOINT_MODE_LEGACY, ENTRYPOINT_MODE_FAST):
+        fatal_error(
+            '{} must be either "{}" or "{}" (got "{}")'.format(
+                ENTRYPOINT_MODE, ENTRYPOINT_MODE_LEGACY, ENTRYPOINT_MODE_FAST, mode
+            )
+        )
+    if mode == ENTRYPOINT_MODE_FAST:
+        passwd, group = generate_passwd_and_group(config)
+        config[VOLUMES]['/etc/passwd:ro'] = str(write_runtime_file('passwd', passwd))
+        config[VOLUMES]['/etc/group:ro'] = str(write_runtime_file('group', group))
+
+
+def fast_entrypoint_args(config: DogConfig) -> List[str]:
+    """Run directly as the dog user, instead of letting the entrypoint add it."""
+    args = ['-e', 'DOG_ENTRYPOINT_MODE={}'.format(ENTRYPOINT_MODE_FAST)]
+    if config[AS_ROOT]:
+        return args
+    args.extend(['--user', '{}:{}'.format(config[UID], config[GID])])
+    args.extend(['-e', 'HOME={}'.format(config[HOME])])
+    home = str(config[HOME])
+    home_is_mounted = any(
+        home == inside.split(':')[0] or home.startswith(inside.split(':')[0] + '/')
+        for inside in config[VOLUMES].keys()
+    )
+    if not home_is_mounted:
+        # Nobody creates the home directory, so give the user a fresh one
+        args.extend(
+            [
+                '--tmpfs',
+                '{}:exec,mode=0755,uid={},gid={}'.format(
+                    home, config[UID], config[GID]
+                ),
+            ]
+        )
+    return args
 
 
 def update_dependencies_in_config(config: DogConfig):
     """Update values in config depending on other values in config."""
-    perform_variable_subst(config)
-    handle_auto_mount(config)
-    handle_full_image(config)
-    handle_usb_devices(config)
-    handle_volumes(config)
+    for handler in [
+        perform_variable_subst,
+        handle_auto_mount,
+        handle_full_image,
+        handle_usb_devices,
+        handle_volumes,
+        handle_normalize_volumes,
+        handle_minimal_auto_mount,
+        handle_volumes_covered_by_auto_mount,
+        handle_caches,
+        handle_resources,
+        handle_entrypoint_mode,
+    ]:
+        with PHASE_TIMINGS.phase(handler.__name__):
+            handler(config)
 
 
 def get_minimum_version_from_config(version_var: str, config: DogConfig) -> str:
@@ -820,19 +3425,27 @@ def perform_sanity_check(config: DogConfig) -> int:
 
 
 def read_config(argv) -> DogConfig:
-    command_line_config = parse_command_line_args(
-        own_name=os.path.basename(argv[0]), argv=list(argv[1:])
-    )
-
-    env_config = get_env_config()
-
-    user_config = deque()
-    user_config_file = Path.home() / ('.' + CONFIG_FILE)
-    if user_config_file.is_file():
-        user_config = read_dog_config(user_config_file)
+    with PHASE_TIMINGS.phase('parse_command_line_args'):
+        command_line_config = parse_command_line_args(
+            own_name=os.path.basename(argv[0]), argv=list(argv[1:])
+        )
 
-    dog_config_file = find_dog_config()
-    dog_config = read_dog_config(dog_config_file)
+    with PHASE_TIMINGS.phase('get_env_config'):
+        env_config = get_env_config()
+        env_config.update(get_env_timings())
+
+    with PHASE_TIMINGS.phase('read_dog_config'):
+        user_config = deque()
+        user_config_file = Path.home() / ('.' + CONFIG_FILE)
+        if user_config_file.is_file():
+            user_config = read_dog_config(user_config_file)
+
+        dog_config_file = find_dog_config()
+        dog_config = read_dog_config(dog_config_file)
+        PHASE_TIMINGS.annotate(
+            'config_files',
+            [str(path) for _, path in list(user_config) + list(dog_config)],
+        )
 
     config = {}
     update_config(config, DEFAULT_CONFIG)
@@ -854,20 +3467,1021 @@ def read_config(argv) -> DogConfig:
 
 
 def main(argv) -> int:
-    config = read_config(argv)
+    PHASE_TIMINGS.restart()
+    PHASE_TIMINGS.annotate('argv', list(argv))
+    with PHASE_TIMINGS.phase('read_config'):
+        config = read_config(argv)
+    PHASE_TIMINGS.annotate('image', config[FULL_IMAGE])
+    try:
+        if config[BENCH]:
+            return bench(argv, config)
+        return run_dog(config)
+    finally:
+        report_run(config)
+
+
+def parse_cpu_list(cpu_list: str) -> List[int]:
+    """Parse a list of CPUs like "0-3,8,10-11" (as used in /sys and by docker)."""
+    cpus = []
+    for part in cpu_list.strip().split(','):
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    ranges = []  # type: List[List[int]]
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(
+        str(first) if first == last else '{}-{}'.format(first, last)
+        for first, last in ranges
+    )
+
+
+def read_cpu_topology(sysfs_root: str = SYSFS_ROOT) -> List[Tuple[int, List[int]]]:
+    """The package (socket) and the logical CPUs of each online physical core."""
+    cpu_dir = os.path.join(sysfs_root, 'devices', 'system', 'cpu')
+
+    def read_int(path: str) -> int:
+        with open(path) as f:
+            return int(f.read())
+
+    try:
+        with open(os.path.join(cpu_dir, 'online')) as f:
+            online = parse_cpu_list(f.read())
+    except (OSError, ValueError):
+        online = list(range(os.cpu_count() or 1))
+    cores = {}  # type: Dict[Tuple[int, int], List[int]]
+    for cpu in online:
+        topology = os.path.join(cpu_dir, 'cpu{}'.format(cpu), 'topology')
+        try:
+            package = read_int(os.path.join(topology, 'physical_package_id'))
+            core = read_int(os.path.join(topology, 'core_id'))
+        except (OSError, ValueError):
+            package, core = 0, -1 - cpu  # Unknown topology: one core per CPU
+        cores.setdefault((package, core), []).append(cpu)
+    return sorted((package, cpus) for (package, _), cpus in cores.items())
+
+
+def choose_cpus(
+    cores: List[Tuple[int, List[int]]], usage: Dict[int, int], count: int
+) -> List[int]:
+    """Choose whole physical cores with at least count CPUs for a container.
+
+    The cores least used by other containers (usage is the number of containers
+    using each CPU) are chosen, preferably all in one package, so the container
+    shares neither core nor (last level) cache with others if possible. Of the
+    packages where that is equally possible, the one with the fewest free CPUs
+    left is chosen, to keep room for larger containers.
+    """
+
+    def core_usage(core: Tuple[int, List[int]]) -> int:
+        return max(usage.get(cpu, 0) for cpu in core[1])
+
+    def pick(candidates: List[Tuple[int, List[int]]]) -> List[int]:
+        chosen = []
+        for core in sorted(candidates, key=lambda c: (core_usage(c), c[1])):
+            if len(chosen) >= count:
+                break
+            chosen.extend(core[1])
+        return chosen
+
+    best = None
+    for package in sorted(set(package for package, _ in cores)):
+        in_package = [core for core in cores if core[0] == package]
+        if sum(len(cpus) for _, cpus in in_package) < count:
+            continue
+        chosen = pick(in_package)
+        shared = sum(usage.get(cpu, 0) for cpu in chosen)
+        free_left = sum(
+            1 for _, cpus in in_package for cpu in cpus if not usage.get(cpu)
+        ) - len(chosen)
+        if best is None or (shared, free_left) < best[0]:
+            best = ((shared, free_left), chosen)
+    if best is None:
+        return sorted(pick(cores))  # Larger than any package
+    return sorted(best[1])
+
+
+def process_start_time(pid: int) -> Union[str, None]:
+    """Start time of the process, to tell it from a later one with the same pid."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().rpartition(')')[2].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def is_process_alive(pid: int, start_time: Union[str, None]) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return start_time is None or process_start_time(pid) in (None, start_time)
+
+
+def this_process() -> Dict[str, Union[int, str, None]]:
+    return {'pid': os.getpid(), 'start': process_start_time(os.getpid())}
+
+
+@contextlib.contextmanager
+def locked_allocations(directory: str, name: str):
+    """The resources allocated to running dogs, locked and written back at the end.
+
+    An allocation belongs to a dog process, which is replaced by docker when dog
+    execs it, so it is freed when the process (the container) exits. The
+    directory is shared by all users, as the resources are those of the host.
+    """
+    import fcntl
+
+    make_shared_dir(directory)
+    lock_fd = open_shared_file(
+        os.path.join(directory, '{}.lock'.format(name)), os.O_RDONLY, 0o644
+    )
+    with open(lock_fd) as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Written in place, as the sticky directory keeps the other users from
+        # replacing the file
+        allocations_fd = open_shared_file(
+            os.path.join(directory, '{}.json'.format(name)), os.O_RDWR, 0o666
+        )
+        with open(allocations_fd, 'r+') as allocations_file:
+            try:
+                allocations = json.loads(allocations_file.read() or '[]')
+            except ValueError:
+                allocations = []
+            allocations = [
+                allocation
+                for allocation in allocations
+                if is_process_alive(allocation['pid'], allocation['start'])
+            ]
+            yield allocations
+            allocations_file.seek(0)
+            allocations_file.truncate()
+            allocations_file.write(json.dumps(allocations))
+
+
+def allocate_cpuset(config: DogConfig, sysfs_root: str = SYSFS_ROOT) -> bool:
+    """Replace cpuset = auto with CPUs not used by the containers of other dogs.
+
+    Returns whether CPUs were allocated (and must be released again).
+    """
+    resources = config[RESOURCES]
+    if sys.platform == 'win32':
+        log_verbose(config, 'Dog cpuset = auto is not supported on Windows')
+        del resources[RESOURCE_CPUSET]
+        return False
+    count = int(math.ceil(float(resources[RESOURCE_CPUS])))
+    cores = read_cpu_topology(sysfs_root)
+    with locked_allocations(config[ALLOCATION_DIR], CPUSET_ALLOCATIONS) as allocations:
+        usage = {}  # type: Dict[int, int]
+        for allocation in allocations:
+            for cpu in allocation['cpus']:
+                usage[cpu] = usage.get(cpu, 0) + 1
+        cpus = choose_cpus(cores, usage, count)
+        allocations.append(dict(this_process(), cpus=cpus))
+    if any(usage.get(cpu) for cpu in cpus):
+        log_verbose(
+            config, 'Dog found no {} free CPUs - sharing CPUs with others'.format(count)
+        )
+    resources[RESOURCE_CPUSET] = format_cpu_list(cpus)
+    return True
+
+
+def release_allocations(directory: str, name: str):
+    with locked_allocations(directory, name) as allocations:
+        allocations[:] = [
+            allocation for allocation in allocations if allocation['pid'] != os.getpid()
+        ]
+
+
+def split_host_port(outside: str) -> Tuple[str, str]:
+    """Split "127.0.0.1:8080", "[::1]:8080" or "8080" into host and port."""
+    host, _, port = outside.rpartition(':')
+    return host.strip('[]'), port
+
+
+def probe_free_port(host: str, udp: bool) -> int:
+    """A port nothing is bound to on host, found by letting the OS choose one."""
+    kind = socket.SOCK_DGRAM if udp else socket.SOCK_STREAM
+    family, _, _, _, address = socket.getaddrinfo(host or '0.0.0.0', 0, 0, kind)[0]
+    with socket.socket(family, kind) as probe:
+        probe.bind(address)
+        return probe.getsockname()[1]
+
+
+def allocate_free_ports(config: DogConfig) -> bool:
+    """Replace ${free-port} in [ports] with free host ports.
+
+    The ports are reserved for this dog until its container exits, so
+    concurrent dogs never choose the same port. Returns whether ports were
+    reserved (and must be released again).
+    """
+
+    def choose_ports(reserved: Set[int]) -> List[int]:
+        chosen = []
+        for inside, outside in config[PORTS].items():
+            if FREE_PORT not in outside:
+                continue
+            host, _ = split_host_port(outside)
+            for _ in range(FREE_PORT_ATTEMPTS):
+                try:
+                    port = probe_free_port(host, inside.endswith('/udp'))
+                except OSError as e:
+                    fatal_error('Could not find a free port for {}: {}'.format(host, e))
+                if port not in reserved and port not in chosen:
+                    break
+            else:
+                fatal_error('Could not find a free port for {}'.format(inside))
+            chosen.append(port)
+            config[PORTS][inside] = outside.replace(FREE_PORT, str(port))
+        return chosen
+
+    if sys.platform == 'win32':
+        choose_ports(set())
+        return False
+    with locked_allocations(config[ALLOCATION_DIR], PORT_ALLOCATIONS) as allocations:
+        reserved = set()  # type: Set[int]
+        for allocation in allocations:
+            reserved.update(allocation['ports'])
+        allocations.append(dict(this_process(), ports=choose_ports(reserved)))
+    return True
+
+
+def port_env_var(inside: str) -> str:
+    """DOG_PORT_<inside>, e.g. DOG_PORT_8080 or DOG_PORT_53_UDP."""
+    return DOG_PORT_ENV_PREFIX + re.sub(r'[^A-Za-z0-9]', '_', inside).upper()
+
+
+def container_cpu_count(config: DogConfig) -> int:
+    """The number of CPUs the container can use."""
+    resources = config[RESOURCES]
+    cpuset = resources.get(RESOURCE_CPUSET, CPUSET_AUTO)
+    if cpuset != CPUSET_AUTO:
+        count = len(parse_cpu_list(cpuset))
+    else:
+        count = os.cpu_count() or 1
+    if RESOURCE_CPUS in resources:
+        count = min(count, int(math.ceil(float(resources[RESOURCE_CPUS]))))
+    return max(count, 1)
 
+
+def make_shared_dir(path: str):
+    """Create a directory every user can create files in, like /tmp.
+
+    It is sticky, so the users can only remove (or replace) their own files.
+    """
+    os.makedirs(path, exist_ok=True)
+    st = os.lstat(path)
+    if stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid():
+        os.chmod(path, 0o1777)
+        st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or stat.S_IMODE(st.st_mode) != 0o1777:
+        fatal_error('{} must be a directory with mode 1777'.format(path))
+
+
+def open_shared_file(path: str, flags: int, mode: int) -> int:
+    """Open a file in a shared dir, creating it with mode if it does not exist.
+
+    O_CREAT is only used for new files, as protected_regular refuses it for the
+    files of other users in sticky directories.
+    """
+    while True:
+        try:
+            return os.open(path, flags)
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(path, flags | os.O_CREAT | os.O_EXCL, mode)
+        except FileExistsError:
+            continue  # Created by another dog in the meantime
+        os.fchmod(fd, mode)  # Regardless of the umask
+        return fd
+
+
+def try_lock(path: str) -> Union[int, None]:
+    """Open (or create) path and lock it without waiting, or return None."""
+    import fcntl
+
+    try:
+        fd = open_shared_file(path, os.O_RDONLY, 0o644)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def admission_queue_ahead(queue_dir: str, ticket: str) -> int:
+    """Count the waiting dogs ahead of ticket, removing the tickets of dead ones."""
+    ahead = 0
+    for name in sorted(os.listdir(queue_dir)):
+        if name >= ticket:
+            break
+        if name.startswith('.'):
+            continue  # Not locked yet
+        path = os.path.join(queue_dir, name)
+        if not os.path.exists(path):
+            continue
+        fd = try_lock(path)
+        if fd is None:
+            ahead += 1
+            continue
+        # Nobody holds the lock of the ticket, so its dog has exited
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        os.close(fd)
+    return ahead
+
+
+def acquire_admission_slots(config: DogConfig) -> List[int]:
+    """Wait for admission-weight of the admission-slots slots of this host.
+
+    Waiting dogs are served in order of arrival, across all users sharing
+    admission-dir. Each slot is a file locked with flock, so it is freed when
+    the process holding it exits, even if it crashes. The returned fds are
+    inherited by docker when dog execs it, so the slots are held until the
+    container exits.
+    """
+    capacity = int_from_config(config, ADMISSION_SLOTS)
+    if capacity <= 0:
+        return []
+    if sys.platform == 'win32':
+        log_verbose(config, 'Dog admission control is not supported on Windows')
+        return []
+    import fcntl
+
+    weight = min(max(int_from_config(config, ADMISSION_WEIGHT), 1), capacity)
+    directory = config[ADMISSION_DIR]
+    queue_dir = os.path.join(directory, ADMISSION_QUEUE_DIR)
+    make_shared_dir(directory)
+    make_shared_dir(queue_dir)
+    ticket = '{:017.6f}-{}'.format(time.time(), uuid.uuid4().hex[:8])
+    # Lock the ticket before it is visible, or it would look like a dead dog's
+    hidden_ticket_path = os.path.join(queue_dir, '.' + ticket)
+    ticket_path = os.path.join(queue_dir, ticket)
+    ticket_fd = os.open(hidden_ticket_path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    fcntl.flock(ticket_fd, fcntl.LOCK_EX)
+    os.rename(hidden_ticket_path, ticket_path)
+    slots = {}  # type: Dict[int, int]
+    reported_ahead = None
+    try:
+        while True:
+            ahead = admission_queue_ahead(queue_dir, ticket)
+            if ahead == 0:
+                # Keep the slots already taken, so heavy dogs are not starved
+                for slot in range(capacity):
+                    if len(slots) == weight:
+                        break
+                    if slot not in slots:
+                        fd = try_lock(os.path.join(directory, 'slot-{}'.format(slot)))
+                        if fd is not None:
+                            slots[slot] = fd
+                if len(slots) == weight:
+                    break
+            if ahead != reported_ahead:
+                message = 'Dog waiting for {} of the {} slots ({} ahead in the queue)'
+                print(message.format(weight, capacity, ahead), file=sys.stderr)
+                reported_ahead = ahead
+            time.sleep(ADMISSION_POLL_SECONDS)
+    except BaseException:
+        release_admission_slots(list(slots.values()))
+        raise
+    finally:
+        os.unlink(ticket_path)
+        os.close(ticket_fd)
+    for fd in slots.values():
+        os.set_inheritable(fd, True)
+    return list(slots.values())
+
+
+def release_admission_slots(fds: List[int]):
+    for fd in fds:
+        os.close(fd)
+
+
+def docker_host_args(config: DogConfig) -> List[str]:
+    """Global engine options selecting the engine (see connect_docker_host)."""
+    return config.get(ENGINE_HOST_ARGS, [])
+
+
+def engine_host_option(config: DogConfig, url: str) -> List[str]:
+    return ['--url', url] if config[USE_PODMAN] else ['-H', url]
+
+
+def is_socket_listening(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX) as s:
+        try:
+            s.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+def engine_ssl_context():
+    """The TLS settings of the docker CLI for tcp:// engines, or None for plain TCP."""
+    verify = bool(os.getenv('DOCKER_TLS_VERIFY'))
+    if not verify and not os.getenv('DOCKER_TLS'):
+        return None
+    import ssl
+
+    cert_path = Path(os.getenv('DOCKER_CERT_PATH') or Path.home() / '.docker')
+    if verify:
+        context = ssl.create_default_context(cafile=str(cert_path / 'ca.pem'))
+    else:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if (cert_path / 'cert.pem').is_file():
+        context.load_cert_chain(str(cert_path / 'cert.pem'), str(cert_path / 'key.pem'))
+    return context
+
+
+def read_http_head(reader) -> Union[bytes, None]:
+    """The request or status line and the headers of an HTTP message.
+
+    Returns None if the connection was closed before the message started.
+    """
+    lines = []
+    size = 0
+    while True:
+        line = reader.readline(ENGINE_HEAD_MAX_SIZE)
+        if not line:
+            if lines:
+                raise ConnectionError('Connection closed in the message head')
+            return None
+        size += len(line)
+        if size >= ENGINE_HEAD_MAX_SIZE:
+            raise ConnectionError('HTTP message head too long')
+        if line.strip() or lines:
+            lines.append(line)
+        if lines and not line.strip():
+            return b''.join(lines)
+
+
+def http_headers(head: bytes) -> Dict[str, str]:
+    headers = {}
+    for line in head.decode('latin-1').splitlines()[1:]:
+        name, separator, value = line.partition(':')
+        if separator:
+            name = name.strip().lower()
+            value = value.strip()
+            headers[name] = headers[name] + ', ' + value if name in headers else value
+    return headers
+
+
+def copy_exactly(reader, sock: socket.socket, size: int):
+    while size > 0:
+        data = reader.read1(min(size, 64 * 1024))
+        if not data:
+            raise ConnectionError('Connection closed in the message body')
+        sock.sendall(data)
+        size -= len(data)
+
+
+def copy_until_closed(reader, sock: socket.socket):
+    data = reader.read1(64 * 1024)
+    while data:
+        sock.sendall(data)
+        data = reader.read1(64 * 1024)
+
+
+def forward_http_body(reader, sock: socket.socket, headers: Dict[str, str]):
+    """Copy the body framed by headers (which must not be read until closed)."""
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            line = reader.readline(ENGINE_HEAD_MAX_SIZE)
+            if not line:
+                raise ConnectionError('Connection closed in a chunk')
+            sock.sendall(line)
+            size = int(line.split(b';')[0], 16)
+            if size == 0:
+                # The trailer headers, ending with an empty line
+                while line.strip():
+                    line = reader.readline(ENGINE_HEAD_MAX_SIZE)
+                    if not line:
+                        raise ConnectionError('Connection closed in the trailer')
+                    sock.sendall(line)
+                return
+            copy_exactly(reader, sock, size + 2)
+    copy_exactly(reader, sock, int(headers.get('content-length', '0')))
+
+
+def splice(sock: socket.socket, reader, other_sock: socket.socket, other_reader):
+    """Copy both ways between two connections until both directions are closed."""
+
+    def pump(from_reader, to_sock: socket.socket):
+        with contextlib.suppress(OSError):
+            copy_until_closed(from_reader, to_sock)
+            to_sock.shutdown(socket.SHUT_WR)
+
+    thread = threading.Thread(target=pump, args=(reader, other_sock), daemon=True)
+    thread.start()
+    pump(other_reader, sock)
+    thread.join()
+
+
+class EngineBroker:
+    """Share kept-alive connections to a tcp:// engine between engine clients.
+
+    The clients (dog and the docker CLI it runs) connect to a unix socket, and
+    their API requests are sent over an idle connection to the engine when there
+    is one. That way consecutive invocations share the TCP and TLS set-up.
+    Connections upgraded to raw streams (like the ones of "docker attach") are
+    not shared. The broker exits when it had no clients for persist seconds.
+    """
+
+    def __init__(self, url: str, ssl_context, persist: int):
+        parts = urllib.parse.urlsplit(url)
+        self.address = (parts.hostname, parts.port or (2376 if ssl_context else 2375))
+        self.ssl_context = ssl_context
+        self.persist = persist
+        self.idle = []  # type: List[tuple]
+        self.clients = 0
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+
+    def connect(self) -> tuple:
+        sock = socket.create_connection(self.address, timeout=ENGINE_CONNECT_SECONDS)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.ssl_context:
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=self.address[0])
+        return sock, sock.makefile('rb')
+
+    def take(self) -> tuple:
+        """An idle connection to the engine, or a new one."""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection = self.idle.pop()
+            # Anything to read on an idle connection means it was closed
+            readable, _, _ = select.select([connection[0]], [], [], 0)
+            if not readable:
+                return connection
+            self.close(connection)
+        return self.connect()
+
+    def give_back(self, connection: tuple):
+        with self.lock:
+            self.idle.append(connection)
+
+    @staticmethod
+    def close(connection: tuple):
+        sock, reader = connection
+        with contextlib.suppress(OSError):
+            reader.close()
+            sock.close()
+
+    def listen(self, socket_path: str) -> socket.socket:
+        """Connect to the engine (to find problems right away) and listen."""
+        self.give_back(self.connect())
+        tmp_path = '{}.{}.tmp'.format(socket_path, os.getpid())
+        listener = socket.socket(socket.AF_UNIX)
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+        listener.bind(tmp_path)
+        listener.listen(16)
+        os.replace(tmp_path, socket_path)
+        return listener
+
+    def serve(self, listener: socket.socket, socket_path: str):
+        listener.settimeout(min(self.persist, ENGINE_BROKER_POLL_SECONDS))
+        try:
+            while True:
+                try:
+                    client, _ = listener.accept()
+                except socket.timeout:
+                    with self.lock:
+                        idle_for = time.monotonic() - self.last_active
+                        if self.clients == 0 and idle_for >= self.persist:
+                            return
+                    continue
+                with self.lock:
+                    self.clients += 1
+                threading.Thread(
+                    target=self.handle_client, args=(client,), daemon=True
+                ).start()
+        finally:
+            with contextlib.suppress(OSError):
+                os.unlink(socket_path)
+            listener.close()
+            for connection in self.idle:
+                self.close(connection)
+
+    def handle_client(self, client: socket.socket):
+        client_reader = client.makefile('rb')
+        connection = None
+        try:
+            while True:
+                request = read_http_head(client_reader)
+                if request is None:
+                    break
+                if connection is None:
+                    connection = self.take()
+                if not self.forward(client, client_reader, request, connection):
+                    self.close(connection)
+                    connection = None
+                    break
+        except (OSError, ValueError):
+            if connection is not None:
+                self.close(connection)
+                connection = None
+        finally:
+            if connection is not None:
+                self.give_back(connection)
+            with contextlib.suppress(OSError):
+                client_reader.close()
+                client.close()
+            with self.lock:
+                self.clients -= 1
+                self.last_active = time.monotonic()
+
+    def forward(self, client: socket.socket, client_reader, request, connection):
+        """Forward one exchange, returning whether the connection can be reused."""
+        sock, reader = connection
+        request_headers = http_headers(request)
+        sock.sendall(request)
+        forward_http_body(client_reader, sock, request_headers)
+        response = read_http_head(reader)
+        # Informational responses are followed by the real one
+        while response is not None and response.split(b' ', 2)[1:2] == [b'100']:
+            client.sendall(response)
+            response = read_http_head(reader)
+        if response is None:
+            raise ConnectionError('The engine closed the connection')
+        client.sendall(response)
+        status = int(response.split(b' ', 2)[1])
+        response_headers = http_headers(response)
+        if status == 101:
+            splice(client, client_reader, sock, reader)
+            return False
+        if request.startswith(b'HEAD ') or status in (204, 304):
+            pass
+        elif (
+            'content-length' in response_headers
+            or 'transfer-encoding' in response_headers
+        ):
+            forward_http_body(reader, client, response_headers)
+        else:
+            copy_until_closed(reader, client)
+            return False
+        return not any(
+            'close' in headers.get('connection', '').lower()
+            for headers in (request_headers, response_headers)
+        )
+
+
+def open_fds() -> List[int]:
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        with contextlib.suppress(OSError):
+            return [int(fd) for fd in os.listdir(fd_dir)]
+    return list(range(256))
+
+
+def start_engine_broker(url: str, socket_path: str, persist: int) -> str:
+    """Start an EngineBroker in the background, returning an error message or ''."""
+    try:
+        broker = EngineBroker(url, engine_ssl_context(), persist)
+    except OSError as e:
+        return str(e)
+    read_fd, write_fd = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork() != 0:
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as status:
+            return status.read().decode(errors='replace')
+    # Detach completely, like the pool refill
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        # The broker outlives dog, so it must not keep the locks and pipes of dog
+        # (or of whatever started dog) open
+        for fd in open_fds():
+            if fd > 2 and fd != write_fd:
+                with contextlib.suppress(OSError):
+                    os.close(fd)
+        try:
+            listener = broker.listen(socket_path)
+        except OSError as e:
+            os.write(write_fd, str(e).encode())
+            return ''
+        finally:
+            os.close(write_fd)
+        broker.serve(listener, socket_path)
+    finally:
+        os._exit(0)
+
+
+def ssh_master_args(
+    url: str, socket_path: str, remote_socket: str, persist: int
+) -> List[str]:
+    """Start an ssh ControlMaster forwarding socket_path to the remote engine."""
+    parts = urllib.parse.urlsplit(url)
+    args = [
+        'ssh',
+        '-f',
+        '-N',
+        '-M',
+        '-S',
+        socket_path + '.ctl',
+        '-E',
+        socket_path + '.log',
+        '-o',
+        'ControlPersist={}'.format(persist),
+        '-o',
+        'ExitOnForwardFailure=yes',
+        '-o',
+        'StreamLocalBindUnlink=yes',
+        '-L',
+        '{}:{}'.format(socket_path, parts.path or remote_socket),
+    ]
+    if parts.port:
+        args += ['-p', str(parts.port)]
+    if parts.username:
+        args += ['-l', parts.username]
+    return args + ['--', parts.hostname]
+
+
+def start_ssh_master(config: DogConfig, url: str, socket_path: str) -> str:
+    """Start the ssh master for url, returning an error message or ''."""
+    for suffix in ('.ctl', '.log'):
+        with contextlib.suppress(OSError):
+            os.unlink(socket_path + suffix)
+    args = ssh_master_args(
+        url,
+        socket_path,
+        ENGINE_REMOTE_SOCKETS[docker_cmd(config)],
+        int_from_config(config, DOCKER_HOST_PERSIST),
+    )
+    log_verbose(config, ' '.join(args))
+    # ssh keeps running in the background, so it must not hold on to the output
+    proc = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if proc.returncode == 0:
+        return ''
+    try:
+        return Path(socket_path + '.log').read_text().strip()
+    except OSError:
+        return 'ssh failed with exit code {}'.format(proc.returncode)
+
+
+def connect_docker_host(config: DogConfig) -> List[str]:
+    """The global engine options to use the engine of docker-host (or DOCKER_HOST).
+
+    If docker-host-persist is set, ssh:// and tcp:// engines are reached through a
+    unix socket in the dog runtime dir, which is kept open for that many seconds
+    after its last use, so consecutive engine commands share one connection: an ssh
+    ControlMaster forwarding the remote engine socket, or an EngineBroker.
+    """
+    host = config[DOCKER_HOST]
+    direct = engine_host_option(config, host) if host else []
+    if not host:
+        host = os.getenv('CONTAINER_HOST' if config[USE_PODMAN] else 'DOCKER_HOST', '')
+    scheme = host.partition('://')[0]
+    if (
+        scheme not in ('ssh', 'tcp')
+        or int_from_config(config, DOCKER_HOST_PERSIST) <= 0
+        or sys.platform == 'win32'
+    ):
+        return direct
+
+    import fcntl
+
+    key = [docker_cmd(config), host]
+    if scheme == 'tcp' and not config[USE_PODMAN]:
+        key += [os.getenv(name, '') for name in ENGINE_TLS_ENV_VARS]
+    socket_path = str(
+        get_runtime_dir()
+        / '{}{}.sock'.format(
+            ENGINE_SOCKET_PREFIX,
+            hashlib.sha256('\n'.join(key).encode()).hexdigest()[:16],
+        )
+    )
+    error = ''
+    if not is_socket_listening(socket_path):
+        with open(socket_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not is_socket_listening(socket_path):
+                log_verbose(config, 'Dog connecting to {}'.format(host))
+                if scheme == 'ssh':
+                    error = start_ssh_master(config, host, socket_path)
+                else:
+                    error = start_engine_broker(
+                        host, socket_path, int_from_config(config, DOCKER_HOST_PERSIST)
+                    )
+    if error or not is_socket_listening(socket_path):
+        log_verbose(
+            config,
+            'Dog cannot share the connection to {} ({}) - connecting directly'.format(
+                host, error or 'no socket'
+            ),
+        )
+        return direct
+    args = engine_host_option(config, 'unix://' + socket_path)
+    if scheme == 'tcp' and not config[USE_PODMAN]:
+        # The broker does the TLS, so the CLI must not
+        args += ['--tls=false', '--tlsverify=false']
+    return args
+
+
+class Jobserver:
+    """A client of the GNU make jobserver given in MAKEFLAGS.
+
+    The make recipe running dog already holds one (implicit) job token. Extra
+    tokens are only taken if they are available right away, so dog never waits
+    for make, and they must be given back with release().
+    """
+
+    def __init__(self, read_fd: int, write_fd: int, owned_fds: List[int]):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.owned_fds = owned_fds
+        self.tokens = b''
+
+    @classmethod
+    def from_makeflags(cls, makeflags: str) -> Union['Jobserver', None]:
+        """The jobserver of MAKEFLAGS, or None if there is none (or not usable).
+
+        Both the fifo form (make 4.4+) and the pipe form are supported. Make only
+        keeps the pipe open for recursive recipes ("+" or using $(MAKE)).
+        """
+        auths = JOBSERVER_AUTH_RE.findall(makeflags)
+        if not auths or sys.platform == 'win32':
+            return None
+        auth = auths[-1]
+        try:
+            if auth.startswith('fifo:'):
+                path = auth[len('fifo:') :]
+                read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+                write_fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+                return cls(read_fd, write_fd, [read_fd, write_fd])
+            read_fd, write_fd = (int(fd) for fd in auth.split(','))
+            if read_fd < 0 or not stat.S_ISFIFO(os.fstat(read_fd).st_mode):
+                return None
+            os.fstat(write_fd)
+            # A new open file description, so O_NONBLOCK does not affect make
+            read_fd = os.open(
+                '/proc/self/fd/{}'.format(read_fd), os.O_RDONLY | os.O_NONBLOCK
+            )
+            return cls(read_fd, write_fd, [read_fd])
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self, max_tokens: int) -> int:
+        """Take up to max_tokens extra tokens without waiting, return how many."""
+        while len(self.tokens) < max_tokens:
+            try:
+                token = os.read(self.read_fd, 1)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not token:
+                break
+            self.tokens += token
+        return len(self.tokens)
+
+    def release(self):
+        """Give the tokens back (the same bytes, make may use them) and close."""
+        tokens = self.tokens
+        while tokens:
+            tokens = tokens[os.write(self.write_fd, tokens) :]
+        self.tokens = b''
+        for fd in self.owned_fds:
+            os.close(fd)
+        self.owned_fds = []
+
+
+def run_with_jobserver(config: DogConfig) -> int:
+    """Run the container with DOG_JOBS set to the number of jobs it may run.
+
+    Under make -jN with a jobserver, that is 1 (the token of the recipe running
+    dog) plus the tokens dog can take right away (at most one less than the
+    number of CPUs of the container). These are held until the container exits.
+    Without a jobserver it is the number of CPUs of the container.
+    """
+    cpus = container_cpu_count(config)
+    jobserver = Jobserver.from_makeflags(os.getenv('MAKEFLAGS', ''))
+    if jobserver is None:
+        if JOBSERVER_AUTH_RE.search(os.getenv('MAKEFLAGS', '')):
+            log_verbose(
+                config,
+                'Dog cannot use the make jobserver - add "+" to the make rule',
+            )
+            cpus = 1
+        config[USER_ENV_VARS][DOG_JOBS_ENV] = str(cpus)
+        return start_container(config)
+
+    def exit_on_sigterm(signum, frame):
+        # Leave through the finally below, giving the tokens back to make
+        sys.exit(128 + signum)
+
+    previous_handler = signal.signal(signal.SIGTERM, exit_on_sigterm)
+    try:
+        config[JOBSERVER_TOKENS] = jobserver.acquire(cpus - 1)
+        PHASE_TIMINGS.annotate('jobserver_tokens', config[JOBSERVER_TOKENS])
+        config[USER_ENV_VARS][DOG_JOBS_ENV] = str(1 + config[JOBSERVER_TOKENS])
+        return start_container(config)
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        jobserver.release()
+
+
+def start_container(config: DogConfig) -> int:
+    if config.get(WATCH):
+        return docker_watch(config)
+
+    if config.get(MEASURE):
+        return docker_run_measured(config)
+
+    if config[CACHE_INPUTS] or config[CACHE_OUTPUTS]:
+        return docker_run_with_action_cache(config)
+
+    if pool_enabled(config):
+        return docker_run_pooled(config)
+
+    return docker_run(config)
+
+
+@contextlib.contextmanager
+def prepared_run(config: DogConfig):
+    """Get the engine and the host ready for starting the container of config.
+
+    Pulls the image and creates the [volumes-from] containers and the caches. The
+    admission slots, cpus and ports taken for the container are given back at the
+    end of the block.
+    """
+    if config[PULL]:
+        with PHASE_TIMINGS.phase('docker_pull'):
+            docker_pull(config)
+
+    if config[VOLUMES_FROM] and config[AUTO_RUN_VOLUMES_FROM]:
+        with PHASE_TIMINGS.phase('docker_run_volumes_from'):
+            docker_run_volumes_from(config)
+
+    if config[CACHES]:
+        with PHASE_TIMINGS.phase('docker_create_caches'):
+            docker_create_caches(config)
+
+    with PHASE_TIMINGS.phase('acquire_admission_slots'):
+        config[ADMISSION_SLOT_FDS] = acquire_admission_slots(config)
+    allocated = []
+    try:
+        if config[RESOURCES].get(RESOURCE_CPUSET) == CPUSET_AUTO:
+            with PHASE_TIMINGS.phase('allocate_cpuset'):
+                if allocate_cpuset(config):
+                    allocated.append((config[ALLOCATION_DIR], CPUSET_ALLOCATIONS))
+        if RESOURCE_CPUSET in config[RESOURCES]:
+            config[USER_ENV_VARS][DOG_CPUS_ENV] = config[RESOURCES][RESOURCE_CPUSET]
+        if any(FREE_PORT in outside for outside in config[PORTS].values()):
+            with PHASE_TIMINGS.phase('allocate_free_ports'):
+                if allocate_free_ports(config):
+                    allocated.append((config[ALLOCATION_DIR], PORT_ALLOCATIONS))
+        for inside, outside in config[PORTS].items():
+            config[USER_ENV_VARS][port_env_var(inside)] = split_host_port(outside)[1]
+        yield
+    finally:
+        for directory, name in allocated:
+            release_allocations(directory, name)
+        release_admission_slots(config[ADMISSION_SLOT_FDS])
+
+
+def run_dog(config: DogConfig) -> int:
     if config[SANITY_CHECK_ALWAYS] or config[SANITY_CHECK]:
-        res = perform_sanity_check(config)
+        with PHASE_TIMINGS.phase('perform_sanity_check'):
+            res = perform_sanity_check(config)
         if config[SANITY_CHECK]:
             return res
 
-    if config[PULL]:
-        docker_pull(config)
+    if config[STATS]:
+        return show_stats(config)
 
-    if config[VOLUMES_FROM] and config[AUTO_RUN_VOLUMES_FROM]:
-        docker_run_volumes_from(config)
+    with PHASE_TIMINGS.phase('connect_docker_host'):
+        config[ENGINE_HOST_ARGS] = connect_docker_host(config)
 
-    return docker_run(config)
+    if config[CACHE_STATS]:
+        return docker_cache_stats(config)
+
+    if config[CACHE_PRUNE]:
+        return docker_cache_prune(config)
+
+    with prepared_run(config):
+        if config[JOBSERVER]:
+            return run_with_jobserver(config)
+        return start_container(config)
 
 
 def setup_tools_main():
@@ -1,6 +1,8 @@
 import configparser
+import json
 import os
 import pytest
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -19,6 +21,28 @@ def is_windows() -> bool:
     return 'win32' in sys.platform
 
 
+def docker_is_available() -> bool:
+    """Whether the docker CLI is installed and its engine is running."""
+    if shutil.which('docker') is None:
+        return False
+    try:
+        info = subprocess.run(
+            ['docker', 'info'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=60,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return info.returncode == 0
+
+
+# For the tests running real images
+needs_docker = pytest.mark.skipif(
+    not docker_is_available(), reason='Needs a running docker engine'
+)
+
+
 @pytest.fixture
 def capstrip(capfd):
     class CapStrip:
@@ -147,3 +171,80 @@ def home_temp_dir(tmp_path_factory, monkeypatch) -> Path:
     tmphome = tmp_path_factory.mktemp('home')
     monkeypatch.setenv('HOME', str(tmphome))
     yield tmphome
+
+
+@pytest.fixture
+def fake_engine(tmp_path_factory, monkeypatch):
+    """Put a fake docker and podman (see fake_engine/fake_engine.py) first in PATH."""
+    engine_dir = tmp_path_factory.mktemp('fake_engine')
+    bin_dir = engine_dir / 'bin'
+    bin_dir.mkdir()
+    script = Path(__file__).parent / 'fake_engine' / 'fake_engine.py'
+    for tool in ('docker', 'podman'):
+        if is_windows():
+            wrapper = bin_dir / (tool + '.bat')
+            wrapper.write_text(
+                '@"{}" "{}" %*\r\n'.format(DOG_PYTHON_UNDER_TEST, script)
+            )
+        else:
+            wrapper = bin_dir / tool
+            wrapper.write_text(
+                '#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(DOG_PYTHON_UNDER_TEST, script)
+            )
+            wrapper.chmod(0o755)
+    monkeypatch.setenv('FAKE_ENGINE_DIR', str(engine_dir))
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+    class FakeEngine:
+        directory = engine_dir
+
+        def calls(self) -> List[List[str]]:
+            """The arguments (without the tool name) of every call so far."""
+            calls_file = engine_dir / 'calls.jsonl'
+            if not calls_file.exists():
+                return []
+            return [
+                json.loads(line)['argv'][1:]
+                for line in calls_file.read_text().splitlines()
+            ]
+
+        def state(self) -> dict:
+            state_file = engine_dir / 'state.json'
+            if not state_file.exists():
+                return {'containers': {}, 'images': {}, 'volumes': {}}
+            return json.loads(state_file.read_text())
+
+    return FakeEngine()
+
+
+class MockEngine:
+    """In-process stand-in for subprocess.run and subprocess.Popen of docker calls.
+
+    Every call is recorded. Subclasses answer the calls their tests need in
+    answer(); the other calls succeed without output.
+    """
+
+    def __init__(self):
+        self.calls: List[List[str]] = []
+        self.popen_calls: List[List[str]] = []
+
+    def install(self, monkeypatch) -> 'MockEngine':
+        monkeypatch.setattr(subprocess, 'run', self.run)
+        monkeypatch.setattr(subprocess, 'Popen', self.popen)
+        return self
+
+    def answer(self, args: List[str]) -> Tuple[int, str]:
+        """The exit code and the output of the call."""
+        return 0, ''
+
+    def run(self, args, **kwargs):
+        self.calls.append(args)
+        returncode, stdout = self.answer(args)
+        return subprocess.CompletedProcess(args, returncode, stdout=stdout)
+
+    def popen(self, args, **kwargs):
+        self.popen_calls.append(args)
+
+    def calls_of(self, *cmd: str) -> List[List[str]]:
+        """The calls of the docker command starting with cmd."""
+        return [c for c in self.calls if c[1 : 1 + len(cmd)] == list(cmd)]
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""A hermetic stand-in for the docker/podman CLI, for tests and benchmarks.
+
+It implements the subset of the CLI used by dog. Containers are simulated: the
+command given to "run" and "exec" is executed locally (in the -w directory if it
+exists, with the -e/--env-file environment), and container names, labels, images
+and volumes are kept in a JSON state file. Every invocation is appended to
+calls.jsonl. Behaviour is controlled with environment variables:
+
+    FAKE_ENGINE_DIR            Directory for the state and the call log (required)
+    FAKE_ENGINE_VERSION        Version reported by --version (default 24.0.7)
+    FAKE_ENGINE_PULL_LATENCY   Seconds a pull (or the first run of an image) takes
+    FAKE_ENGINE_FAIL           Comma separated <subcommand>=<exit code> failures,
+                               e.g. "pull=1,rename=1"
+    FAKE_ENGINE_EXECUTE        Set to 0 to not execute the commands (exit code 0)
+
+When an engine is given with -H/--host (or --url for podman), every command
+first sends "HEAD /_ping" to the engine API there (unix:// or tcp://), like
+the real CLI, and fails if that does not work.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+# Options of "run" and "exec" taking a separate value
+OPTIONS_WITH_VALUE = {
+    '-e',
+    '--env',
+    '--cidfile',
+    '--entrypoint',
+    '--env-file',
+    '--filter',
+    '--label',
+    '--name',
+    '--network',
+    '-p',
+    '--tmpfs',
+    '-u',
+    '--user',
+    '-v',
+    '--volume',
+    '--volumes-from',
+    '-w',
+    '--workdir',
+}
+
+# Global options selecting the engine
+HOST_OPTIONS = {'-H', '--host', '--url'}
+
+
+class Engine:
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.state_file = directory / 'state.json'
+        self.lock_file = directory / 'state.lock'
+
+    @contextmanager
+    def state(self):
+        """The state, locked and written back when the block ends."""
+        with self.lock_file.open('w') as lock:
+            if sys.platform != 'win32':
+                import fcntl
+
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = json.loads(self.state_file.read_text())
+            except (OSError, ValueError):
+                state = {'containers': {}, 'images': {}, 'volumes': {}}
+            yield state
+            tmp_file = self.state_file.with_suffix('.{}.tmp'.format(os.getpid()))
+            tmp_file.write_text(json.dumps(state, indent=2))
+            os.replace(str(tmp_file), str(self.state_file))
+
+    def log_call(self, argv):
+        with (self.directory / 'calls.jsonl').open('a') as f:
+            f.write(json.dumps({'argv': argv, 'time': time.time()}) + '\n')
+
+
+def image_id(image: str) -> str:
+    return 'sha256:' + hashlib.sha256(image.encode()).hexdigest()
+
+
+def parse_options(args):
+    """Split "[options] <positional> [rest]" into options, positional and rest."""
+    options = []
+    index = 0
+    while index < len(args) and args[index].startswith('-'):
+        option = args[index]
+        if option in OPTIONS_WITH_VALUE:
+            options.append((option, args[index + 1]))
+            index += 2
+        else:
+            name, _, value = option.partition('=')
+            options.append((name, value or None))
+            index += 1
+    if index == len(args):
+        return options, None, []
+    return options, args[index], args[index + 1 :]
+
+
+def option_values(options, *names):
+    return [value for option, value in options if option in names]
+
+
+def execute(options, command) -> int:
+    if not command or os.getenv('FAKE_ENGINE_EXECUTE') == '0':
+        return 0
+    env = dict(os.environ)
+    for env_file in option_values(options, '--env-file'):
+        for line in Path(env_file).read_text().splitlines():
+            if '=' in line:
+                name, _, value = line.partition('=')
+                env[name] = value
+    for assignment in option_values(options, '-e', '--env'):
+        name, _, value = assignment.partition('=')
+        env[name] = value
+    workdirs = option_values(options, '-w', '--workdir')
+    cwd = workdirs[-1] if workdirs and os.path.isdir(workdirs[-1]) else None
+    try:
+        return subprocess.run(command, env=env, cwd=cwd).returncode
+    except OSError:
+        print('fake engine: {}: command not found'.format(command[0]), file=sys.stderr)
+        return 127
+
+
+def pull(state, image: str):
+    if image not in state['images']:
+        time.sleep(float(os.getenv('FAKE_ENGINE_PULL_LATENCY', '0')))
+        state['images'][image] = image_id(image)
+
+
+def cmd_run(engine: Engine, args) -> int:
+    options, image, command = parse_options(args)
+    if image is None:
+        print('"docker run" requires at least 1 argument', file=sys.stderr)
+        return 125
+    names = option_values(options, '--name')
+    name = names[-1] if names else 'fake_{}'.format(uuid.uuid4().hex[:8])
+    container_id = hashlib.sha256(name.encode() + os.urandom(8)).hexdigest()
+    detached = bool(option_values(options, '-d', '--detach'))
+    with engine.state() as state:
+        if name in state['containers']:
+            print('Conflict. The container name "/{}" is already in use'.format(name))
+            return 125
+        pull(state, image)
+        labels = dict(
+            label.partition('=')[::2] for label in option_values(options, '--label')
+        )
+        state['containers'][name] = {
+            'id': container_id,
+            'image': image,
+            'labels': labels,
+            'command': command,
+            'status': 'running',
+        }
+    for cidfile in option_values(options, '--cidfile'):
+        Path(cidfile).write_text(container_id)
+    if detached:
+        print(container_id)
+        return 0
+    returncode = execute(options, command)
+    with engine.state() as state:
+        if option_values(options, '--rm'):
+            state['containers'].pop(name, None)
+        elif name in state['containers']:
+            state['containers'][name]['status'] = 'exited'
+    return returncode
+
+
+def cmd_exec(engine: Engine, args) -> int:
+    options, name, command = parse_options(args)
+    with engine.state() as state:
+        container = state['containers'].get(name)
+        if not container or container['status'] != 'running':
+            print('Error: No such container: {}'.format(name), file=sys.stderr)
+            return 1
+    return execute(options, command)
+
+
+def matches_filters(item: dict, filters) -> bool:
+    for kind, _, value in (f.partition('=') for f in filters):
+        if kind == 'label':
+            key, _, wanted = value.partition('=')
+            if key not in item['labels'] or (wanted and item['labels'][key] != wanted):
+                return False
+        elif kind == 'status' and item.get('status') != value:
+            return False
+    return True
+
+
+def cmd_container(engine: Engine, args) -> int:
+    if not args or args[0] not in ('ls', 'list', 'ps'):
+        return 0
+    options, _, _ = parse_options(args[1:])
+    filters = option_values(options, '--filter')
+    show_all = bool(option_values(options, '-a', '--all'))
+    with engine.state() as state:
+        for name, container in sorted(state['containers'].items()):
+            if container['status'] != 'running' and not show_all:
+                continue
+            if matches_filters(container, filters):
+                print(name)
+    return 0
+
+
+def cmd_rename(engine: Engine, args) -> int:
+    old, new = args
+    with engine.state() as state:
+        if old not in state['containers'] or new in state['containers']:
+            print('Error: could not rename {} to {}'.format(old, new), file=sys.stderr)
+            return 1
+        state['containers'][new] = state['containers'].pop(old)
+    return 0
+
+
+def cmd_rm(engine: Engine, args) -> int:
+    _, first, rest = parse_options(args)
+    returncode = 0
+    with engine.state() as state:
+        for name in [first] + rest if first else []:
+            if state['containers'].pop(name, None) is None:
+                returncode = 1
+    return returncode
+
+
+def cmd_pull(engine: Engine, args) -> int:
+    _, image, _ = parse_options(args)
+    with engine.state() as state:
+        pull(state, image)
+    print('{}: Pulled (fake)'.format(image))
+    return 0
+
+
+def cmd_image(engine: Engine, args) -> int:
+    if args[:1] != ['inspect']:
+        return 0
+    _, image, _ = parse_options(args[1:])
+    with engine.state() as state:
+        if image not in state['images']:
+            print('Error: No such image: {}'.format(image), file=sys.stderr)
+            return 1
+        print(state['images'][image])
+    return 0
+
+
+def cmd_volume(engine: Engine, args) -> int:
+    options, name, rest = parse_options(args[1:])
+    with engine.state() as state:
+        if args[0] == 'create':
+            labels = dict(
+                label.partition('=')[::2] for label in option_values(options, '--label')
+            )
+            state['volumes'].setdefault(name, {'labels': labels})
+            print(name)
+        elif args[0] in ('ls', 'list'):
+            filters = option_values(options, '--filter')
+            for volume_name, volume in sorted(state['volumes'].items()):
+                if matches_filters(volume, filters):
+                    print(volume_name)
+        elif args[0] == 'rm':
+            for volume_name in [name] + rest:
+                if state['volumes'].pop(volume_name, None) is None:
+                    return 1
+    return 0
+
+
+def cmd_system(engine: Engine, args) -> int:
+    with engine.state() as state:
+        volumes = [{'Name': name, 'Size': '0B'} for name in sorted(state['volumes'])]
+    print(json.dumps({'Volumes': volumes}))
+    return 0
+
+
+def cmd_stats(engine: Engine, args) -> int:
+    _, first, rest = parse_options(args)
+    for _ in [first] + rest if first else []:
+        print('1MiB / 1GiB')
+    return 0
+
+
+COMMANDS = {
+    'container': cmd_container,
+    'exec': cmd_exec,
+    'image': cmd_image,
+    'ps': lambda engine, args: cmd_container(engine, ['ls'] + args),
+    'pull': cmd_pull,
+    'rename': cmd_rename,
+    'rm': cmd_rm,
+    'run': cmd_run,
+    'stats': cmd_stats,
+    'system': cmd_system,
+    'volume': cmd_volume,
+}
+
+
+def ping(host: str) -> bool:
+    scheme, _, address = host.partition('://')
+    try:
+        if scheme == 'unix':
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(address)
+        else:
+            address, _, port = address.rpartition(':')
+            sock = socket.create_connection((address, int(port)))
+        with sock, sock.makefile('rb') as reader:
+            sock.sendall(b'HEAD /_ping HTTP/1.1\r\nHost: docker\r\n\r\n')
+            status = reader.readline().split()
+            while reader.readline().strip():
+                pass
+        return status[1:2] == [b'200']
+    except (OSError, ValueError):
+        return False
+
+
+def main(argv) -> int:
+    engine = Engine(Path(os.environ['FAKE_ENGINE_DIR']))
+    engine.log_call(argv)
+    tool = os.path.basename(argv[0])
+    args = argv[1:]
+    # The global options (before the subcommand)
+    while args and (args[0] in HOST_OPTIONS or args[0].startswith('--tls')):
+        if args[0] in HOST_OPTIONS:
+            if not ping(args[1]):
+                message = 'Cannot connect to the engine at {}'.format(args[1])
+                print(message, file=sys.stderr)
+                return 1
+            args = args[1:]
+        args = args[1:]
+    if args[:1] in (['--version'], ['version']):
+        version = os.getenv('FAKE_ENGINE_VERSION', '24.0.7')
+        print('{} version {}, build fake'.format(tool.capitalize(), version))
+        return 0
+    subcommand = args[0] if args else ''
+    failures = dict(
+        failure.split('=')
+        for failure in os.getenv('FAKE_ENGINE_FAIL', '').split(',')
+        if failure
+    )
+    if subcommand in failures:
+        print('fake engine: {} failed'.format(subcommand), file=sys.stderr)
+        return int(failures[subcommand])
+    command = COMMANDS.get(subcommand)
+    return command(engine, args[1:]) if command else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,182 @@
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+import dog
+from conftest import MockEngine, update_dog_config
+from dog import DOG, HashDatabase, expand_globs, parse_command_line_args
+
+
+class ActionEngine(MockEngine):
+    """Pretends to be docker; "running" a container copies in/*.txt to out/."""
+
+    def __init__(self, workspace: Path):
+        super().__init__()
+        self.workspace = workspace
+        self.image_id = 'sha256:1111'
+        self.exit_code = 0
+
+    @property
+    def runs(self) -> List[List[str]]:
+        return self.calls_of('run')
+
+    def answer(self, args: List[str]) -> Tuple[int, str]:
+        if args[1:3] == ['image', 'inspect']:
+            return 0, self.image_id
+        if args[1] == 'run':
+            out = self.workspace / 'out'
+            out.mkdir(exist_ok=True)
+            for f in (self.workspace / 'in').glob('*.txt'):
+                (out / f.name).write_text(f.read_text().upper())
+            return self.exit_code, ''
+        return super().answer(args)
+
+
+@pytest.fixture
+def mock_engine(monkeypatch, tmp_path):
+    return ActionEngine(tmp_path).install(monkeypatch)
+
+
+@pytest.fixture(autouse=True)
+def workspace(basic_dog_config_with_image, home_temp_dir, monkeypatch, tmp_path):
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    update_dog_config(tmp_path, {DOG: {'auto-mount': False}})
+    (tmp_path / 'in').mkdir()
+    (tmp_path / 'in' / 'a.txt').write_text('a')
+    (tmp_path / 'in' / 'b.txt').write_text('b')
+    return tmp_path
+
+
+CACHE_ARGS = ['--cache-inputs', 'in/*.txt', '--cache-outputs', 'out/**', '--']
+
+
+def test_cache_options_do_not_need_dash_dash():
+    config = parse_command_line_args(
+        'dog', ['--cache-inputs', 'a/*,b', '--cache-outputs', 'out/*', 'make', '-j']
+    )
+    assert config['cache-inputs'] == ['a/*,b']
+    assert config['cache-outputs'] == ['out/*']
+    assert config['args'] == ['make', '-j']
+
+
+def test_miss_then_hit(call_main, mock_engine, workspace):
+    assert call_main(*CACHE_ARGS, 'gen') == 0
+    assert len(mock_engine.runs) == 1
+    assert (workspace / 'out' / 'a.txt').read_text() == 'A'
+
+    (workspace / 'out' / 'a.txt').unlink()
+    os.chmod(str(workspace / 'out' / 'b.txt'), 0o600)
+    (workspace / 'out' / 'b.txt').write_text('garbage')
+    assert call_main(*CACHE_ARGS, 'gen') == 0
+    assert len(mock_engine.runs) == 1
+    assert (workspace / 'out' / 'a.txt').read_text() == 'A'
+    assert (workspace / 'out' / 'b.txt').read_text() == 'B'
+
+
+@pytest.mark.parametrize(
+    'change',
+    ['input', 'image', 'command'],
+)
+def test_changes_cause_miss(call_main, mock_engine, workspace, change):
+    assert call_main(*CACHE_ARGS, 'gen') == 0
+    cmd = 'gen'
+    if change == 'input':
+        (workspace / 'in' / 'a.txt').write_text('aa')
+    elif change == 'image':
+        mock_engine.image_id = 'sha256:2222'
+    else:
+        cmd = 'gen2'
+    assert call_main(*CACHE_ARGS, cmd) == 0
+    assert len(mock_engine.runs) == 2
+
+
+def test_failed_runs_are_not_cached(call_main, mock_engine):
+    mock_engine.exit_code = 2
+    assert call_main(*CACHE_ARGS, 'gen') == 2
+    mock_engine.exit_code = 0
+    assert call_main(*CACHE_ARGS, 'gen') == 0
+    assert len(mock_engine.runs) == 2
+
+
+def test_inputs_and_outputs_must_be_used_together(call_main, mock_engine, capsys):
+    with pytest.raises(SystemExit):
+        call_main('--cache-inputs', 'in/*', '--', 'gen')
+    assert 'must be used together' in capsys.readouterr().err
+
+
+def test_expand_globs(workspace, monkeypatch):
+    monkeypatch.chdir(workspace)
+    (workspace / 'in' / 'sub').mkdir()
+    (workspace / 'in' / 'sub' / 'c.txt').write_text('c')
+    assert expand_globs(['in/*.txt']) == [
+        os.path.join('in', 'a.txt'),
+        os.path.join('in', 'b.txt'),
+    ]
+    assert len(expand_globs(['in/**/*.txt', 'in/a.txt'])) == 3
+    assert len(expand_globs(['in/a.txt, in/b.txt'])) == 2
+
+
+def test_hash_database_avoids_rehashing(workspace, monkeypatch):
+    file_name = str(workspace / 'in' / 'a.txt')
+    old = os.stat(file_name).st_mtime - 10
+    os.utime(file_name, (old, old))
+    db = HashDatabase(workspace / 'hashdb.json')
+    digest = db.hash_file(file_name)
+    db.save()
+
+    opened = []
+    real_open = open
+
+    def tracking_open(name, *args, **kwargs):
+        opened.append(name)
+        return real_open(name, *args, **kwargs)
+
+    monkeypatch.setattr('builtins.open', tracking_open)
+    db = HashDatabase(workspace / 'hashdb.json')
+    assert db.hash_file(file_name) == digest
+    assert file_name not in opened
+
+    (workspace / 'in' / 'a.txt').write_text('changed')
+    assert db.hash_file(file_name) != digest
+    assert file_name in opened
+
+
+def test_hash_database_skips_racy_files(workspace):
+    db = HashDatabase(workspace / 'hashdb.json')
+    db.hash_file(str(workspace / 'in' / 'a.txt'))
+    assert db.db == {}
+    assert not dog.HashDatabase(workspace / 'hashdb.json').db
+
+
+def test_dog_jobs_do_not_cause_miss(call_main, mock_engine, workspace, monkeypatch):
+    update_dog_config(workspace, {DOG: {'jobserver': 'True'}})
+    monkeypatch.delenv('MAKEFLAGS', raising=False)
+    for cpus in [2, 4]:
+        monkeypatch.setattr(os, 'cpu_count', lambda: cpus)
+        assert call_main(*CACHE_ARGS, 'gen') == 0
+    assert len(mock_engine.runs) == 1
+    assert 'DOG_JOBS=2' in mock_engine.runs[0]
+
+
+def test_dog_cpus_do_not_cause_miss(call_main, mock_engine, workspace):
+    for cpuset in ['0', '1']:
+        update_dog_config(workspace, {'resources': {'cpuset': cpuset}})
+        assert call_main(*CACHE_ARGS, 'gen') == 0
+    assert len(mock_engine.runs) == 1
+    assert 'DOG_CPUS=0' in mock_engine.runs[0]
+
+
+def test_dog_ports_do_not_cause_miss(call_main, mock_engine, workspace):
+    update_dog_config(
+        workspace,
+        {
+            DOG: {'allocation-dir': str(workspace / 'allocations')},
+            'ports': {'80': '127.0.0.1:${free-port}'},
+        },
+    )
+    for _ in range(2):
+        assert call_main(*CACHE_ARGS, 'gen') == 0
+    assert len(mock_engine.runs) == 1
+    assert any(arg.startswith('DOG_PORT_80=') for arg in mock_engine.runs[0])
@@ -0,0 +1,139 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from conftest import update_dog_config
+from dog import (
+    ADMISSION_DIR,
+    ADMISSION_SLOTS,
+    ADMISSION_WEIGHT,
+    DOG,
+    VERBOSE,
+    acquire_admission_slots,
+    release_admission_slots,
+    try_lock,
+)
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == 'win32', reason='Admission control uses flock'
+)
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {
+        ADMISSION_DIR: str(tmp_path / 'admission'),
+        ADMISSION_SLOTS: 2,
+        ADMISSION_WEIGHT: 1,
+        VERBOSE: False,
+    }
+
+
+class Waiter(threading.Thread):
+    def __init__(self, config):
+        super().__init__(daemon=True)
+        self.config = config
+        self.slots = None
+
+    def run(self):
+        self.slots = acquire_admission_slots(self.config)
+
+
+def is_waiting(waiter: Waiter) -> bool:
+    waiter.join(0.5)
+    return waiter.is_alive()
+
+
+def test_disabled(config):
+    config[ADMISSION_SLOTS] = 0
+    assert acquire_admission_slots(config) == []
+    assert not os.path.exists(config[ADMISSION_DIR])
+
+
+def test_slots(config, capfd):
+    first = acquire_admission_slots(config)
+    second = acquire_admission_slots(config)
+    assert len(first) == len(second) == 1
+    assert os.get_inheritable(first[0])
+
+    waiter = Waiter(config)
+    waiter.start()
+    assert is_waiting(waiter)
+    release_admission_slots(second)
+    waiter.join(5)
+    assert len(waiter.slots) == 1
+    _, err = capfd.readouterr()
+    assert err == 'Dog waiting for 1 of the 2 slots (0 ahead in the queue)\n'
+    # The queue is empty again
+    assert os.listdir(os.path.join(config[ADMISSION_DIR], 'queue')) == []
+    release_admission_slots(first + waiter.slots)
+
+
+@pytest.mark.parametrize('weight, expected', [(2, 2), (5, 2), (0, 1)])
+def test_weight(config, weight, expected):
+    config[ADMISSION_WEIGHT] = weight
+    slots = acquire_admission_slots(config)
+    assert len(slots) == expected
+    release_admission_slots(slots)
+
+
+def test_fifo(config, capfd):
+    queue_dir = os.path.join(config[ADMISSION_DIR], 'queue')
+    os.makedirs(queue_dir)
+    # Another dog arrived first, and is still waiting
+    other_ticket = os.path.join(queue_dir, '{:017.6f}-other'.format(time.time() - 1))
+    other_fd = try_lock(other_ticket)
+
+    waiter = Waiter(config)
+    waiter.start()
+    assert is_waiting(waiter)
+    _, err = capfd.readouterr()
+    assert '(1 ahead in the queue)' in err
+
+    # The other dog crashed, so its ticket is stale
+    os.close(other_fd)
+    waiter.join(5)
+    assert len(waiter.slots) == 1
+    assert not os.path.exists(other_ticket)
+    release_admission_slots(waiter.slots)
+
+
+def test_crashed_holder(config):
+    config[ADMISSION_SLOTS] = 1
+    slots = acquire_admission_slots(config)
+    waiter = Waiter(config)
+    waiter.start()
+    assert is_waiting(waiter)
+    # The lock is released when the fds are closed, e.g. when the process dies
+    release_admission_slots(slots)
+    waiter.join(5)
+    assert len(waiter.slots) == 1
+    release_admission_slots(waiter.slots)
+
+
+def test_slot_held_by_container(
+    basic_dog_config_with_image, call_main, tmp_path, monkeypatch
+):
+    admission_dir = tmp_path / 'admission'
+    update_dog_config(
+        tmp_path, {DOG: {ADMISSION_SLOTS: '1', ADMISSION_DIR: str(admission_dir)}}
+    )
+    slot = str(admission_dir / 'slot-0')
+    slot_free = []
+
+    def execvp(file, args):
+        fd = try_lock(slot)
+        slot_free.append(fd is not None)
+        release_admission_slots([] if fd is None else [fd])
+
+    monkeypatch.setattr(os, 'execvp', execvp)
+    call_main('true')
+    # Held (and handed over to docker) when dog execs
+    assert slot_free == [False]
+    # and released by dog when it does not exec
+    fd = try_lock(slot)
+    assert fd is not None
+    release_admission_slots([fd])
@@ -0,0 +1,98 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+import dog
+from conftest import update_dog_config
+from dog import CACHES, VOLUMES_FROM
+
+
+class FakeEngine:
+    def __init__(self):
+        self.runs = []
+
+    def run(self, args, **kwargs):
+        if args[-1] == 'true':
+            self.runs.append(args)
+        return subprocess.CompletedProcess(args=args, returncode=0, stdout='')
+
+
+@pytest.fixture
+def fake_engine(monkeypatch, tmp_path, home_temp_dir):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'runtime'))
+    engine = FakeEngine()
+    monkeypatch.setattr(subprocess, 'run', engine.run)
+    return engine
+
+
+def test_bench(basic_dog_config_with_image, call_main, fake_engine, capsys):
+    assert call_main('--bench=3') == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == (
+        'Dog benchmarking "true" in debian:latest (3 iterations, times in ms)'
+    )
+    strategies = [line[:26].strip() for line in lines[2:]]
+    expected = ['docker run --init', 'docker run', 'entrypoint-mode=fast']
+    if sys.platform != 'win32':
+        expected.append('container pool')
+    assert strategies == expected
+    # Each strategy is warmed up once
+    assert len(fake_engine.runs) == 4 * len(expected)
+    assert '--init' in fake_engine.runs[0]
+    assert '--init' not in fake_engine.runs[4]
+    assert all('-i' not in args for args in fake_engine.runs)
+
+
+def test_bench_volumes_from(
+    basic_dog_config_with_image, call_main, tmp_path, fake_engine, monkeypatch, capsys
+):
+    preflights = []
+    monkeypatch.setattr(dog, 'docker_run_volumes_from', preflights.append)
+    update_dog_config(tmp_path, {VOLUMES_FROM: {'tools:1.0': '/opt/tools'}})
+    call_main('--bench=1')
+    assert 'volumes-from pre-flight' in capsys.readouterr().out
+    # Only done by the pre-flight strategy: warm-up and one iteration
+    assert len(preflights) == 2
+
+
+def test_bench_prepares_every_run(
+    basic_dog_config_with_image, call_main, tmp_path, fake_engine, monkeypatch, capsys
+):
+    calls = []
+    monkeypatch.setattr(
+        dog, 'connect_docker_host', lambda config: calls.append('connect') or []
+    )
+    monkeypatch.setattr(
+        dog, 'docker_create_caches', lambda config: calls.append('caches')
+    )
+    monkeypatch.setattr(
+        dog, 'acquire_admission_slots', lambda config: calls.append('acquire') or []
+    )
+    monkeypatch.setattr(
+        dog, 'release_admission_slots', lambda fds: calls.append('release')
+    )
+    update_dog_config(tmp_path, {CACHES: {'ccache': '/ccache'}})
+    call_main('--bench=2')
+    strategies = capsys.readouterr().out.splitlines()[2:]
+    # The warm-up and the iterations of each strategy
+    runs = 3 * len(strategies)
+    assert calls == ['connect', 'caches', 'acquire', 'release'] * runs
+
+
+def test_bench_separate_value(
+    basic_dog_config_with_image, call_main, fake_engine, capsys
+):
+    assert call_main('--bench', '2') == 0
+    assert '(2 iterations, times in ms)' in capsys.readouterr().out
+
+
+def test_bench_timings(
+    basic_dog_config_with_image, call_main, fake_engine, tmp_path, capsys
+):
+    timings_file = tmp_path / 'timings.json'
+    call_main('--timings={}'.format(timings_file), '--bench=3')
+    # The phases of the iterations are not added to those of the dog run
+    names = [phase['name'] for phase in json.loads(timings_file.read_text())['phases']]
+    assert names.count('get_env_config') == 1
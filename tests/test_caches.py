@@ -0,0 +1,178 @@
+import json
+from typing import List, Tuple
+
+import pytest
+
+import dog
+from conftest import MockEngine, update_dog_config
+from dog import (
+    CACHE_MAX_SIZE,
+    CACHES,
+    DOG,
+    VOLUMES,
+    cache_volume_name,
+    format_size,
+    read_cache_index,
+)
+
+
+class VolumeEngine(MockEngine):
+    """Keeps the volumes created and removed by the cache calls."""
+
+    def __init__(self):
+        super().__init__()
+        self.volumes: List[str] = []
+        self.sizes = {}
+        self.in_use: List[str] = []
+
+    def answer(self, args: List[str]) -> Tuple[int, str]:
+        if args[1:3] == ['volume', 'ls']:
+            return 0, '\n'.join(self.volumes)
+        if args[1:3] == ['volume', 'create']:
+            self.volumes.append(args[-1])
+        elif args[1:3] == ['volume', 'rm']:
+            if args[3] in self.in_use:
+                return 1, ''
+            self.volumes.remove(args[3])
+        elif args[1:3] == ['system', 'df']:
+            sizes = [{'Name': name, 'Size': size} for name, size in self.sizes.items()]
+            return 0, json.dumps({'Volumes': sizes})
+        return super().answer(args)
+
+
+@pytest.fixture
+def mock_engine(monkeypatch):
+    return VolumeEngine().install(monkeypatch)
+
+
+@pytest.fixture(autouse=True)
+def cache_home(home_temp_dir, monkeypatch):
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    return home_temp_dir / '.cache' / 'dog'
+
+
+@pytest.fixture
+def caches_config(basic_v2_dog_config_with_image, tmp_path):
+    update_dog_config(
+        tmp_path,
+        {DOG: {'auto-mount': False}, CACHES: {'ccache': '${home}/.ccache'}},
+    )
+
+
+@pytest.fixture
+def read_caches_config(caches_config, monkeypatch, tmp_path):
+    def read(*args):
+        with monkeypatch.context() as m:
+            m.chdir(tmp_path)
+            return dog.read_config(['dog'] + list(args) + ['make'])
+
+    return read
+
+
+def test_caches_are_mounted(read_caches_config, home_temp_dir):
+    config = read_caches_config()
+    volume = cache_volume_name(config, 'ccache')
+    assert volume.startswith('dog-cache-ccache-')
+    assert config[VOLUMES] == {str(home_temp_dir / '.ccache'): volume}
+
+
+def test_cache_volume_name_depends_on_image_and_user(read_caches_config, tmp_path):
+    config = read_caches_config()
+    volume = cache_volume_name(config, 'ccache')
+    config['uid'] = 4242
+    assert cache_volume_name(config, 'ccache') != volume
+    update_dog_config(tmp_path, {DOG: {'image': 'alpine:latest'}})
+    assert cache_volume_name(read_caches_config(), 'ccache') != volume
+
+
+def test_caches_are_created_lazily(read_caches_config, mock_engine, cache_home):
+    config = read_caches_config()
+    volume = cache_volume_name(config, 'ccache')
+
+    dog.docker_create_caches(config)
+    (create,) = mock_engine.calls_of('volume', 'create')
+    assert create[-1] == volume
+    (chown,) = mock_engine.calls_of('run')
+    assert chown[chown.index('--entrypoint') + 1] == 'chown'
+    assert chown[-2:] == ['{}:{}'.format(config['uid'], config['gid']), '/dog-cache']
+    assert volume in read_cache_index()
+
+    # The index is not rewritten for a while
+    mock_engine.calls.clear()
+    index_mtime = (cache_home / 'caches.json').stat().st_mtime_ns
+    dog.docker_create_caches(config)
+    assert len(mock_engine.calls_of('volume', 'ls')) == 1
+    assert mock_engine.calls_of('volume', 'create') == []
+    assert (cache_home / 'caches.json').stat().st_mtime_ns == index_mtime
+
+    # Unless its last use is older than the resolution of the index
+    dog.write_cache_index({volume: 1.0})
+    dog.docker_create_caches(config)
+    assert mock_engine.calls_of('volume', 'create') == []
+    assert read_cache_index()[volume] > 1.0
+
+
+def test_removed_caches_are_created_again(read_caches_config, mock_engine, cache_home):
+    config = read_caches_config()
+    dog.docker_create_caches(config)
+    # Removed behind the back of dog, e.g. by "docker volume prune"
+    mock_engine.volumes.clear()
+    mock_engine.calls.clear()
+    dog.docker_create_caches(config)
+    assert len(mock_engine.calls_of('volume', 'create')) == 1
+    assert len(mock_engine.calls_of('run')) == 1
+
+
+def test_caches_missing_in_index_are_not_created_again(
+    read_caches_config, mock_engine, cache_home
+):
+    config = read_caches_config()
+    # Created before the index was removed
+    mock_engine.volumes = [cache_volume_name(config, 'ccache')]
+    dog.docker_create_caches(config)
+    assert len(mock_engine.calls_of('volume', 'ls')) == 1
+    assert mock_engine.calls_of('volume', 'create') == []
+
+
+def test_cache_stats(caches_config, call_main, mock_engine, capsys):
+    mock_engine.volumes = ['dog-cache-a-1', 'dog-cache-b-2', 'dog-cache-c-3']
+    mock_engine.sizes = {
+        'dog-cache-a-1': '1.5GB',
+        'dog-cache-b-2': '10MB',
+        'dog-cache-c-3': '1MB',
+    }
+    # dog-cache-c-3 is a volume of another user
+    dog.write_cache_index({'dog-cache-a-1': 1.0, 'dog-cache-b-2': 2.0})
+    assert call_main('--cache-stats') == 0
+    out = capsys.readouterr().out
+    assert 'dog-cache-a-1' in out
+    assert '1.4 GiB' in out
+    assert 'in 2 cache volumes' in out
+    assert 'dog-cache-c-3' not in out
+
+
+def test_cache_prune_removes_least_recently_used(
+    caches_config, call_main, mock_engine, tmp_path
+):
+    update_dog_config(tmp_path, {DOG: {CACHE_MAX_SIZE: '100m'}})
+    mock_engine.volumes = ['other', 'old', 'in-use', 'middle', 'new']
+    mock_engine.sizes = {
+        'other': '500m',
+        'old': '50m',
+        'in-use': '50m',
+        'middle': '50m',
+        'new': '50m',
+    }
+    mock_engine.in_use = ['in-use']
+    # The volume of another user is not in the index, so it is left alone
+    dog.write_cache_index({'old': 1.0, 'in-use': 2.0, 'middle': 3.0, 'new': 4.0})
+
+    assert call_main('--cache-prune') == 0
+    assert mock_engine.volumes == ['other', 'in-use', 'new']
+    assert sorted(read_cache_index()) == ['in-use', 'new']
+
+
+def test_format_size():
+    assert format_size(10) == '10 B'
+    assert format_size(2048) == '2.0 KiB'
+    assert format_size(3 * 1024 ** 4) == '3.0 TiB'
@@ -0,0 +1,223 @@
+import os
+import sys
+import time
+from typing import List, Tuple
+
+import pytest
+
+import dog
+from conftest import MockEngine, update_dog_config
+from dog import (
+    DOG,
+    POOL_IDLE_TTL,
+    POOL_MAX_MEMORY,
+    POOL_SIZE,
+    PORTS,
+    docker_pool_exec_args,
+    docker_pool_start_args,
+    parse_size,
+    pool_fingerprint,
+)
+
+pytestmark = pytest.mark.skipif(
+    'win32' in sys.platform, reason='The container pool is not supported on Windows'
+)
+
+
+class PoolEngine(MockEngine):
+    """Answers the docker calls of the pool."""
+
+    def __init__(self):
+        super().__init__()
+        self.pool_names: List[str] = []
+        self.rename_fails: List[str] = []
+        self.mem_usage = ''
+
+    def answer(self, args: List[str]) -> Tuple[int, str]:
+        if args[1:3] == ['container', 'ls']:
+            return 0, '\n'.join(self.pool_names)
+        if args[1] == 'rename' and args[2] in self.rename_fails:
+            return 1, ''
+        if args[1] == 'stats':
+            return 0, self.mem_usage
+        return super().answer(args)
+
+
+@pytest.fixture
+def mock_engine(monkeypatch):
+    return PoolEngine().install(monkeypatch)
+
+
+@pytest.fixture
+def no_fork(monkeypatch):
+    """Run the background refill in-process instead of in a forked child."""
+    refills = []
+    monkeypatch.setattr(
+        dog,
+        'docker_pool_refill_in_background',
+        lambda config, fingerprint: refills.append(fingerprint),
+    )
+    return refills
+
+
+@pytest.fixture(autouse=True)
+def isolated_home(home_temp_dir):
+    return home_temp_dir
+
+
+@pytest.fixture
+def pool_config(basic_dog_config_with_image, tmp_path):
+    update_dog_config(tmp_path, {DOG: {POOL_SIZE: 2}})
+
+
+@pytest.fixture
+def read_pool_config(pool_config, monkeypatch, tmp_path):
+    def read(*args):
+        with monkeypatch.context() as m:
+            m.chdir(tmp_path)
+            return dog.read_config(['dog'] + list(args))
+
+    return read
+
+
+def test_parse_size():
+    assert parse_size('100') == 100
+    assert parse_size('1k') == 1024
+    assert parse_size('12.5MiB') == int(12.5 * 1024 * 1024)
+    assert parse_size(' 2 GB ') == 2 * 1000 ** 3
+    assert parse_size('2GiB') == parse_size('2g') == 2 * 1024 ** 3
+    with pytest.raises(ValueError):
+        parse_size('lots')
+
+
+def test_fingerprint_depends_on_run_params_not_command(read_pool_config, tmp_path):
+    fp_echo = pool_fingerprint(read_pool_config('echo', 'foo'))
+    fp_ls = pool_fingerprint(read_pool_config('ls'))
+    assert fp_echo == fp_ls
+    assert fp_echo != pool_fingerprint(read_pool_config('--as-root', 'ls'))
+
+    update_dog_config(tmp_path, {DOG: {'image': 'alpine:latest'}})
+    assert pool_fingerprint(read_pool_config('ls')) != fp_ls
+
+
+def test_start_args(read_pool_config, tmp_path):
+    update_dog_config(tmp_path, {DOG: {POOL_IDLE_TTL: 42}})
+    config = read_pool_config('-it', 'make')
+    args = docker_pool_start_args(config, 'abcd')
+    assert args[:5] == ['docker', 'run', '--rm', '-d', '--name']
+    assert args[5].startswith('dog-pool-abcd-')
+    assert args[6:8] == ['--label', 'dog.pool=abcd']
+    assert args[-4:-1] == ['debian:latest', 'sh', '-c']
+    assert '[ ! -e /tmp/.dog-pool-claimed ]' in args[-1]
+    assert '[ $i -ge 42 ]' in args[-1]
+    assert '-i' not in args and '-t' not in args
+
+
+def test_exec_args(read_pool_config, tmp_path):
+    config = read_pool_config('-t', 'make', 'all')
+    args = docker_pool_exec_args(config, 'dog-claimed-abcd-1')
+    uid_gid = '{}:{}'.format(config['uid'], config['gid'])
+    assert args[:6] == ['docker', 'exec', '-i', '-t', '-u', uid_gid]
+    assert args[6:8] == ['-w', str(tmp_path)]
+    assert args[-3:] == ['dog-claimed-abcd-1', 'make', 'all']
+    assert '-u' not in docker_pool_exec_args(read_pool_config('--as-root', 'ls'), 'x')
+
+
+def test_pooled_run_claims_container(
+    pool_config, call_main, mock_engine, no_fork, read_pool_config
+):
+    fp = pool_fingerprint(read_pool_config('echo', 'foo'))
+    now = int(time.time())
+    mock_engine.pool_names = [
+        # About to reach its idle TTL, so not claimed
+        'dog-pool-{}-{}-0'.format(fp, now - 590),
+        'dog-pool-{}-{}-1'.format(fp, now),
+        'dog-pool-{}-{}-2'.format(fp, now),
+    ]
+    mock_engine.rename_fails = [mock_engine.pool_names[1]]
+    assert call_main('echo', 'foo') == 0
+
+    renames = mock_engine.calls_of('rename')
+    assert len(renames) == 2
+    claimed = 'dog-claimed-{}-{}'.format(fp, os.getpid())
+    assert renames[-1][2:] == [mock_engine.pool_names[2], claimed]
+    exec_call = mock_engine.calls_of('exec')[0]
+    # The command marks the container as claimed, which stops its idle TTL
+    assert exec_call[-7:] == [
+        claimed,
+        'sh',
+        '-c',
+        ': > /tmp/.dog-pool-claimed; exec "$@"',
+        'sh',
+        'echo',
+        'foo',
+    ]
+    assert mock_engine.popen_calls == [['docker', 'rm', '-f', claimed]]
+    assert no_fork == [fp]
+
+
+def test_empty_pool_runs_cold(
+    pool_config, call_main, mock_engine, no_fork, monkeypatch
+):
+    executed = []
+    monkeypatch.setattr(os, 'execvp', lambda file, args: executed.append(args))
+    call_main('echo', 'foo')
+    assert mock_engine.calls_of('exec') == []
+    assert executed[0][:3] == ['docker', 'run', '--rm']
+    assert len(no_fork) == 1
+
+
+def test_pool_disabled_with_ports(
+    pool_config, call_main, mock_engine, no_fork, monkeypatch, tmp_path
+):
+    update_dog_config(tmp_path, {PORTS: {'80': '8080'}})
+    executed = []
+    monkeypatch.setattr(os, 'execvp', lambda file, args: executed.append(args))
+    call_main('echo', 'foo')
+    assert mock_engine.calls == []
+    assert no_fork == []
+    assert len(executed) == 1
+
+
+def test_refill(read_pool_config, mock_engine, tmp_path):
+    config = read_pool_config('echo')
+    mock_engine.pool_names = ['dog-pool-abcd-1']
+    dog.docker_pool_refill(config, 'abcd')
+    started = mock_engine.calls_of('run')
+    assert len(started) == 1
+    assert started[0][3] == '-d'
+
+
+def test_refill_is_locked(read_pool_config, mock_engine, monkeypatch):
+    import fcntl
+
+    config = read_pool_config('echo')
+    lock_path = dog.get_runtime_dir() / 'pool-abcd.lock'
+    locked = []
+
+    def container_names(config, fingerprint):
+        with lock_path.open('w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked.append(False)
+            except OSError:
+                locked.append(True)
+        return []
+
+    monkeypatch.setattr(dog, 'docker_pool_container_names', container_names)
+    dog.docker_pool_refill(config, 'abcd')
+    assert locked == [True]
+    assert len(mock_engine.calls_of('run')) == 2
+
+
+def test_refill_respects_memory_cap(read_pool_config, mock_engine, tmp_path):
+    update_dog_config(tmp_path, {DOG: {POOL_SIZE: 4, POOL_MAX_MEMORY: '100m'}})
+    config = read_pool_config('echo')
+    mock_engine.pool_names = ['dog-pool-abcd-1']
+    mock_engine.mem_usage = '60MiB / 7.6GiB\n50MiB / 7.6GiB'
+    dog.docker_pool_refill(config, 'abcd')
+    assert mock_engine.calls_of('run') == []
+
+    mock_engine.mem_usage = '20MiB / 7.6GiB'
+    dog.docker_pool_refill(config, 'abcd')
+    assert len(mock_engine.calls_of('run')) == 3
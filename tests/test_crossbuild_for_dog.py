@@ -4,9 +4,10 @@ from pathlib import Path
 
 import pytest
 
-from conftest import DOG_PYTHON_UNDER_TEST
+from conftest import DOG_PYTHON_UNDER_TEST, needs_docker
 
 RESOURCES = Path(__file__).parent / 'resources' / 'crossbuild-for-dog'
+IMAGE = 'rtol/crossbuild-for-dog'
 
 
 @pytest.fixture
@@ -22,14 +23,36 @@ def call_shell(my_dog, monkeypatch):
     return call
 
 
+@pytest.fixture
+def call_fake_shell(call_shell, home_temp_dir, fake_engine, monkeypatch):
+    # The cross compilers are in the image, so make is not run on this host
+    monkeypatch.setenv('FAKE_ENGINE_EXECUTE', '0')
+    return call_shell
+
+
+@needs_docker
 def test_pull_crossbuild_for_dog(call_shell, capstrip, dog_env):
     call_shell(f'{dog_env} --pull env')
     print(capstrip.get())
 
 
+@needs_docker
 def test_make_creates_arm_targets(call_shell, capstrip, dog_env):
     call_shell(f'{dog_env} make')
     stdout, stderr = capstrip.get()
     assert stderr == ''
     assert 'CROSS_TRIPLE: aarch64-linux-gnu' in stdout
     assert 'ARM aarch64' in stdout
+
+
+def test_pull_on_fake_engine(call_fake_shell, dog_env, fake_engine):
+    assert call_fake_shell(f'{dog_env} --pull env').returncode == 0
+    assert fake_engine.calls()[0] == ['pull', IMAGE]
+
+
+def test_make_runs_in_image(call_fake_shell, dog_env, fake_engine):
+    assert call_fake_shell(f'{dog_env} make').returncode == 0
+    [call] = fake_engine.calls()
+    assert call[:2] == ['run', '--rm']
+    assert call[call.index('-w') + 1] == str(RESOURCES)
+    assert call[-2:] == [IMAGE, 'make']
@@ -1,4 +1,5 @@
 import itertools
+import json
 import os
 import platform
 import subprocess
@@ -85,6 +86,7 @@ def mock_getuid(monkeypatch, tmp_path):
     uid = 1000 if is_windows() else 1122
     if not is_windows():
         monkeypatch.setattr(os, 'getuid', lambda: uid)
+        monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'runtime'))
 
 
 @pytest.fixture(autouse=True)
@@ -719,3 +721,166 @@ def test_init(
     args_left = assert_init(args_left, init)
     args_left = std_assert_env_params(home_temp_dir, args_left)
     assert args_left == []
+
+
+def assert_fast_entrypoint_params(
+    run_args: List[str], home_temp_dir: Path, as_root: bool
+) -> List[str]:
+    env_params, args_left = split_single_cmdline_param(
+        '-e', run_args, include_value=True
+    )
+    assert env_params[:2] == ['-e', 'DOG_ENTRYPOINT_MODE=fast']
+    user_params, args_left = split_single_cmdline_param(
+        '--user', args_left, include_value=True
+    )
+    if as_root:
+        assert user_params == []
+        return args_left + env_params[2:]
+    assert user_params == ['--user', '1122:5566']
+    assert env_params[2:4] == ['-e', f'HOME={home_temp_dir}']
+    return args_left + env_params[4:]
+
+
+@pytest.mark.skipif(is_windows(), reason='Uses uid and gid of a unix user')
+@pytest.mark.parametrize('as_root', [False, True])
+def test_entrypoint_mode_fast(
+    basic_dog_config_with_image,
+    call_main,
+    tmp_path,
+    mock_execvp,
+    home_temp_dir,
+    monkeypatch,
+    as_root: bool,
+):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'runtime'))
+    update_dog_config(tmp_path, {DOG: {'entrypoint-mode': 'fast'}})
+    if as_root:
+        call_main('--as-root', 'echo', 'foo')
+    else:
+        call_main('echo', 'foo')
+    args_left = assert_docker_std_cmdline(mock_execvp)
+    args_left = assert_docker_image_and_cmd_inside_docker(
+        args_left, 'debian:latest', ['echo', 'foo']
+    )
+    args_left = assert_workdir_param(args_left, get_workdir(tmp_path))
+    args_left = std_assert_hostname_param(args_left)
+    runtime_dir = tmp_path / 'runtime' / 'dog'
+    (passwd,) = runtime_dir.glob('passwd-*')
+    (group,) = runtime_dir.glob('group-*')
+    mount_point = str(find_mount_point(tmp_path))
+    args_left = assert_volume_params(
+        args_left,
+        [
+            (mount_point, mount_point),
+            ('/etc/passwd:ro', str(passwd)),
+            ('/etc/group:ro', str(group)),
+        ],
+    )
+    args_left = std_assert_interactive(args_left)
+    args_left = std_assert_init(args_left)
+    args_left = assert_fast_entrypoint_params(args_left, home_temp_dir, as_root)
+    args_left = assert_env_params(
+        args_left,
+        [
+            'DOG_UID=1122',
+            'DOG_GID=5566',
+            'DOG_USER=dog_test_user',
+            'DOG_GROUP=test_group',
+            f'DOG_HOME={home_temp_dir}',
+            f'DOG_AS_ROOT={as_root}',
+            f'DOG_VERSION={ACTUAL_DOG_VERSION}',
+        ],
+    )
+    tmpfs_params, args_left = split_single_cmdline_param(
+        '--tmpfs', args_left, include_value=True
+    )
+    home_is_mounted = str(home_temp_dir).startswith(mount_point + '/')
+    if as_root or home_is_mounted:
+        assert tmpfs_params == []
+    else:
+        assert tmpfs_params == [
+            '--tmpfs',
+            f'{home_temp_dir}:exec,mode=0755,uid=1122,gid=5566',
+        ]
+    assert args_left == []
+
+    assert (
+        f'dog_test_user:x:1122:5566:Self:{home_temp_dir}:/bin/sh'
+        in passwd.read_text().splitlines()
+    )
+    assert 'test_group:x:5566:dog_test_user' in group.read_text().splitlines()
+
+
+def test_entrypoint_mode_unknown(
+    basic_dog_config_with_image, call_main, tmp_path, mock_execvp, capsys
+):
+    update_dog_config(tmp_path, {DOG: {'entrypoint-mode': 'turbo'}})
+    with pytest.raises(SystemExit):
+        call_main('echo', 'foo')
+    captured = capsys.readouterr()
+    assert 'entrypoint-mode must be either "legacy" or "fast"' in captured.err
+
+
+@pytest.mark.skipif(is_windows(), reason='File permissions are unix specific')
+def test_runtime_dir_in_tmp(monkeypatch, tmp_path):
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    monkeypatch.setattr(dog.tempfile, 'gettempdir', lambda: str(tmp_path))
+    monkeypatch.setattr(os, 'getuid', lambda: os.stat(tmp_path).st_uid)
+    runtime_dir = dog.get_runtime_dir()
+    assert runtime_dir == tmp_path / f'dog-{os.getuid()}'
+    assert runtime_dir.stat().st_mode & 0o777 == 0o700
+    assert dog.get_runtime_dir() == runtime_dir
+
+
+@pytest.mark.skipif(is_windows(), reason='File permissions are unix specific')
+@pytest.mark.parametrize('problem', ['mode', 'owner', 'symlink'])
+def test_runtime_dir_in_tmp_not_private(monkeypatch, tmp_path, capsys, problem):
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    monkeypatch.setattr(dog.tempfile, 'gettempdir', lambda: str(tmp_path))
+    owner = os.stat(tmp_path).st_uid
+    uid = owner + 1 if problem == 'owner' else owner
+    monkeypatch.setattr(os, 'getuid', lambda: uid)
+    runtime_dir = tmp_path / f'dog-{uid}'
+    if problem == 'symlink':
+        (tmp_path / 'elsewhere').mkdir(mode=0o700)
+        runtime_dir.symlink_to(tmp_path / 'elsewhere')
+    else:
+        runtime_dir.mkdir()
+        runtime_dir.chmod(0o755 if problem == 'mode' else 0o700)
+    with pytest.raises(SystemExit):
+        dog.get_runtime_dir()
+    assert 'must be a directory owned by you with mode 0700' in capsys.readouterr().err
+
+
+@pytest.mark.skipif(is_windows(), reason='File permissions are unix specific')
+def test_env_file(
+    basic_dog_config_with_image, call_main, tmp_path, home_temp_dir, monkeypatch
+):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'runtime'))
+    monkeypatch.setenv('MY_SECRET', 'hunter2')
+    monkeypatch.setenv('MY_MULTILINE', 'line1\nline2')
+    update_dog_config(
+        tmp_path,
+        {DOG: {'env-file': True, 'user-env-vars': 'MY_SECRET,MY_MULTILINE'}},
+    )
+    env_files = {}
+
+    def mock_run(args):
+        path = args[args.index('--env-file') + 1]
+        env_files[path] = (os.stat(path).st_mode & 0o777, Path(path).read_text())
+        return subprocess.CompletedProcess(args=args, returncode=0)
+
+    monkeypatch.setattr(subprocess, 'run', mock_run)
+    call_main('echo', 'foo')
+
+    ((path, (mode, contents)),) = env_files.items()
+    assert not Path(path).exists()
+    assert Path(path).parent == tmp_path / 'runtime' / 'dog'
+    assert mode == 0o600
+    lines = contents.splitlines()
+    assert 'DOG_UID=1122' in lines
+    assert f'DOG_HOME={home_temp_dir}' in lines
+    assert 'MY_SECRET=hunter2' in lines
+    assert not any(line.startswith('MY_MULTILINE') for line in lines)
+    (dog_json,) = [line for line in lines if line.startswith('DOG_JSON=')]
+    assert json.loads(dog_json[len('DOG_JSON=') :])['uid'] == 1122
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+from conftest import DOG_PYTHON_UNDER_TEST, is_windows, update_dog_config
+
+PRINT_ENV = 'import os; print("ran with", os.environ["USER_ENV"])'
+
+
+@pytest.fixture
+def dog_config(tmp_path, home_temp_dir, monkeypatch):
+    monkeypatch.setenv('USER_ENV', 'fake-engine')
+    update_dog_config(
+        tmp_path,
+        {
+            'dog': {
+                'dog-config-file-version': '2',
+                'image': 'debian:latest',
+                'user-env-vars': 'USER_ENV',
+            }
+        },
+    )
+
+
+def test_sanity_check(call_dog, tmp_path, dog_config, fake_engine, monkeypatch):
+    update_dog_config(tmp_path, {'dog': {'docker-minimum-version': '19.3.0'}})
+    monkeypatch.setenv('FAKE_ENGINE_VERSION', '19.3.0')
+    assert call_dog('--sanity-check') == 0
+    assert fake_engine.calls() == [['--version']]
+    monkeypatch.setenv('FAKE_ENGINE_VERSION', '1.2.3')
+    assert call_dog('--sanity-check') != 0
+
+
+def test_launch(call_dog, capfd, dog_config, fake_engine):
+    assert call_dog(DOG_PYTHON_UNDER_TEST, '-c', PRINT_ENV) == 0
+    stdout, _ = capfd.readouterr()
+    assert 'ran with fake-engine' in stdout
+    [call] = fake_engine.calls()
+    assert call[:2] == ['run', '--rm']
+    assert call[-3:] == [DOG_PYTHON_UNDER_TEST, '-c', PRINT_ENV]
+    assert fake_engine.state()['containers'] == {}
+
+
+def test_launch_env_file(call_dog, capfd, tmp_path, dog_config, fake_engine):
+    update_dog_config(tmp_path, {'dog': {'env-file': 'True'}})
+    assert call_dog(DOG_PYTHON_UNDER_TEST, '-c', PRINT_ENV) == 0
+    stdout, _ = capfd.readouterr()
+    assert 'ran with fake-engine' in stdout
+    assert '--env-file' in fake_engine.calls()[0]
+
+
+@pytest.mark.parametrize('exit_code', [0, 1, 42])
+def test_exit_code(call_dog, dog_config, fake_engine, exit_code):
+    code = f'import sys; sys.exit({exit_code})'
+    assert call_dog(DOG_PYTHON_UNDER_TEST, '-c', code) == exit_code
+
+
+def test_pull(call_dog, dog_config, fake_engine):
+    assert call_dog('--pull', DOG_PYTHON_UNDER_TEST, '-c', 'pass') == 0
+    calls = fake_engine.calls()
+    assert calls[0] == ['pull', 'debian:latest']
+    assert calls[1][0] == 'run'
+    assert 'debian:latest' in fake_engine.state()['images']
+
+
+def test_pull_failure(call_dog, dog_config, fake_engine, monkeypatch):
+    monkeypatch.setenv('FAKE_ENGINE_FAIL', 'pull=3')
+    assert call_dog('--pull', DOG_PYTHON_UNDER_TEST, '-c', 'pass') == 3
+    assert [call[0] for call in fake_engine.calls()] == ['pull']
+
+
+def test_volumes_from(call_dog, tmp_path, dog_config, fake_engine):
+    update_dog_config(
+        tmp_path,
+        {
+            'dog': {'volumes-from-silent': 'True'},
+            'volumes-from': {'tool1': 'tool1:latest', 'tool2:ro': 'tool2:latest'},
+        },
+    )
+    assert call_dog(DOG_PYTHON_UNDER_TEST, '-c', 'pass') == 0
+    assert call_dog(DOG_PYTHON_UNDER_TEST, '-c', 'pass') == 0
+    containers = fake_engine.state()['containers']
+    assert sorted(containers) == ['tool1', 'tool2']
+    assert containers['tool1']['image'] == 'tool1:latest'
+    run_call = fake_engine.calls()[-1]
+    assert run_call[run_call.index('--volumes-from') + 1] == 'tool1'
+
+
+@pytest.mark.skipif(is_windows(), reason='The container pool is not used on Windows')
+def test_pool(call_dog, capfd, tmp_path, dog_config, fake_engine):
+    update_dog_config(tmp_path, {'dog': {'pool-size': '1'}})
+    assert call_dog(DOG_PYTHON_UNDER_TEST, '-c', PRINT_ENV) == 0
+    deadline = time.monotonic() + 10
+    while not fake_engine.state()['containers'] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    [pooled] = fake_engine.state()['containers']
+    assert pooled.startswith('dog-pool-')
+
+    assert call_dog(DOG_PYTHON_UNDER_TEST, '-c', PRINT_ENV) == 0
+    stdout, _ = capfd.readouterr()
+    assert stdout.count('ran with fake-engine') == 2
+    commands = [call[0] for call in fake_engine.calls()]
+    assert 'rename' in commands
+    assert 'exec' in commands
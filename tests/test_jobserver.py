@@ -0,0 +1,147 @@
+import os
+import signal
+import subprocess
+import sys
+
+import pytest
+
+from conftest import update_dog_config
+from dog import DOG, JOBSERVER, Jobserver
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith('linux'), reason='Uses a pipe jobserver via /proc'
+)
+
+
+@pytest.fixture
+def make_pipe():
+    """A jobserver pipe as created by make, holding three tokens."""
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'abc')
+    yield read_fd, write_fd
+    os.close(read_fd)
+    os.close(write_fd)
+
+
+def available_tokens(read_fd: int) -> bytes:
+    os.set_blocking(read_fd, False)
+    try:
+        return os.read(read_fd, 100)
+    except BlockingIOError:
+        return b''
+    finally:
+        os.set_blocking(read_fd, True)
+
+
+@pytest.mark.parametrize('makeflags', ['', ' -j4', 'k -- X=--jobserver-auth'])
+def test_no_jobserver(makeflags):
+    assert Jobserver.from_makeflags(makeflags) is None
+
+
+def test_closed_pipe():
+    read_fd, write_fd = os.pipe()
+    os.close(read_fd)
+    os.close(write_fd)
+    makeflags = ' -j4 --jobserver-auth={},{}'.format(read_fd, write_fd)
+    assert Jobserver.from_makeflags(makeflags) is None
+
+
+@pytest.mark.parametrize('option', ['--jobserver-auth', '--jobserver-fds'])
+def test_pipe(make_pipe, option):
+    read_fd, write_fd = make_pipe
+    makeflags = ' -j4 {}={},{}'.format(option, read_fd, write_fd)
+    jobserver = Jobserver.from_makeflags(makeflags)
+    assert jobserver.acquire(2) == 2
+    assert jobserver.tokens == b'ab'
+    jobserver.release()
+    assert available_tokens(read_fd) == b'cab'
+
+
+def test_pipe_does_not_wait(make_pipe):
+    read_fd, _ = make_pipe
+    jobserver = Jobserver.from_makeflags('--jobserver-auth={},{}'.format(*make_pipe))
+    assert jobserver.acquire(10) == 3
+    # make itself still reads the pipe in blocking mode
+    assert os.get_blocking(read_fd)
+    jobserver.release()
+    assert available_tokens(read_fd) == b'abc'
+
+
+def test_fifo(tmp_path):
+    fifo = tmp_path / 'GMfifo1234'
+    os.mkfifo(str(fifo))
+    make_fd = os.open(str(fifo), os.O_RDWR)
+    try:
+        os.write(make_fd, b'++')
+        # Only the last jobserver option counts (the one of the innermost make)
+        makeflags = ' -j8 --jobserver-auth=3,4 --jobserver-auth=fifo:{}'.format(fifo)
+        jobserver = Jobserver.from_makeflags(makeflags)
+        assert jobserver.acquire(7) == 2
+        jobserver.release()
+        assert available_tokens(make_fd) == b'++'
+    finally:
+        os.close(make_fd)
+
+
+@pytest.fixture
+def engine(basic_dog_config_with_image, tmp_path, monkeypatch):
+    update_dog_config(tmp_path, {DOG: {JOBSERVER: 'True'}})
+    runs = []
+
+    def run(args, **kwargs):
+        runs.append(args)
+        return subprocess.CompletedProcess(args=args, returncode=0)
+
+    monkeypatch.setattr(subprocess, 'run', run)
+    monkeypatch.setattr(os, 'execvp', lambda file, args: runs.append(args))
+    monkeypatch.setattr(os, 'cpu_count', lambda: 3)
+    return runs
+
+
+def test_dog_jobs_under_make(call_main, engine, make_pipe, monkeypatch):
+    read_fd, _ = make_pipe
+    monkeypatch.setenv('MAKEFLAGS', ' -j4 --jobserver-auth={},{}'.format(*make_pipe))
+    engine_tokens = []
+    monkeypatch.setattr(
+        subprocess,
+        'run',
+        lambda args, **kwargs: engine_tokens.append(available_tokens(read_fd))
+        or subprocess.CompletedProcess(args=args, returncode=0),
+    )
+    assert call_main('make', 'all') == 0
+    # At most cpu_count - 1 extra tokens are held while the container runs
+    assert engine_tokens == [b'c']
+    assert available_tokens(read_fd) == b'ab'
+
+
+def test_dog_jobs(call_main, engine, make_pipe, monkeypatch):
+    monkeypatch.setenv('MAKEFLAGS', ' -j4 --jobserver-auth={},{}'.format(*make_pipe))
+    assert call_main('make', 'all') == 0
+    assert 'DOG_JOBS=3' in engine[0]
+
+
+def test_dog_jobs_without_make(call_main, engine, monkeypatch):
+    monkeypatch.delenv('MAKEFLAGS', raising=False)
+    assert call_main('make', 'all') == 0
+    assert 'DOG_JOBS=3' in engine[0]
+
+
+def test_dog_jobs_unusable_jobserver(call_main, engine, monkeypatch):
+    monkeypatch.setenv('MAKEFLAGS', ' -j4 --jobserver-auth=1000,1001')
+    assert call_main('make', 'all') == 0
+    assert 'DOG_JOBS=1' in engine[0]
+
+
+def test_tokens_given_back_on_sigterm(call_main, engine, make_pipe, monkeypatch):
+    read_fd, _ = make_pipe
+    monkeypatch.setenv('MAKEFLAGS', ' -j4 --jobserver-auth={},{}'.format(*make_pipe))
+
+    def terminated(args, **kwargs):
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    monkeypatch.setattr(subprocess, 'run', terminated)
+    with pytest.raises(SystemExit) as e:
+        call_main('make', 'all')
+    assert e.value.code == 128 + signal.SIGTERM
+    assert available_tokens(read_fd) == b'cab'
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
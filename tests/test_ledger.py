@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+from conftest import update_dog_config
+from dog import (
+    DOG,
+    LEDGER_FILE,
+    LEDGER_SIZE,
+    LEDGER_SLOT_SIZE,
+    encode_ledger_slot,
+    get_cache_dir,
+    percentile,
+    read_ledger,
+)
+
+
+@pytest.fixture
+def mock_execvp(monkeypatch):
+    calls = []
+    monkeypatch.setattr(os, 'execvp', lambda file, args: calls.append(args))
+    return calls
+
+
+@pytest.fixture
+def ledger_config(basic_dog_config_with_image, tmp_path, home_temp_dir, monkeypatch):
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    update_dog_config(tmp_path, {DOG: {LEDGER_SIZE: 3}})
+
+
+def test_ledger_is_a_ring_buffer(ledger_config, call_main, tmp_path, mock_execvp):
+    for i in range(5):
+        call_main('echo', str(i), 'and more')
+    ledger_file = get_cache_dir() / LEDGER_FILE
+    assert ledger_file.stat().st_size == 4 * LEDGER_SLOT_SIZE
+
+    entries = read_ledger(ledger_file)
+    assert sorted(entry['cmd'] for entry in entries) == ['echo 2', 'echo 3', 'echo 4']
+    entry = entries[0]
+    assert entry['img'] == 'debian:latest'
+    assert entry['ws'] == str(tmp_path)
+    assert entry['ovh'] >= 0
+    assert 'dur' not in entry
+    assert len(entry['ph']) == 3
+    assert 'read_config' not in [name for name, _ in entry['ph']]
+
+    # Resizing starts a new ledger
+    update_dog_config(tmp_path, {DOG: {LEDGER_SIZE: 10}})
+    call_main('echo', 'resized')
+    assert [entry['cmd'] for entry in read_ledger(ledger_file)] == ['echo resized']
+
+
+def test_long_entries_fit_in_a_slot():
+    entry = {
+        't': 1700000000,
+        'ws': '/' + 'w' * 300,
+        'img': 'registry.example.com/' + 'i' * 500,
+        'cmd': 'make all',
+        'ovh': 0.1234,
+        'dur': 1.5,
+        'rc': 0,
+        'ph': [['handle_volumes', 0.01]] * 3,
+    }
+    slot = encode_ledger_slot(entry)
+    assert len(slot) == LEDGER_SLOT_SIZE
+    # Whole fields are left out, so the entry can still be read
+    decoded = json.loads(slot.decode())
+    assert decoded == dict(
+        (key, value) for key, value in entry.items() if key not in ('ph', 'ws', 'img')
+    )
+    assert encode_ledger_slot(dict(entry, ws='/w', img='i')).startswith(
+        b'{"t":1700000000,"ws":"/w","img":"i"'
+    )
+
+
+def test_stats(ledger_config, call_main, mock_execvp, capsys):
+    call_main('--stats')
+    assert 'No runs recorded' in capsys.readouterr().out
+
+    for _ in range(2):
+        call_main('make', 'all')
+    call_main('ls')
+    capsys.readouterr()
+    assert call_main('--stats') == 0
+    out = capsys.readouterr().out
+    assert 'Dog runs recorded since' in out
+    assert out.count('debian:latest') == 1
+    lines = out.splitlines()
+    commands = lines[lines.index('Most frequent commands:') + 2 :]
+    assert commands[0].split() == ['make', 'all', '2', '0']
+    assert 'Candidates for pool-size' in out
+
+
+def test_percentile():
+    values = list(range(1, 21))
+    assert percentile(values, 50) == 10
+    assert percentile(values, 95) == 19
+    assert percentile([7], 95) == 7
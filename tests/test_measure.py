@@ -0,0 +1,84 @@
+import json
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import dog
+
+CONTAINER_ID = 'f00d' * 16
+
+
+class FakeContainer:
+    """Stand-in for subprocess.Popen of "docker run" with a cgroup v2 directory."""
+
+    def __init__(self, cgroup_root: Path, returncode: int = 0):
+        self.cgroup = cgroup_root / 'system.slice' / f'docker-{CONTAINER_ID}.scope'
+        self.returncode = returncode
+        self.args = None
+        self.polls = 0
+
+    def popen(self, args):
+        self.args = args
+        Path(args[args.index('--cidfile') + 1]).write_text(CONTAINER_ID)
+        self.cgroup.mkdir(parents=True)
+        self.write_stats(usage=1000, memory=200)
+        return self
+
+    def write_stats(self, usage: int, memory: int):
+        (self.cgroup / 'cpu.stat').write_text(
+            f'usage_usec {usage}\nuser_usec {usage // 2}\nsystem_usec {usage // 2}\n'
+        )
+        (self.cgroup / 'memory.current').write_text(f'{memory}\n')
+        (self.cgroup / 'io.stat').write_text(
+            '8:0 rbytes=1024 wbytes=2048 rios=1 wios=2\n8:16 rbytes=1024 wbytes=0\n'
+        )
+
+    def wait(self, timeout=None):
+        self.polls += 1
+        if self.polls == 2:
+            self.write_stats(usage=2500000, memory=3 * 1024 * 1024)
+        elif self.polls == 3:
+            self.write_stats(usage=3000000, memory=1024)
+        if self.polls < 4:
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+
+@pytest.fixture
+def fake_container(tmp_path, monkeypatch):
+    container = FakeContainer(tmp_path / 'cgroup', returncode=3)
+    monkeypatch.setattr(dog, 'CGROUP_ROOT', str(tmp_path / 'cgroup'))
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'runtime'))
+    monkeypatch.setattr(subprocess, 'Popen', container.popen)
+    return container
+
+
+def test_measure_json(
+    basic_dog_config_with_image, call_main, tmp_path, home_temp_dir, fake_container
+):
+    measure_file = tmp_path / 'measure.json'
+    assert call_main(f'--measure={measure_file}', 'make') == 3
+    assert fake_container.args[-2:] == ['debian:latest', 'make']
+    assert list((tmp_path / 'runtime' / 'dog').glob('measure-*')) == []
+
+    measurements = json.loads(measure_file.read_text())
+    assert measurements['exit_code'] == 3
+    assert measurements['cgroup'] == str(fake_container.cgroup)
+    assert measurements['cpu_seconds'] == 3.0
+    assert measurements['user_seconds'] == 1.5
+    assert measurements['memory_peak_bytes'] == 3 * 1024 * 1024
+    assert measurements['io_read_bytes'] == 2048
+    assert measurements['io_write_bytes'] == 2048
+    assert measurements['wall_seconds'] >= 0
+    assert 0 <= measurements['overhead_seconds'] < 10
+
+
+def test_measure_human(
+    basic_dog_config_with_image, call_main, home_temp_dir, fake_container, capsys
+):
+    call_main('--measure', 'make')
+    err = capsys.readouterr().err
+    assert 'Dog measure: cpu 3.00 s (user 1.50 s, system 1.50 s)' in err
+    assert 'Dog measure: peak memory 3.0 MiB' in err
+    assert 'Dog measure: block io read 2.0 KiB, written 2.0 KiB' in err
@@ -0,0 +1,59 @@
+import os
+import subprocess
+
+import pytest
+
+from conftest import update_dog_config
+from dog import DOG, ENV_FILE, METRICS_FILE
+
+
+@pytest.fixture
+def mock_execvp(monkeypatch):
+    calls = []
+    monkeypatch.setattr(os, 'execvp', lambda file, args: calls.append(args))
+    return calls
+
+
+def metric_lines(metrics_file) -> dict:
+    samples = {}
+    for line in metrics_file.read_text().splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = value
+    return samples
+
+
+def test_metrics(
+    basic_dog_config_with_image,
+    call_main,
+    tmp_path,
+    home_temp_dir,
+    monkeypatch,
+    mock_execvp,
+):
+    metrics_file = tmp_path / 'dog.prom'
+    update_dog_config(tmp_path, {DOG: {METRICS_FILE: str(metrics_file)}})
+    call_main('echo', 'foo')
+    call_main('echo', 'foo')
+    samples = metric_lines(metrics_file)
+    assert samples['dog_invocations_total{image="debian:latest"}'] == '2'
+    assert samples['dog_overhead_seconds_count{image="debian:latest"}'] == '2'
+    inf_bucket = 'dog_overhead_seconds_bucket{image="debian:latest",le="+Inf"}'
+    assert samples[inf_bucket] == '2'
+    assert not any(name.startswith('dog_container') for name in samples)
+    assert '# TYPE dog_overhead_seconds histogram' in metrics_file.read_text()
+
+    # Without exec dog also knows how the container ended
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'runtime'))
+    update_dog_config(tmp_path, {DOG: {ENV_FILE: True}})
+    monkeypatch.setattr(
+        subprocess,
+        'run',
+        lambda args: subprocess.CompletedProcess(args=args, returncode=3),
+    )
+    call_main('false')
+    samples = metric_lines(metrics_file)
+    assert samples['dog_invocations_total{image="debian:latest"}'] == '3'
+    assert samples['dog_container_exits_total{image="debian:latest",status="3"}'] == '1'
+    assert samples['dog_container_run_seconds_count{image="debian:latest"}'] == '1'
+    assert float(samples['dog_container_run_seconds_sum{image="debian:latest"}']) >= 0
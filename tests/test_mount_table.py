@@ -0,0 +1,158 @@
+from pathlib import Path
+
+import pytest
+
+import dog
+from conftest import is_windows, update_dog_config
+from dog import AUTO_MOUNT, DOG, VOLUMES, MountTable, find_mount_point, read_config
+
+MOUNTINFO = Path(__file__).parent / 'resources' / 'mountinfo'
+
+
+@pytest.fixture
+def workstation() -> MountTable:
+    return MountTable.from_mountinfo(str(MOUNTINFO / 'workstation'))
+
+
+@pytest.mark.parametrize(
+    'path,mount_point',
+    [
+        ('/', '/'),
+        ('/usr/bin', '/'),
+        ('/home', '/home'),
+        ('/home/', '/home'),
+        ('/home/jdoe', '/home'),
+        ('/home/jdoe/projects', '/home/jdoe/projects'),
+        ('/home/jdoe/projects/dog/src', '/home/jdoe/projects'),
+        ('/home/jdoe/projectsX', '/home'),
+        ('/home/jdoe/My Drive/doc', '/home/jdoe/My Drive'),
+        ('/net/fileserver/export', '/net'),
+        ('/home/jdoe/../../tmp/x', '/tmp'),
+    ],
+)
+def test_find(workstation, path: str, mount_point: str):
+    assert workstation.find(path) == mount_point
+
+
+def test_container_mountinfo():
+    table = MountTable.from_mountinfo(str(MOUNTINFO / 'container'))
+    assert table.find('/src/dog') == '/src'
+    assert table.find('/home/jdoe/src') == '/'
+
+
+def test_find_mount_point(workstation):
+    assert find_mount_point(Path('/home/jdoe/projects/a'), workstation) == Path(
+        '/home/jdoe/projects'
+    )
+    assert find_mount_point(Path('/home/jdoe'), workstation) == Path('/home')
+    # Paths on the root file system use the top-level directory
+    assert find_mount_point(Path('/opt/src/dog'), workstation) == Path('/opt')
+    assert find_mount_point(Path('/'), workstation) == Path('/')
+
+
+@pytest.mark.skipif(is_windows(), reason='Auto-mount works differently on Windows')
+def test_find_mount_point_without_mountinfo(monkeypatch, tmp_path):
+    monkeypatch.setattr(dog, 'get_mount_table', lambda: None)
+    expected = tmp_path
+    while not expected.is_mount() and str(expected.parent) != expected.root:
+        expected = expected.parent
+    assert find_mount_point(tmp_path) == expected
+
+
+def test_missing_mountinfo():
+    assert dog.get_mount_table('/this/does/not/exist') is None
+
+
+@pytest.mark.skipif(is_windows(), reason='Auto-mount works differently on Windows')
+def test_volumes_covered_by_auto_mount(
+    basic_v2_dog_config_with_image,
+    home_temp_dir,
+    tmp_path,
+    monkeypatch,
+    my_dog,
+    workstation,
+):
+    monkeypatch.setattr(dog, 'get_mount_table', lambda: workstation)
+    monkeypatch.setattr(Path, 'cwd', lambda: Path('/home/jdoe/work'))
+    monkeypatch.setattr(dog, 'find_dog_config', lambda: tmp_path / 'dog.config')
+    update_dog_config(
+        tmp_path,
+        {
+            VOLUMES: {
+                'same': '/home/jdoe/tools:/home/jdoe/tools',
+                'nested': '/home/jdoe/projects:/home/jdoe/projects',
+                'moved': '/home/jdoe/other:/other',
+                'ro': '/home/jdoe/ro:/home/jdoe/ro:ro',
+                'outside': '/opt/tools:/opt/tools',
+            }
+        },
+    )
+    config = read_config([str(my_dog), 'true'])
+    assert config[VOLUMES] == {
+        '/home': '/home',
+        '/other': '/home/jdoe/other',
+        '/home/jdoe/ro:ro': '/home/jdoe/ro',
+        '/opt/tools': '/opt/tools',
+    }
+
+    update_dog_config(tmp_path, {DOG: {AUTO_MOUNT: False}})
+    config = read_config([str(my_dog), 'true'])
+    assert '/home/jdoe/tools' in config[VOLUMES]
+
+
+@pytest.mark.skipif(is_windows(), reason='Auto-mount works differently on Windows')
+@pytest.mark.parametrize('vcs', [True, False])
+def test_auto_mount_workspace(
+    basic_v2_dog_config_with_image, home_temp_dir, tmp_path, monkeypatch, my_dog, vcs
+):
+    repo = tmp_path / 'repo'
+    project = repo / 'project'
+    cwd = project / 'src'
+    cwd.mkdir(parents=True)
+    if vcs:
+        (repo / '.git').mkdir()
+    (tmp_path / 'dog.config').rename(project / 'dog.config')
+    monkeypatch.chdir(str(cwd))
+    monkeypatch.setattr(dog, 'find_dog_config', lambda: project / 'dog.config')
+    update_dog_config(project, {DOG: {AUTO_MOUNT: 'Workspace'}})
+    config = read_config([str(my_dog), 'true'])
+    workspace = str(repo if vcs else project)
+    assert config[AUTO_MOUNT] == 'workspace'
+    assert config[VOLUMES][workspace] == workspace
+    assert str(tmp_path) not in config[VOLUMES]
+
+
+@pytest.mark.skipif(is_windows(), reason='Auto-mount works differently on Windows')
+def test_auto_mount_minimal(
+    basic_v2_dog_config_with_image, home_temp_dir, tmp_path, monkeypatch, my_dog
+):
+    monkeypatch.setattr(Path, 'cwd', lambda: Path('/home/jdoe/work/dog'))
+    monkeypatch.setattr(dog, 'find_dog_config', lambda: tmp_path / 'dog.config')
+    update_dog_config(
+        tmp_path,
+        {
+            DOG: {AUTO_MOUNT: 'minimal'},
+            VOLUMES: {
+                'work': '/home/jdoe/work:/home/jdoe/work',
+                'tools': '/home/jdoe/work/tools:/home/jdoe/work/tools',
+                'moved': '/home/jdoe/other:/other',
+                'outside': '/opt/tools:/opt/tools',
+            },
+        },
+    )
+    config = read_config([str(my_dog), 'true'])
+    assert config[VOLUMES] == {
+        '/home/jdoe/work': '/home/jdoe/work',
+        '/other': '/home/jdoe/other',
+        '/opt/tools': '/opt/tools',
+    }
+
+    update_dog_config(tmp_path, {VOLUMES: {'work': '/opt/work:/opt/work'}})
+    config = read_config([str(my_dog), 'true'])
+    assert config[VOLUMES] == {
+        '/home/jdoe/work/dog': '/home/jdoe/work/dog',
+        '/home/jdoe/work/tools': '/home/jdoe/work/tools',
+        '/opt/work': '/opt/work',
+        '/other': '/home/jdoe/other',
+        '/opt/tools': '/opt/tools',
+    }
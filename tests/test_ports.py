@@ -0,0 +1,128 @@
+import json
+import os
+import socket
+import sys
+from pathlib import Path
+
+import pytest
+
+import dog
+from conftest import update_dog_config
+from dog import ALLOCATION_DIR, DOG, PORTS, port_env_var, split_host_port
+
+
+@pytest.mark.parametrize(
+    'outside, host, port',
+    [
+        ('8080', '', '8080'),
+        ('127.0.0.1:8080', '127.0.0.1', '8080'),
+        ('[::1]:8080', '::1', '8080'),
+    ],
+)
+def test_split_host_port(outside, host, port):
+    assert split_host_port(outside) == (host, port)
+
+
+@pytest.mark.parametrize(
+    'inside, name', [('80', 'DOG_PORT_80'), ('53/udp', 'DOG_PORT_53_UDP')]
+)
+def test_port_env_var(inside, name):
+    assert port_env_var(inside) == name
+
+
+@pytest.fixture
+def allocation_dir(tmp_path) -> Path:
+    return tmp_path / 'allocations'
+
+
+def read_reservations(allocation_dir: Path) -> list:
+    try:
+        return json.loads((allocation_dir / 'ports.json').read_text())
+    except FileNotFoundError:
+        return []
+
+
+@pytest.fixture
+def run_args(
+    basic_v2_dog_config_with_image, call_main, monkeypatch, tmp_path, allocation_dir
+):
+    """Run dog, returning the docker arguments and the port reservations at exec."""
+    update_dog_config(tmp_path, {DOG: {ALLOCATION_DIR: str(allocation_dir)}})
+    runs = []
+    monkeypatch.setattr(
+        os,
+        'execvp',
+        lambda file, args: runs.append((args, read_reservations(allocation_dir))),
+    )
+
+    def run():
+        call_main('true')
+        return runs[-1]
+
+    return run
+
+
+def published_ports(args) -> dict:
+    ports = {}
+    for i, arg in enumerate(args):
+        if arg == '-p':
+            outside, _, inside = args[i + 1].rpartition(':')
+            ports[inside] = outside
+    return ports
+
+
+def test_fixed_ports(run_args, tmp_path, allocation_dir):
+    update_dog_config(tmp_path, {PORTS: {'80': '127.0.0.1:8080'}})
+    args, reservations = run_args()
+    assert published_ports(args) == {'80': '127.0.0.1:8080'}
+    assert 'DOG_PORT_80=8080' in args
+    assert not allocation_dir.joinpath('ports.json').exists()
+
+
+def test_free_ports(run_args, tmp_path, allocation_dir):
+    update_dog_config(
+        tmp_path,
+        {
+            PORTS: {
+                '80': '${free-port}',
+                '443': '127.0.0.1:${free-port}',
+                '53/udp': '${free-port}',
+            }
+        },
+    )
+    args, reservations = run_args()
+    ports = published_ports(args)
+    assert ports['443'].startswith('127.0.0.1:')
+    chosen = [int(split_host_port(ports[inside])[1]) for inside in ['80', '443']]
+    chosen.append(int(ports['53/udp']))
+    assert len(set(chosen)) == 3
+    assert 'DOG_PORT_80={}'.format(chosen[0]) in args
+    assert 'DOG_PORT_443={}'.format(chosen[1]) in args
+    assert 'DOG_PORT_53_UDP={}'.format(chosen[2]) in args
+    if sys.platform != 'win32':
+        # Reserved while the container runs, and released when dog gets back
+        [reservation] = reservations
+        assert reservation['pid'] == os.getpid()
+        assert sorted(reservation['ports']) == sorted(chosen)
+        assert read_reservations(allocation_dir) == []
+    # The ports are free
+    with socket.socket() as s:
+        s.bind(('', chosen[0]))
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='No reservations on Windows')
+def test_reserved_ports_are_skipped(run_args, tmp_path, allocation_dir, monkeypatch):
+    allocation_dir.mkdir(parents=True)
+    # Another dog, which is still running, has reserved 40000
+    (allocation_dir / 'ports.json').write_text(
+        json.dumps([{'pid': os.getppid(), 'start': None, 'ports': [40000]}])
+    )
+    probes = iter([40000, 40000, 40001])
+    monkeypatch.setattr(dog, 'probe_free_port', lambda host, udp: next(probes))
+    update_dog_config(tmp_path, {PORTS: {'80': '${free-port}'}})
+    args, reservations = run_args()
+    assert published_ports(args) == {'80': '40001'}
+    assert [reservation['ports'] for reservation in reservations] == [
+        [40000],
+        [40001],
+    ]
@@ -38,6 +38,7 @@ from dog import (
     VERSION,
     VOLUMES,
     VOLUMES_FROM,
+    existing_paths,
     read_config,
 )
 from tests.conftest import is_windows
@@ -184,7 +185,7 @@ def test_volumes_v1(
 
 
 def test_volumes_v1_conditional(
-    call_read_config, basic_dog_config_with_image, tmp_path, monkeypatch
+    call_read_config, basic_dog_config_with_image, tmp_path, home_temp_dir
 ):
     update_dog_config(
         tmp_path,
@@ -196,7 +197,7 @@ def test_volumes_v1_conditional(
             },
         },
     )
-    monkeypatch.setattr(os.path, 'exists', lambda x: x == str(tmp_path / 'there'))
+    (tmp_path / 'there').mkdir()
     assert call_read_config()[VOLUMES] == {'/there': str(tmp_path / 'there')}
 
 
@@ -231,7 +232,7 @@ def test_volumes_v2(
 
 
 def test_volumes_v2_conditional(
-    call_read_config, basic_dog_config_with_image, tmp_path, monkeypatch
+    call_read_config, basic_dog_config_with_image, tmp_path, home_temp_dir
 ):
     update_dog_config(
         tmp_path,
@@ -243,10 +244,76 @@ def test_volumes_v2_conditional(
             },
         },
     )
-    monkeypatch.setattr(os.path, 'exists', lambda x: x == str(tmp_path / 'there'))
+    (tmp_path / 'there').mkdir()
     assert call_read_config()[VOLUMES] == {'/there': str(tmp_path / 'there')}
 
 
+@pytest.mark.skipif(is_windows(), reason='Symlinks require privileges on Windows')
+def test_existing_paths(tmp_path, home_temp_dir, monkeypatch):
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    (tmp_path / 'a' / 'x').mkdir(parents=True)
+    (tmp_path / 'a' / 'dangling').symlink_to(tmp_path / 'nowhere')
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'b' / 'y').touch()
+    for d in ('a', 'b'):
+        os.utime(str(tmp_path / d), (1000000000, 1000000000))
+    expected = {
+        str(tmp_path / 'a' / 'x'),
+        str(tmp_path / 'b' / 'y'),
+        str(tmp_path / 'b' / '..' / 'a' / 'x'),
+    }
+    paths = sorted(expected) + [
+        str(tmp_path / 'a' / 'missing'),
+        str(tmp_path / 'a' / 'dangling'),
+        str(tmp_path / 'c' / 'missing'),
+    ]
+    assert existing_paths(paths) == expected
+
+    # The directory listings are cached until the directory is modified
+    with monkeypatch.context() as m:
+        m.setattr(os, 'scandir', None)
+        assert existing_paths(paths) == expected
+    (tmp_path / 'a' / 'missing').touch()
+    os.utime(str(tmp_path / 'a'), (1000000001, 1000000001))
+    assert existing_paths(paths) == expected | {str(tmp_path / 'a' / 'missing')}
+
+
+def test_existing_paths_relative(tmp_path, home_temp_dir, monkeypatch):
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'b' / 'a').touch()
+    monkeypatch.chdir(tmp_path)
+    assert existing_paths(['a', 'missing', 'b/a']) == {'a', 'b/a'}
+    # The listing of the current directory is not reused in another one
+    monkeypatch.chdir(tmp_path / 'b')
+    assert existing_paths(['a', 'b']) == {'a'}
+
+
+def test_existing_paths_without_cache_dir(tmp_path, monkeypatch):
+    (tmp_path / 'not-a-dir').touch()
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'not-a-dir' / 'cache'))
+    monkeypatch.setenv('LOCALAPPDATA', str(tmp_path / 'not-a-dir' / 'cache'))
+    (tmp_path / 'a').mkdir()
+    paths = [str(tmp_path / 'a'), str(tmp_path / 'missing')]
+    assert existing_paths(paths) == {str(tmp_path / 'a')}
+
+
+def test_volumes_v2_conditional_relative(
+    call_read_config, basic_dog_config_with_image, tmp_path, monkeypatch
+):
+    update_dog_config(
+        tmp_path,
+        {
+            DOG: {AUTO_MOUNT: False, 'dog-config-file-version': '2'},
+            VOLUMES: {'vol1?': 'not_there:/test_path', 'vol2?': 'there:/there'},
+        },
+    )
+    (tmp_path / 'there').mkdir()
+    monkeypatch.chdir(tmp_path)
+    assert list(call_read_config()[VOLUMES]) == ['/there']
+
+
 def test_volumes_v2_using_v1_format(
     call_read_config, basic_dog_config_with_image, tmp_path, capsys
 ):
@@ -261,6 +328,67 @@ def test_volumes_v2_using_v1_format(
     assert '"/foo=/bar" found in volumes' in captured.err
 
 
+@pytest.mark.skipif(is_windows(), reason='Volumes are not normalized on Windows')
+def test_volumes_normalized(
+    call_read_config, basic_dog_config_with_image, tmp_path, capsys
+):
+    (tmp_path / 'src' / 'sub').mkdir(parents=True)
+    (tmp_path / 'link').symlink_to(tmp_path / 'src')
+    src = str(tmp_path / 'src')
+    update_dog_config(
+        tmp_path,
+        {
+            DOG: {
+                AUTO_MOUNT: False,
+                'dog-config-file-version': '2',
+                'verbose': True,
+                'volumes-resolve-symlinks': True,
+            },
+            VOLUMES: {
+                'parent': f'{src}:/src',
+                'nested': f'{src}/sub:/src/sub',
+                'symlink': f'{tmp_path / "link"}/:/src/',
+                'ro': f'{src}/sub:/src/sub2:ro',
+                'moved': f'{src}/sub:/elsewhere',
+                'named': 'my-volume:/src/named',
+            },
+        },
+    )
+    assert call_read_config()[VOLUMES] == {
+        '/src': src,
+        '/src/sub2:ro': f'{src}/sub',
+        '/elsewhere': f'{src}/sub',
+        '/src/named': 'my-volume',
+    }
+    captured = capsys.readouterr()
+    assert f'skipping volume {src}/sub:/src/sub - it is inside' in captured.out
+
+    update_dog_config(tmp_path, {VOLUMES: {'conflict': '/other:/src'}})
+    with pytest.raises(SystemExit):
+        call_read_config()
+    captured = capsys.readouterr()
+    assert 'Conflicting volumes for /src' in captured.err
+
+
+@pytest.mark.skipif(is_windows(), reason='Volumes are not normalized on Windows')
+def test_volumes_normalized_without_file_system(
+    call_read_config, basic_dog_config_with_image, tmp_path, monkeypatch
+):
+    update_dog_config(
+        tmp_path,
+        {
+            DOG: {AUTO_MOUNT: False, 'dog-config-file-version': '2'},
+            VOLUMES: {
+                'parent': '/net/src/:/src',
+                'nested': '/net/other/../src/sub:/src/sub',
+                'symlink': '/net/link:/link',
+            },
+        },
+    )
+    monkeypatch.setattr(os.path, 'realpath', None)
+    assert call_read_config()[VOLUMES] == {'/src': '/net/src', '/link': '/net/link'}
+
+
 def test_dog_is_too_old_for_minimum_version(
     call_read_config, basic_dog_config_with_image, tmp_path, capsys
 ):
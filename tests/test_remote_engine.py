@@ -0,0 +1,341 @@
+import contextlib
+import http.client
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from conftest import update_dog_config
+from dog import (
+    DOCKER_HOST,
+    DOCKER_HOST_PERSIST,
+    DOG,
+    USE_PODMAN,
+    EngineBroker,
+    ssh_master_args,
+)
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == 'win32', reason='The shared connections use unix sockets'
+)
+
+
+class EngineHandler(BaseHTTPRequestHandler):
+    """A few engine API like endpoints, on kept-alive connections."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body: bytes):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_body(b'OK')
+
+    def do_GET(self):
+        if self.path == '/events':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in [b'{"a": 1}\n', b'{"b": 2}\n', b'']:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        else:
+            self.send_body(b'OK')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', '0')))
+        if self.path == '/attach':
+            # Like "docker attach": the connection becomes a raw stream
+            self.send_response(101)
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Upgrade', 'tcp')
+            self.end_headers()
+            self.wfile.flush()
+            data = self.connection.recv(1024)
+            while data:
+                self.connection.sendall(data.upper())
+                data = self.connection.recv(1024)
+            self.close_connection = True
+        else:
+            self.send_body(body[::-1])
+
+
+@pytest.fixture
+def engine():
+    """A local TCP stand-in for a remote engine, counting its connections."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), EngineHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.url = 'tcp://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def broker(engine, tmp_path):
+    broker = EngineBroker(engine.url, None, persist=1)
+    socket_path = str(tmp_path / 'engine.sock')
+    listener = broker.listen(socket_path)
+    thread = threading.Thread(
+        target=broker.serve, args=(listener, socket_path), daemon=True
+    )
+    thread.start()
+    broker.socket_path = socket_path
+    broker.thread = thread
+    return broker
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(self.path)
+
+
+def request(path: str, method: str, url: str, body: bytes = None) -> tuple:
+    connection = UnixHTTPConnection(path)
+    try:
+        connection.request(method, url, body)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def test_broker_shares_connection(engine, broker):
+    for _ in range(3):
+        # Like separate docker invocations, each with their own connection
+        connection = UnixHTTPConnection(broker.socket_path)
+        connection.request('HEAD', '/_ping')
+        response = connection.getresponse()
+        assert (response.status, response.read()) == (200, b'')
+        connection.request('GET', '/_ping')
+        assert connection.getresponse().read() == b'OK'
+        connection.close()
+    assert engine.connections == 1
+
+
+def test_broker_bodies(engine, broker):
+    assert request(broker.socket_path, 'POST', '/echo', b'hello') == (200, b'olleh')
+    assert request(broker.socket_path, 'GET', '/events') == (
+        200,
+        b'{"a": 1}\n{"b": 2}\n',
+    )
+    assert engine.connections == 1
+
+
+def test_broker_upgrade(engine, broker):
+    with socket.socket(socket.AF_UNIX) as client:
+        client.connect(broker.socket_path)
+        client.sendall(
+            b'POST /attach HTTP/1.1\r\nHost: docker\r\nConnection: Upgrade\r\n'
+            b'Upgrade: tcp\r\n\r\n'
+        )
+        reader = client.makefile('rb')
+        assert reader.readline().startswith(b'HTTP/1.1 101')
+        while reader.readline().strip():
+            pass
+        client.sendall(b'stream')
+        assert reader.read1(100) == b'STREAM'
+        client.shutdown(socket.SHUT_WR)
+        assert reader.read() == b''
+    # The upgraded connection is not shared
+    assert request(broker.socket_path, 'GET', '/_ping') == (200, b'OK')
+    assert engine.connections == 2
+
+
+def test_broker_replaces_closed_connection(engine, broker):
+    assert request(broker.socket_path, 'GET', '/_ping') == (200, b'OK')
+    while not broker.idle:
+        time.sleep(0.01)
+    [(sock, _)] = broker.idle
+    sock.shutdown(socket.SHUT_RDWR)
+    assert request(broker.socket_path, 'GET', '/_ping') == (200, b'OK')
+    assert engine.connections == 2
+
+
+def test_broker_exits_when_idle(broker):
+    assert request(broker.socket_path, 'GET', '/_ping') == (200, b'OK')
+    broker.thread.join(5)
+    assert not broker.thread.is_alive()
+    assert not os.path.exists(broker.socket_path)
+
+
+def test_ssh_master_args():
+    args = ssh_master_args('ssh://me@builder:2222', '/run/dog/e.sock', '/d.sock', 60)
+    assert args[:6] == ['ssh', '-f', '-N', '-M', '-S', '/run/dog/e.sock.ctl']
+    assert '-oControlPersist=60' in ''.join(args)
+    assert args[-8:] == [
+        '-L',
+        '/run/dog/e.sock:/d.sock',
+        '-p',
+        '2222',
+        '-l',
+        'me',
+        '--',
+        'builder',
+    ]
+    # podman URLs name the engine socket
+    args = ssh_master_args('ssh://builder/run/user/1000/podman.sock', 'e', 'd', 60)
+    assert args[-4:] == ['-L', 'e:/run/user/1000/podman.sock', '--', 'builder']
+
+
+@pytest.fixture
+def runtime_dir(tmp_path, monkeypatch) -> Path:
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'runtime'))
+    return tmp_path / 'runtime' / 'dog'
+
+
+@pytest.fixture
+def run_args(basic_v2_dog_config_with_image, call_main, monkeypatch, runtime_dir):
+    """Run dog, returning the arguments it runs docker with."""
+    monkeypatch.delenv('DOCKER_HOST', raising=False)
+    runs = []
+    monkeypatch.setattr(os, 'execvp', lambda file, args: runs.append(args))
+
+    def run(*args):
+        call_main(*(args or ['true']))
+        return runs[-1]
+
+    return run
+
+
+def test_docker_host_tcp(run_args, tmp_path, engine, fake_engine, runtime_dir):
+    update_dog_config(
+        tmp_path, {DOG: {DOCKER_HOST: engine.url, DOCKER_HOST_PERSIST: '2'}}
+    )
+    for _ in range(3):
+        args = run_args('--pull', 'true')
+    [socket_path] = runtime_dir.glob('engine-*.sock')
+    assert args[:5] == [
+        'docker',
+        '-H',
+        'unix://{}'.format(socket_path),
+        '--tls=false',
+        '--tlsverify=false',
+    ]
+    # The fake docker pulled through the broker each time, over one connection
+    pulls = [call for call in fake_engine.calls() if 'pull' in call]
+    assert len(pulls) == 3
+    assert engine.connections == 1
+
+
+def test_docker_host_env(run_args, tmp_path, engine, fake_engine, monkeypatch):
+    update_dog_config(tmp_path, {DOG: {DOCKER_HOST_PERSIST: '2'}})
+    monkeypatch.setenv('DOCKER_HOST', engine.url)
+    assert run_args()[1] == '-H'
+    # The broker connected before it answered, but the engine may not have
+    # got to counting it yet
+    deadline = time.monotonic() + 5
+    while engine.connections == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert engine.connections == 1
+
+
+def test_docker_host_unreachable(run_args, tmp_path):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        url = 'tcp://127.0.0.1:{}'.format(s.getsockname()[1])
+    update_dog_config(tmp_path, {DOG: {DOCKER_HOST: url, DOCKER_HOST_PERSIST: '2'}})
+    assert run_args()[:3] == ['docker', '-H', url]
+
+
+def test_docker_host_not_shared_by_default(run_args, engine, monkeypatch, runtime_dir):
+    monkeypatch.setenv('DOCKER_HOST', engine.url)
+    # The docker CLI uses DOCKER_HOST itself
+    assert run_args()[:2] == ['docker', 'run']
+    assert list(runtime_dir.glob('engine-*')) == []
+    assert engine.connections == 0
+
+
+@pytest.mark.parametrize(
+    'host, persist, podman, expected',
+    [
+        ('unix:///run/other.sock', '600', False, ['-H', 'unix:///run/other.sock']),
+        ('tcp://10.0.0.1:2375', '0', False, ['-H', 'tcp://10.0.0.1:2375']),
+        ('tcp://10.0.0.1:2375', '0', True, ['--url', 'tcp://10.0.0.1:2375']),
+    ],
+)
+def test_docker_host_direct(run_args, tmp_path, host, persist, podman, expected):
+    update_dog_config(
+        tmp_path,
+        {
+            DOG: {
+                DOCKER_HOST: host,
+                DOCKER_HOST_PERSIST: persist,
+                USE_PODMAN: str(podman),
+            }
+        },
+    )
+    assert run_args()[1:3] == expected
+
+
+FAKE_SSH = '''#!{python}
+import os, socket, sys, time
+with open({log!r}, 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+local = sys.argv[sys.argv.index('-L') + 1].split(':')[0]
+listener = socket.socket(socket.AF_UNIX)
+listener.bind(local)
+listener.listen(1)
+pid = os.fork()
+if pid:
+    with open({log!r} + '.pid', 'w') as f:
+        f.write(str(pid))
+else:
+    os.setsid()
+    listener.settimeout(10)
+    try:
+        while True:
+            listener.accept()[0].close()
+    finally:
+        os._exit(0)
+'''
+
+
+def test_docker_host_ssh(run_args, tmp_path, monkeypatch, runtime_dir):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    ssh_log = tmp_path / 'ssh.log'
+    ssh = bin_dir / 'ssh'
+    ssh.write_text(FAKE_SSH.format(python=sys.executable, log=str(ssh_log)))
+    ssh.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    update_dog_config(
+        tmp_path, {DOG: {DOCKER_HOST: 'ssh://me@builder', DOCKER_HOST_PERSIST: '2'}}
+    )
+    try:
+        for _ in range(2):
+            args = run_args()
+    finally:
+        with contextlib.suppress(OSError, ValueError):
+            os.kill(int(Path(str(ssh_log) + '.pid').read_text()), signal.SIGTERM)
+    [socket_path] = runtime_dir.glob('engine-*.sock')
+    assert args[1:3] == ['-H', 'unix://{}'.format(socket_path)]
+    # The second dog used the forward of the ssh master started by the first
+    [ssh_args] = ssh_log.read_text().splitlines()
+    assert ssh_args.endswith(
+        '-L {}:/var/run/docker.sock -l me -- builder'.format(socket_path)
+    )
@@ -0,0 +1,227 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from conftest import update_dog_config
+from dog import (
+    ALLOCATION_DIR,
+    CPUSET_ALLOCATIONS,
+    DOG,
+    RESOURCES,
+    VERBOSE,
+    allocate_cpuset,
+    choose_cpus,
+    format_cpu_list,
+    parse_cpu_list,
+    read_cpu_topology,
+    release_allocations,
+)
+
+
+def make_sysfs(root: Path, packages: int, cores: int, threads: int) -> str:
+    """A /sys with Linux style CPU numbering: the SMT siblings come last."""
+    cpu_dir = root / 'devices' / 'system' / 'cpu'
+    total_cores = packages * cores
+    for cpu in range(total_cores * threads):
+        topology = cpu_dir / 'cpu{}'.format(cpu) / 'topology'
+        topology.mkdir(parents=True)
+        core = cpu % total_cores
+        (topology / 'physical_package_id').write_text('{}\n'.format(core // cores))
+        (topology / 'core_id').write_text('{}\n'.format(core % cores))
+    (cpu_dir / 'online').write_text('0-{}\n'.format(total_cores * threads - 1))
+    return str(root)
+
+
+@pytest.fixture
+def sysfs(tmp_path) -> str:
+    """Two packages of four cores with two threads each."""
+    return make_sysfs(tmp_path / 'sys', packages=2, cores=4, threads=2)
+
+
+@pytest.fixture
+def allocation_dir(tmp_path) -> Path:
+    return tmp_path / 'allocations'
+
+
+@pytest.mark.parametrize(
+    'cpu_list, cpus',
+    [('0', [0]), ('0-3', [0, 1, 2, 3]), ('0-1,4,6-7', [0, 1, 4, 6, 7])],
+)
+def test_cpu_list(cpu_list, cpus):
+    assert parse_cpu_list(cpu_list + '\n') == cpus
+    assert format_cpu_list(list(reversed(cpus))) == cpu_list
+
+
+def test_read_cpu_topology(sysfs):
+    assert read_cpu_topology(sysfs) == [
+        (0, [0, 8]),
+        (0, [1, 9]),
+        (0, [2, 10]),
+        (0, [3, 11]),
+        (1, [4, 12]),
+        (1, [5, 13]),
+        (1, [6, 14]),
+        (1, [7, 15]),
+    ]
+
+
+def test_read_cpu_topology_unknown(tmp_path):
+    cores = read_cpu_topology(str(tmp_path))
+    assert [cpus for _, cpus in cores] == [[cpu] for cpu in range(os.cpu_count())]
+
+
+def test_choose_cpus(sysfs):
+    cores = read_cpu_topology(sysfs)
+    usage = {}
+    allocations = []
+    for count in [3, 2, 4, 2, 4, 2]:
+        cpus = choose_cpus(cores, usage, count)
+        allocations.append(format_cpu_list(cpus))
+        for cpu in cpus:
+            usage[cpu] = usage.get(cpu, 0) + 1
+    # Whole cores, one package per container, and no shared cores while possible
+    assert allocations == [
+        '0-1,8-9',
+        '2,10',
+        '4-5,12-13',
+        '3,11',
+        '6-7,14-15',
+        '0,8',
+    ]
+
+
+def test_choose_cpus_larger_than_package(sysfs):
+    cores = read_cpu_topology(sysfs)
+    assert format_cpu_list(choose_cpus(cores, {}, 10)) == '0-4,8-12'
+
+
+def cpuset_config(cpus: str, allocation_dir: Path) -> dict:
+    return {
+        RESOURCES: {'cpus': cpus, 'cpuset': 'auto'},
+        ALLOCATION_DIR: str(allocation_dir),
+        VERBOSE: False,
+    }
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='cpuset = auto uses flock')
+def test_allocate_cpuset(sysfs, allocation_dir):
+    configs = [cpuset_config('4', allocation_dir) for _ in range(2)]
+    for config in configs:
+        assert allocate_cpuset(config, sysfs)
+    assert configs[0][RESOURCES]['cpuset'] == '0-1,8-9'
+    assert configs[1][RESOURCES]['cpuset'] == '2-3,10-11'
+    # The allocations are shared with the dogs of other users
+    assert allocation_dir.stat().st_mode & 0o7777 == 0o1777
+    assert (allocation_dir / 'cpusets.json').stat().st_mode & 0o777 == 0o666
+    release_allocations(str(allocation_dir), CPUSET_ALLOCATIONS)
+    assert json.loads((allocation_dir / 'cpusets.json').read_text()) == []
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='cpuset = auto uses flock')
+def test_allocate_cpuset_reclaims_exited(sysfs, allocation_dir):
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    allocation_dir.mkdir(parents=True)
+    (allocation_dir / 'cpusets.json').write_text(
+        json.dumps([{'pid': exited.pid, 'start': None, 'cpus': [0, 8]}])
+    )
+    config = cpuset_config('2', allocation_dir)
+    assert allocate_cpuset(config, sysfs)
+    assert config[RESOURCES]['cpuset'] == '0,8'
+    release_allocations(str(allocation_dir), CPUSET_ALLOCATIONS)
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='cpuset = auto uses flock')
+@pytest.mark.parametrize('problem', ['symlink', 'other user'])
+def test_allocation_dir_not_shared(
+    sysfs, allocation_dir, tmp_path, monkeypatch, capsys, problem
+):
+    if problem == 'symlink':
+        (tmp_path / 'elsewhere').mkdir(mode=0o700)
+        allocation_dir.symlink_to(tmp_path / 'elsewhere')
+    else:
+        allocation_dir.mkdir(mode=0o777)
+        allocation_dir.chmod(0o777)
+        uid = os.getuid() + 1
+        monkeypatch.setattr(os, 'getuid', lambda: uid)
+    with pytest.raises(SystemExit):
+        allocate_cpuset(cpuset_config('2', allocation_dir), sysfs)
+    assert 'must be a directory with mode 1777' in capsys.readouterr().err
+    assert list(allocation_dir.iterdir()) == []
+    if problem == 'symlink':
+        assert (tmp_path / 'elsewhere').stat().st_mode & 0o7777 == 0o700
+
+
+def read_allocations(allocation_dir: Path) -> list:
+    try:
+        return json.loads((allocation_dir / 'cpusets.json').read_text())
+    except FileNotFoundError:
+        return []
+
+
+@pytest.fixture
+def run_args(
+    basic_v2_dog_config_with_image, call_main, monkeypatch, tmp_path, allocation_dir
+):
+    """Run dog, returning the docker arguments and the CPU allocations at exec."""
+    update_dog_config(tmp_path, {DOG: {ALLOCATION_DIR: str(allocation_dir)}})
+    runs = []
+    monkeypatch.setattr(
+        os,
+        'execvp',
+        lambda file, args: runs.append((args, read_allocations(allocation_dir))),
+    )
+
+    def run():
+        call_main('true')
+        return runs[-1]
+
+    return run
+
+
+def test_docker_run_args(run_args, tmp_path):
+    update_dog_config(
+        tmp_path, {RESOURCES: {'cpus': '1.5', 'memory': '2g', 'cpuset': '0-1'}}
+    )
+    args, allocations = run_args()
+    assert '--cpus=1.5' in args
+    assert '--memory=2g' in args
+    assert '--cpuset-cpus=0-1' in args
+    assert 'DOG_CPUS=0-1' in args
+    assert allocations == []
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='cpuset = auto uses flock')
+def test_docker_run_args_auto(run_args, tmp_path, allocation_dir):
+    update_dog_config(tmp_path, {RESOURCES: {'cpus': '1', 'cpuset': 'auto'}})
+    args, allocations = run_args()
+    # When dog execs docker, the allocation belongs to the process running docker
+    [allocation] = allocations
+    assert allocation['pid'] == os.getpid()
+    cpuset = format_cpu_list(allocation['cpus'])
+    assert '--cpus=1' in args
+    assert '--cpuset-cpus={}'.format(cpuset) in args
+    assert 'DOG_CPUS={}'.format(cpuset) in args
+    # execvp returned here, so dog released the CPUs itself
+    assert read_allocations(allocation_dir) == []
+
+
+@pytest.mark.parametrize(
+    'resources, error',
+    [
+        ({'cpu': '1'}, 'Unknown key "cpu" in [resources]'),
+        ({'cpus': '-1'}, '[resources] cpus must be a positive number (got "-1")'),
+        ({'cpuset': 'auto'}, '[resources] cpuset = auto needs cpus'),
+        ({'cpuset': 'some'}, '[resources] cpuset must be "auto" or a list of CPUs'),
+        ({'memory': 'lots'}, '[resources] memory: '),
+    ],
+)
+def test_invalid(run_args, tmp_path, capstrip, resources, error):
+    update_dog_config(tmp_path, {RESOURCES: resources})
+    with pytest.raises(SystemExit):
+        run_args()
+    assert error in capstrip.get()[1]
@@ -5,7 +5,7 @@ import sys
 import pytest
 
 from conftest import DOG_PYTHON_UNDER_TEST
-from conftest import append_to_dog_config
+from conftest import append_to_dog_config, needs_docker
 
 
 @pytest.fixture
@@ -23,11 +23,46 @@ def call_shell(my_dog, basic_dog_config, monkeypatch, tmp_path):
     return call
 
 
+@pytest.fixture
+def ssh_dir(home_temp_dir, fake_engine, monkeypatch):
+    """A ~/.ssh, with git run by the fake engine (on this host) not doing anything."""
+    monkeypatch.setenv('FAKE_ENGINE_EXECUTE', '0')
+    ssh_dir = home_temp_dir / '.ssh'
+    ssh_dir.mkdir()
+    return ssh_dir
+
+
+def volumes(call) -> list:
+    return [call[i + 1] for i, arg in enumerate(call) if arg == '-v']
+
+
+@needs_docker
 def test_pull_git_for_dog(call_shell, capstrip, dog_env):
     call_shell(f'{dog_env} env')
     print(capstrip.get())
 
 
+def test_git_for_dog(call_shell, dog_env, fake_engine, ssh_dir):
+    assert call_shell(f'{dog_env} git status').returncode == 0
+    [call] = fake_engine.calls()
+    assert call[-3:] == ['rtol/git-for-dog', 'git', 'status']
+
+
+def test_ssh_mounted(call_shell, dog_env, fake_engine, ssh_dir, tmp_path):
+    append_to_dog_config(tmp_path, ['[volumes]', '$home/.ssh:ro = ~/.ssh'])
+    assert call_shell(f'{dog_env} git fetch').returncode == 0
+    [call] = fake_engine.calls()
+    assert '{0}:{0}:ro'.format(ssh_dir) in volumes(call)
+
+
+def test_ssh_not_mounted(call_shell, dog_env, fake_engine, ssh_dir):
+    assert call_shell(f'{dog_env} git fetch').returncode == 0
+    [call] = fake_engine.calls()
+    assert not any('.ssh' in volume for volume in volumes(call))
+
+
+# The tests below clone over SSH from inside the real image, so they need a
+# docker daemon, network access and a key registered with the git server
 @pytest.mark.skipif(
     'GITHUB_ACTIONS' in os.environ,
     reason='This test does not work on GitHub actions since it uses SSH authentication',
@@ -57,6 +92,7 @@ def test_ssh_enabled_demant(call_shell, capstrip, dog_env, tmp_path):
     assert 'Could not read from remote repository' not in stderr
 
 
+@needs_docker
 def test_ssh_disabled(call_shell, capstrip, dog_env, tmp_path):
     call_shell(f'{dog_env} git clone git@github.com:rasmus-toftdahl-olesen/dog.git')
     stdout, stderr = capstrip.get()
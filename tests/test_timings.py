@@ -0,0 +1,106 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+from conftest import update_dog_config
+from dog import DOG, ENV_FILE
+
+
+@pytest.fixture
+def mock_execvp(monkeypatch):
+    calls = []
+    monkeypatch.setattr(os, 'execvp', lambda file, args: calls.append(args))
+    return calls
+
+
+def test_timings_json(
+    basic_dog_config_with_image, call_main, tmp_path, home_temp_dir, mock_execvp
+):
+    timings_file = tmp_path / 'timings.json'
+    call_main(f'--timings={timings_file}', 'echo', 'foo')
+    assert mock_execvp[0][-2:] == ['echo', 'foo']
+
+    timings = json.loads(timings_file.read_text())
+    phases = {phase['name']: phase for phase in timings['phases']}
+    assert phases['read_config']['depth'] == 0
+    assert phases['handle_auto_mount']['depth'] == 1
+    assert phases['get_env_config']['duration'] >= 0
+    assert 'run_subprocess' not in phases
+    end = max(phase['start'] + phase['duration'] for phase in timings['phases'])
+    assert end <= timings['total']
+
+
+def test_timings_table(
+    basic_dog_config_with_image,
+    call_main,
+    tmp_path,
+    home_temp_dir,
+    monkeypatch,
+    mock_execvp,
+    capsys,
+):
+    # With an env file docker is run as a subprocess, which is included
+    monkeypatch.setenv('DOG_TIMINGS', '1')
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'runtime'))
+    update_dog_config(tmp_path, {DOG: {ENV_FILE: True}})
+    monkeypatch.setattr(
+        subprocess,
+        'run',
+        lambda args: subprocess.CompletedProcess(args=args, returncode=0),
+    )
+    call_main('echo', 'foo')
+    assert mock_execvp == []
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[0].endswith('ms  read_config')
+    assert any(line.endswith('ms    handle_volumes') for line in lines)
+    assert lines[-2].endswith('ms  run_subprocess')
+    assert lines[-1].endswith('ms total')
+    assert len([line for line in lines if line.endswith('total')]) == 1
+
+
+def test_trace_file(
+    basic_dog_config_with_image,
+    call_main,
+    tmp_path,
+    home_temp_dir,
+    monkeypatch,
+    mock_execvp,
+):
+    trace_file = tmp_path / 'trace.jsonl'
+    monkeypatch.setenv('DOG_TRACE_FILE', str(trace_file))
+    call_main('echo', 'foo')
+    call_main('echo', 'bar')
+
+    lines = trace_file.read_text().splitlines()
+    assert len(lines) == 2
+    events = json.loads(lines[1])['traceEvents']
+    run = events[0]
+    assert run['name'] == 'dog'
+    assert run['ph'] == 'X'
+    assert run['args']['image'] == 'debian:latest'
+    assert run['args']['argv'][-2:] == ['echo', 'bar']
+    by_name = {event['name']: event for event in events}
+    read_dog_config = by_name['read_dog_config']
+    assert read_dog_config['args']['config_files'] == [str(tmp_path / 'dog.config')]
+    for event in events[1:]:
+        assert run['ts'] <= event['ts']
+        assert event['ts'] + event['dur'] <= run['ts'] + run['dur'] + 1
+
+
+def test_trace_file_error(
+    basic_dog_config_with_image,
+    call_main,
+    tmp_path,
+    home_temp_dir,
+    monkeypatch,
+    mock_execvp,
+    capsys,
+):
+    monkeypatch.setenv('DOG_TRACE_FILE', str(tmp_path / 'missing' / 'trace.jsonl'))
+    call_main('echo', 'foo')
+    # The output of the command is not mixed with the warning
+    out, err = capsys.readouterr()
+    assert 'Dog could not write trace to' not in out
+    assert 'Dog could not write trace to' in err
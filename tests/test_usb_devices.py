@@ -0,0 +1,73 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+import dog
+from conftest import is_windows
+from dog import USB_DEVICES, UsbDevices, handle_usb_devices
+
+SYSFS = Path(__file__).parent / 'resources' / 'sysfs'
+
+
+def test_all_devices():
+    usb_devices = UsbDevices(sysfs_root=str(SYSFS))
+    assert usb_devices.get_bus_paths('1111:aaaa') == ['/dev/bus/usb/001/004']
+    assert sorted(usb_devices.get_bus_paths('cccc:dddd')) == [
+        '/dev/bus/usb/001/007',
+        '/dev/bus/usb/002/010',
+    ]
+    assert usb_devices.get_bus_paths('1d6b:0003') == ['/dev/bus/usb/002/001']
+    assert usb_devices.get_bus_paths('0000:0000') == []
+
+
+def test_only_wanted_devices_are_read(monkeypatch):
+    read = []
+    real_read_info = UsbDevices.read_info
+    monkeypatch.setattr(
+        UsbDevices,
+        'read_info',
+        staticmethod(lambda path: read.append(path) or real_read_info(path)),
+    )
+    usb_devices = UsbDevices(['1111:aaaa'], sysfs_root=str(SYSFS))
+    assert usb_devices.devs == {'1111:aaaa': [(1, 4)]}
+    assert len([p for p in read if p.endswith('devnum')]) == 1
+
+
+def test_no_usb_devices_configured(monkeypatch):
+    monkeypatch.setattr(dog, 'UsbDevices', None)
+    config = {USB_DEVICES: {}}
+    handle_usb_devices(config)
+    assert config == {USB_DEVICES: {}}
+
+
+def test_missing_sysfs(tmp_path):
+    assert UsbDevices(sysfs_root=str(tmp_path)).devs == {}
+
+
+@pytest.mark.skipif(is_windows(), reason='Interface names contain a colon')
+def test_cache(tmp_path):
+    sysfs = tmp_path / 'sysfs'
+    shutil.copytree(str(SYSFS), str(sysfs))
+    devices = sysfs / 'bus' / 'usb' / 'devices'
+    (devices / '1-1:1.0').mkdir()
+    (devices / '1-1:1.0' / 'bInterfaceClass').write_text('09\n')
+    cache_file = tmp_path / 'usb-devices.json'
+    wanted = ['1111:aaaa']
+
+    assert UsbDevices(wanted, str(sysfs), cache_file).devs == {'1111:aaaa': [(1, 4)]}
+    assert cache_file.exists()
+
+    # Cached as long as the topology is unchanged
+    (devices / '1-1.2' / 'devnum').write_text('5\n')
+    assert UsbDevices(wanted, str(sysfs), cache_file).devs == {'1111:aaaa': [(1, 4)]}
+    assert UsbDevices(None, str(sysfs), cache_file).get_bus_paths('1111:aaaa') == [
+        '/dev/bus/usb/001/005'
+    ]
+
+    # Replugging the device recreates its directory
+    shutil.copytree(str(devices / '1-1.2'), str(devices / 'replugged'))
+    shutil.rmtree(str(devices / '1-1.2'))
+    (devices / 'replugged').rename(devices / '1-1.2')
+    (devices / '1-1.2' / 'devnum').write_text('6\n')
+    assert UsbDevices(wanted, str(sysfs), cache_file).devs == {'1111:aaaa': [(1, 6)]}
@@ -4,9 +4,13 @@ from pathlib import Path
 
 import pytest
 
-from conftest import DOG_PYTHON_UNDER_TEST
+from conftest import DOG_PYTHON_UNDER_TEST, needs_docker
 
 RESOURCES = Path(__file__).parent / 'resources' / 'volumes-from-test'
+IMAGE = 'ghcr.io/rasmus-toftdahl-olesen/dog/centos-for-dog'
+TOOL_IMAGE = (
+    'ghcr.io/rasmus-toftdahl-olesen/dog/volume-docker-integration-tests-{}:latest'
+)
 
 
 @pytest.fixture
@@ -22,11 +26,18 @@ def call_shell(my_dog, monkeypatch):
     return call
 
 
+@pytest.fixture
+def call_fake_shell(call_shell, home_temp_dir, fake_engine):
+    return call_shell
+
+
+@needs_docker
 def test_pull_centos_for_dog(call_shell, capstrip, dog_env):
     call_shell(f'{dog_env} --pull env')
     print(capstrip.get())
 
 
+@needs_docker
 def test_run_tool1(call_shell, capstrip, dog_env):
     call_shell(f'{dog_env} /opt/tool1/tool1.sh')
     stdout, stderr = capstrip.get()
@@ -34,8 +45,31 @@ def test_run_tool1(call_shell, capstrip, dog_env):
     assert 'tool1 ran' in stdout
 
 
+@needs_docker
 def test_run_tool2(call_shell, capstrip, dog_env):
     call_shell(f'{dog_env} /opt/tool2/tool2.sh')
     stdout, stderr = capstrip.get()
     assert stderr == ''
     assert 'tool2 ran' in stdout
+
+
+def test_pull_on_fake_engine(call_fake_shell, dog_env, fake_engine):
+    assert call_fake_shell(f'{dog_env} --pull env').returncode == 0
+    assert fake_engine.calls()[0] == ['pull', IMAGE]
+
+
+def test_volume_containers(call_fake_shell, dog_env, fake_engine):
+    assert call_fake_shell(f'{dog_env} env').returncode == 0
+    runs = [call for call in fake_engine.calls() if call[0] == 'run']
+    # The containers of the tool images are created concurrently, then the command
+    # is run with their volumes
+    assert sorted(runs[:2]) == [
+        ['run', '--network', 'none', '--name', tool, TOOL_IMAGE.format(tool)]
+        for tool in ['tool1', 'tool2']
+    ]
+    volumes_from = [
+        runs[2][i + 1] for i, arg in enumerate(runs[2]) if arg == '--volumes-from'
+    ]
+    assert volumes_from == ['tool1', 'tool2:ro']
+    assert runs[2][-2:] == [IMAGE, 'env']
+    assert sorted(fake_engine.state()['containers']) == ['tool1', 'tool2']
@@ -0,0 +1,195 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+import dog
+from conftest import DOG_PYTHON_UNDER_TEST, is_windows
+from dog import Inotify, PollingWatcher, matches_watch_patterns
+
+
+@pytest.mark.parametrize(
+    'path, patterns, expected',
+    [
+        ('main.c', ['*.c'], True),
+        ('src/main.c', ['*.c'], True),
+        ('src/main.c', ['**/*.c'], True),
+        ('main.c', ['**/*.c'], True),
+        ('src/main.c', ['src/*'], True),
+        ('main.h', ['*.c', '*.h'], True),
+        ('main.o', ['*.c', '*.h'], False),
+        ('lib/main.c', ['src/*'], False),
+    ],
+)
+def test_matches_watch_patterns(path, patterns, expected):
+    assert matches_watch_patterns(path, patterns) == expected
+
+
+WATCHERS = [
+    pytest.param(
+        Inotify,
+        marks=pytest.mark.skipif(
+            not sys.platform.startswith('linux'), reason='inotify is Linux only'
+        ),
+    ),
+    PollingWatcher,
+]
+
+
+@pytest.fixture(params=WATCHERS)
+def watcher(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dog, 'WATCH_POLL_SECONDS', 0.05)
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'main.c').write_text('int main;')
+    (tmp_path / '.git').mkdir()
+    watcher = request.param(['**/*.c'])
+    yield watcher
+    watcher.close()
+
+
+def wait_for_changes(watcher) -> list:
+    changed = set()
+    deadline = time.monotonic() + 5
+    while not changed and time.monotonic() < deadline:
+        changed.update(watcher.changes(0.5))
+    # Pick up the rest of a burst of changes
+    more = watcher.changes(0.5)
+    while more:
+        changed.update(more)
+        more = watcher.changes(0.5)
+    return sorted(Path(path).as_posix() for path in changed)
+
+
+def test_watcher(watcher, tmp_path):
+    assert watcher.changes(0.1) == []
+    # Changes in a hidden directory, and to files not matching, are ignored
+    (tmp_path / '.git' / 'index.c').write_text('')
+    (tmp_path / 'src' / 'main.o').write_text('')
+    assert watcher.changes(0.3) == []
+
+    time.sleep(0.01)
+    (tmp_path / 'src' / 'main.c').write_text('int main() {}')
+    assert wait_for_changes(watcher) == ['src/main.c']
+
+    # Files in new directories are watched too
+    (tmp_path / 'lib' / 'util').mkdir(parents=True)
+    (tmp_path / 'lib' / 'util' / 'util.c').write_text('')
+    assert 'lib/util/util.c' in wait_for_changes(watcher)
+    time.sleep(0.01)
+    (tmp_path / 'lib' / 'util' / 'util.c').write_text('int util;')
+    assert wait_for_changes(watcher) == ['lib/util/util.c']
+
+    (tmp_path / 'src' / 'main.c').unlink()
+    assert wait_for_changes(watcher) == ['src/main.c']
+
+
+class ScriptedWatcher:
+    """Returns the changes of each step once its condition holds.
+
+    The conditions get the timeout, which is None when no run is in progress.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def changes(self, timeout):
+        condition, changed = self.steps[0]
+        deadline = time.monotonic() + 10
+        while not condition(timeout):
+            if timeout is not None:
+                time.sleep(min(timeout, 0.05))
+                return []
+            assert time.monotonic() < deadline, 'Timed out waiting'
+            time.sleep(0.05)
+        self.steps.pop(0)
+        if changed is KeyboardInterrupt:
+            raise KeyboardInterrupt
+        return changed
+
+    def close(self):
+        pass
+
+
+def idle(timeout):
+    return timeout is None
+
+
+def debouncing(timeout):
+    return timeout == dog.WATCH_DEBOUNCE_SECONDS
+
+
+def running_with_lines(log: Path, count: int):
+    def condition(timeout):
+        return (
+            timeout is not None
+            and log.exists()
+            and len(log.read_text().splitlines()) >= count
+        )
+
+    return condition
+
+
+@pytest.fixture
+def watch_dog(
+    call_main, tmp_path, basic_v2_dog_config_with_image, fake_engine, monkeypatch
+):
+    def run(command: str, steps) -> int:
+        monkeypatch.setattr(dog, 'make_watcher', lambda config: ScriptedWatcher(steps))
+        returncode = call_main('--watch', '*.c', DOG_PYTHON_UNDER_TEST, '-c', command)
+        assert steps == []
+        # The fake engine runs the commands on this host, so the pid file is here
+        name = fake_engine.calls()[0][4]
+        Path(dog.docker_watch_pid_file(name)).unlink()
+        # The container is removed when dog stops watching
+        assert fake_engine.state()['containers'] == {}
+        return returncode
+
+    return run
+
+
+needs_local_sh = pytest.mark.skipif(
+    is_windows(), reason='The fake engine runs the "sh -c" locally'
+)
+
+
+@needs_local_sh
+def test_watch(watch_dog, tmp_path, fake_engine, capfd):
+    log = tmp_path / 'log'
+    command = 'open("log", "a").write("run\\n"); raise SystemExit(3)'
+    steps = [
+        # The first run is started right away
+        (idle, ['main.c']),
+        (debouncing, ['util.c']),
+        (idle, KeyboardInterrupt),
+    ]
+    assert watch_dog(command, steps) == 3
+    assert log.read_text() == 'run\nrun\n'
+    _, err = capfd.readouterr()
+    assert err.count('Dog: exit code 3 - waiting for changes') == 2
+    assert 'again (2 files changed)' in err
+    calls = fake_engine.calls()
+    assert [call[0] for call in calls] == ['run', 'exec', 'exec', 'rm']
+    assert calls[0][:4] == ['run', '--rm', '-d', '--name']
+    name = calls[0][4]
+    assert name.startswith('dog-watch-')
+    assert calls[1][-8:-6] == [name, 'sh']
+    assert calls[1][-3:] == [DOG_PYTHON_UNDER_TEST, '-c', command]
+
+
+@needs_local_sh
+def test_watch_cancels_run(watch_dog, tmp_path):
+    log = tmp_path / 'log'
+    command = (
+        'import time; open("log", "a").write("start\\n"); time.sleep(60);'
+        ' open("log", "a").write("end\\n")'
+    )
+    start = time.monotonic()
+    steps = [
+        (running_with_lines(log, 1), ['main.c']),
+        (running_with_lines(log, 2), KeyboardInterrupt),
+    ]
+    watch_dog(command, steps)
+    assert log.read_text() == 'start\nstart\n'
+    assert time.monotonic() - start < 30